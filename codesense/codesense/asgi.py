@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'codesense.settings')
 
 application = get_asgi_application()
+
+# Load the knowledge base and the Ollama model now rather than on the first scan
+from scanner.apps import start_server_warmup
+
+start_server_warmup()
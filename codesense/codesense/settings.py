@@ -84,6 +84,16 @@ DATABASES = {
 MONGO_URI = "mongodb://localhost:27017/"
 MONGO_DB_NAME = "code_sense"
 
+# Directory holding the FAISS knowledge base (index.faiss / index.pkl)
+SCANNER_KB_PATH = BASE_DIR / "scanner"
+# sqlite file caching the scanner's KB query embeddings
+SCANNER_EMBEDDING_CACHE_PATH = BASE_DIR / "scanner" / "embedding_cache.sqlite3"
+# Load the KB and warm the Ollama model when a server process starts (see codesense/wsgi.py and asgi.py)
+# instead of on the first scan
+SCANNER_EAGER_WARMUP = True
+# Ollama hosts serving the scanner's models; LLM and embedding requests are balanced across them
+OLLAMA_HOSTS = ["http://localhost:11434"]
+
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",
     "http://127.0.0.1:5173",
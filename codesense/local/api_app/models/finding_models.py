@@ -22,6 +22,7 @@ class FindingModel:
             "description": finding.get("description", ""),
             "severity": finding.get("severity", ""),
             "file_path": finding.get("file_path", ""),
+            "source_path": finding.get("source_path", ""),
             "code_snip": finding.get("code_snip", ""),
             "security_risk": finding.get("security_risk", ""),
             "mitigation": finding.get("mitigation", ""),
@@ -17,7 +17,8 @@ class ProjectModel:
             "description": project.get("description", ""),
             "created_by": str(project["created_by"]),
             "created_at": project["created_at"].isoformat() if project.get("created_at") else None,
-            "deleted": project.get("deleted", False)
+            "deleted": project.get("deleted", False),
+            "scan_settings": project.get("scan_settings", {})
         }
 
     @classmethod
@@ -71,6 +72,11 @@ class ProjectModel:
     def find_by_id(cls, project_id):
         return cls.serialize(cls.collection.find_one({"_id": ObjectId(project_id)}))
 
+    @classmethod
+    def get_scan_settings(cls, project_id):
+        project = cls.collection.find_one({"_id": ObjectId(project_id)}, projection={"scan_settings": 1})
+        return project.get("scan_settings", {}) if project else {}
+
     @classmethod
     def update(cls, project_id, data):
         cls.collection.update_one({"_id": ObjectId(project_id)}, {"$set": data})
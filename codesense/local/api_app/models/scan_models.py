@@ -7,6 +7,7 @@ from common.db import MongoDBClient
 class ScanModel:
     scans_collection = MongoDBClient.get_database()["scans"]
     findings_collection = MongoDBClient.get_database()["findings"]
+    manifests_collection = MongoDBClient.get_database()["scan_manifests"]
 
     @staticmethod
     def serialize(scan):
@@ -16,13 +17,18 @@ class ScanModel:
             "id": str(scan["_id"]),
             "project_id": str(scan["project_id"]),
             "scan_name": scan.get("scan_name", ""),
+            "scan_mode": scan.get("scan_mode", "full"),
+            "priority": scan.get("priority", "bulk"),
             "status": scan.get("status", "queued"),
             "created_at": scan["created_at"].isoformat() if scan.get("created_at") else None,
             "triggered_by": str(scan.get("triggered_by", "")),
             "total_files": scan.get("total_files", 0),
             "files_scanned": scan.get("files_scanned", 0),
             "findings": scan.get("findings", 0),
+            "failed_files": scan.get("failed_files", 0),
             "end_time": scan["end_time"].isoformat() if scan.get("end_time") else None,
+            "archive_sha256": scan.get("archive_sha256"),
+            "metrics": scan.get("metrics", {}),
         }
 
     @classmethod
@@ -102,6 +108,7 @@ class ScanModel:
         try:
             scan_result = cls.scans_collection.delete_one({"_id": ObjectId(scan_id)})
             cls.findings_collection.delete_many({"scan_id": ObjectId(scan_id)})
+            cls.manifests_collection.delete_many({"scan_id": ObjectId(scan_id)})
             return bool(scan_result.deleted_count)
         except:
             return False
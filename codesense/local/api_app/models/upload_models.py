@@ -0,0 +1,68 @@
+from bson import ObjectId
+from datetime import datetime, timezone
+from common.db import MongoDBClient
+
+class UploadModel:
+    collection = MongoDBClient.get_database()["uploads"]
+
+    @staticmethod
+    def serialize(upload):
+        if not upload:
+            return None
+        return {
+            "id": str(upload["_id"]),
+            "project_id": str(upload["project_id"]),
+            "file_name": upload.get("file_name", ""),
+            "total_size": upload.get("total_size", 0),
+            "received_bytes": upload.get("received_bytes", 0),
+            "sha256": upload.get("sha256"),
+            "status": upload.get("status", "uploading"),
+            "scan_id": str(upload["scan_id"]) if upload.get("scan_id") else None,
+            "created_at": upload["created_at"].isoformat() if upload.get("created_at") else None,
+            "updated_at": upload["updated_at"].isoformat() if upload.get("updated_at") else None,
+        }
+
+    @classmethod
+    def create(cls, data: dict):
+        """
+        Create a new upload document.
+        Expects: project_id, file_name, total_size, sha256 (optional, checked on completion)
+        """
+        data["project_id"] = ObjectId(data["project_id"]) if isinstance(data.get("project_id"), str) else data["project_id"]
+        data["created_at"] = datetime.now(timezone.utc)
+        data["updated_at"] = data["created_at"]
+        data["status"] = "uploading"
+        data["received_bytes"] = 0
+
+        result = cls.collection.insert_one(data)
+        return cls.find_by_id(result.inserted_id)
+
+    @classmethod
+    def find_by_id(cls, upload_id: str):
+        upload = cls.collection.find_one({"_id": ObjectId(upload_id)})
+        return cls.serialize(upload)
+
+    @classmethod
+    def advance(cls, upload_id: str, offset: int, received_bytes: int):
+        """Move received_bytes from offset forward; False if another request already moved it."""
+        result = cls.collection.update_one(
+            {"_id": ObjectId(upload_id), "status": "uploading", "received_bytes": offset},
+            {"$set": {"received_bytes": received_bytes, "updated_at": datetime.now(timezone.utc)}}
+        )
+        return result.modified_count == 1
+
+    @classmethod
+    def complete(cls, upload_id: str, sha256: str, scan_id=None):
+        update_fields = {"status": "completed", "sha256": sha256, "updated_at": datetime.now(timezone.utc)}
+        if scan_id:
+            update_fields["scan_id"] = ObjectId(scan_id)
+        cls.collection.update_one({"_id": ObjectId(upload_id)}, {"$set": update_fields})
+        return cls.find_by_id(upload_id)
+
+    @classmethod
+    def delete_upload(cls, upload_id: str):
+        try:
+            result = cls.collection.delete_one({"_id": ObjectId(upload_id)})
+            return bool(result.deleted_count)
+        except:
+            return False
@@ -1,13 +1,23 @@
 # projects/serializers.py
 from rest_framework import serializers
 
+class CascadeSettingsSerializer(serializers.Serializer):
+    enabled = serializers.BooleanField(required=False)
+    triage_model = serializers.CharField(required=False)
+    escalation_threshold = serializers.FloatField(required=False, min_value=0.0, max_value=1.0)
+
+class ScanSettingsSerializer(serializers.Serializer):
+    cascade = CascadeSettingsSerializer(required=False)
+
 class ProjectCreateSerializer(serializers.Serializer):
     name = serializers.CharField()
     preset = serializers.CharField()
     description = serializers.CharField(allow_blank=True)
+    scan_settings = ScanSettingsSerializer(required=False)
 
 class ProjectUpdateSerializer(serializers.Serializer):
     name = serializers.CharField(required=False)
     preset = serializers.CharField(required=False)
     description = serializers.CharField(required=False)
     deleted = serializers.BooleanField(required=False)
+    scan_settings = ScanSettingsSerializer(required=False)
@@ -5,6 +5,26 @@ class ScanStartSerializer(serializers.Serializer):
     scan_name = serializers.CharField(required=True)
     project_id = serializers.CharField(required=True)
     zip_file = serializers.FileField(required=True)
+    scan_mode = serializers.ChoiceField(choices=["full", "incremental"], default="full")
+    priority = serializers.ChoiceField(choices=["interactive", "bulk"], default="bulk")
+    triage_level = serializers.ChoiceField(choices=["off", "low", "medium", "high"], required=False)
+    cascade = serializers.BooleanField(required=False, allow_null=True, default=None)
+
+class ScanOptionsSerializer(serializers.Serializer):
+    scan_name = serializers.CharField(required=True)
+    scan_mode = serializers.ChoiceField(choices=["full", "incremental"], default="full")
+    priority = serializers.ChoiceField(choices=["interactive", "bulk"], default="bulk")
+    triage_level = serializers.ChoiceField(choices=["off", "low", "medium", "high"], required=False)
+    cascade = serializers.BooleanField(required=False, allow_null=True, default=None)
+
+class UploadCreateSerializer(serializers.Serializer):
+    project_id = serializers.CharField(required=True)
+    file_name = serializers.CharField(required=True)
+    total_size = serializers.IntegerField(min_value=1)
+    sha256 = serializers.RegexField(r"^[0-9a-fA-F]{64}$", required=False)
+    # Only used to match an earlier scan of the same sha256; the scan itself takes them on complete
+    triage_level = serializers.ChoiceField(choices=["off", "low", "medium", "high"], required=False)
+    cascade = serializers.BooleanField(required=False, allow_null=True, default=None)
 
 class ScanProgressSerializer(serializers.Serializer):
     total_files = serializers.IntegerField()
@@ -1,3 +1,146 @@
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory
+from local.api_app.views import upload_views
+from local.api_app.views.upload_views import UploadDetailView, UploadCompleteView
 
-# Create your tests here.
+ARCHIVE = b"PK" + bytes(range(256)) * 40
+
+
+class FakeUploadModel:
+    """In-memory stand-in for UploadModel with the same conditional update semantics."""
+
+    def __init__(self):
+        self.uploads = {}
+
+    def add(self, upload_id, total_size, sha256=None):
+        self.uploads[upload_id] = {"id": upload_id, "project_id": "p1", "file_name": "src.zip", "total_size": total_size,
+                                   "received_bytes": 0, "sha256": sha256, "status": "uploading", "scan_id": None}
+
+    def find_by_id(self, upload_id):
+        upload = self.uploads.get(str(upload_id))
+        return dict(upload) if upload else None
+
+    def advance(self, upload_id, offset, received_bytes):
+        upload = self.uploads.get(upload_id)
+        if not upload or upload["status"] != "uploading" or upload["received_bytes"] != offset:
+            return False
+        upload["received_bytes"] = received_bytes
+        return True
+
+    def complete(self, upload_id, sha256, scan_id=None):
+        self.uploads[upload_id].update(status="completed", sha256=sha256, scan_id=scan_id)
+        return self.find_by_id(upload_id)
+
+    def delete_upload(self, upload_id):
+        return self.uploads.pop(upload_id, None) is not None
+
+
+class UploadResumeTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.uploads = FakeUploadModel()
+        self.start_scan = mock.Mock(return_value=({"scan": {"id": "s1"}}, 202))
+        patches = [
+            mock.patch.object(upload_views, "UPLOAD_ROOT", self.root),
+            mock.patch.object(upload_views, "UploadModel", self.uploads),
+            mock.patch.object(upload_views, "ensure_ready", return_value=True),
+            mock.patch.object(upload_views, "start_archive_scan", self.start_scan),
+            mock.patch.dict(upload_views.upload_hashes, clear=True),
+            mock.patch("local.auth_app.permissions.decorators.decode_token", return_value={"id": "user1", "role": "admin"}),
+            mock.patch("local.auth_app.permissions.decorators.PermissionModel.get_permissions_for_role",
+                       return_value={"create_scan": True}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.factory = APIRequestFactory()
+
+    def start_upload(self, upload_id="u1", sha256=None):
+        self.uploads.add(upload_id, len(ARCHIVE), sha256)
+        os.makedirs(os.path.join(self.root, upload_id))
+        open(os.path.join(self.root, upload_id, "archive"), "wb").close()
+        return upload_id
+
+    def put(self, upload_id, offset, data):
+        request = self.factory.put(f"/api/scans/uploads/{upload_id}/?offset={offset}", data,
+                                   content_type="application/octet-stream", HTTP_AUTHORIZATION="Bearer token")
+        return UploadDetailView.as_view()(request, upload_id=upload_id)
+
+    def complete(self, upload_id):
+        request = self.factory.post(f"/api/scans/uploads/{upload_id}/complete/", {"scan_name": "nightly"}, format="json",
+                                    HTTP_AUTHORIZATION="Bearer token")
+        return UploadCompleteView.as_view()(request, upload_id=upload_id)
+
+    def test_resumes_at_received_bytes(self):
+        upload_id = self.start_upload(sha256=hashlib.sha256(ARCHIVE).hexdigest())
+        self.assertEqual(self.put(upload_id, 0, ARCHIVE[:1000]).status_code, 200)
+        self.assertEqual(self.put(upload_id, 1000, ARCHIVE[1000:]).status_code, 200)
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.start_scan.call_args.args[2], hashlib.sha256(ARCHIVE).hexdigest())
+        self.assertEqual(self.uploads.find_by_id(upload_id)["status"], "completed")
+        with open(os.path.join(self.root, upload_id, "archive"), "rb") as f:
+            self.assertEqual(f.read(), ARCHIVE)
+
+    def test_offset_mismatch_is_rejected(self):
+        upload_id = self.start_upload()
+        self.put(upload_id, 0, ARCHIVE[:1000])
+
+        for offset in (0, 500, 2000):
+            response = self.put(upload_id, offset, ARCHIVE[offset:offset + 100])
+            self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.uploads.find_by_id(upload_id)["received_bytes"], 1000)
+        self.assertEqual(os.path.getsize(os.path.join(self.root, upload_id, "archive")), 1000)
+
+    def test_hash_state_is_rebuilt_after_restart(self):
+        upload_id = self.start_upload(sha256=hashlib.sha256(ARCHIVE).hexdigest())
+        self.put(upload_id, 0, ARCHIVE[:3000])
+        # A restarted process has no running hashes; the next PUT rebuilds it from the stored bytes
+        upload_views.upload_hashes.clear()
+        self.assertEqual(self.put(upload_id, 3000, ARCHIVE[3000:]).status_code, 200)
+
+        self.assertEqual(self.complete(upload_id).status_code, 202)
+        self.assertEqual(self.start_scan.call_args.args[2], hashlib.sha256(ARCHIVE).hexdigest())
+
+    def test_hash_state_is_rebuilt_when_completing_after_restart(self):
+        upload_id = self.start_upload(sha256=hashlib.sha256(ARCHIVE).hexdigest())
+        self.put(upload_id, 0, ARCHIVE)
+        upload_views.upload_hashes.clear()
+
+        self.assertEqual(self.complete(upload_id).status_code, 202)
+        self.assertEqual(self.start_scan.call_args.args[2], hashlib.sha256(ARCHIVE).hexdigest())
+
+    def test_sha256_mismatch_does_not_start_a_scan(self):
+        upload_id = self.start_upload(sha256=hashlib.sha256(b"something else").hexdigest())
+        self.put(upload_id, 0, ARCHIVE)
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.start_scan.assert_not_called()
+        self.assertEqual(self.uploads.find_by_id(upload_id)["status"], "uploading")
+
+    def test_incomplete_upload_cannot_be_completed(self):
+        upload_id = self.start_upload()
+        self.put(upload_id, 0, ARCHIVE[:1000])
+
+        self.assertEqual(self.complete(upload_id).status_code, 409)
+        self.start_scan.assert_not_called()
+
+    def test_running_scan_keeps_upload_for_retry(self):
+        upload_id = self.start_upload()
+        self.put(upload_id, 0, ARCHIVE)
+        self.start_scan.return_value = ({"error": "A scan is already running"}, 409)
+
+        self.assertEqual(self.complete(upload_id).status_code, 409)
+        self.assertEqual(self.uploads.find_by_id(upload_id)["status"], "uploading")
+        self.assertTrue(os.path.exists(os.path.join(self.root, upload_id, "archive")))
+
+        self.start_scan.return_value = ({"scan": {"id": "s1"}}, 202)
+        self.assertEqual(self.complete(upload_id).status_code, 202)
@@ -1,8 +1,12 @@
 from django.urls import path
 from ..views.scan_views import ScanCreateView, ScanDetailView, ScanListView
+from ..views.upload_views import UploadCreateView, UploadDetailView, UploadCompleteView
 
 urlpatterns = [
     path("create/", ScanCreateView.as_view(), name="create-scan"),
+    path("uploads/", UploadCreateView.as_view(), name="create-upload"),
+    path("uploads/<str:upload_id>/", UploadDetailView.as_view(), name="upload-detail"),
+    path("uploads/<str:upload_id>/complete/", UploadCompleteView.as_view(), name="complete-upload"),
     path("<str:scan_id>/", ScanDetailView.as_view(), name="scan-detail"),
     path("project/<str:project_id>/", ScanListView.as_view(), name="scan-list"),
     path("delete/<str:scan_id>/", ScanDetailView.as_view(), name="scan-delete"),
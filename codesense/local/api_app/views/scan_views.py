@@ -1,4 +1,5 @@
-import os, zipfile, uuid
+import os, uuid
+import hashlib
 import tempfile
 from django.http import JsonResponse
 from django.conf import settings
@@ -8,7 +9,11 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from rest_framework.views import APIView
 from rest_framework import status
-from scanner.rag.scanner import scan_folder
+from scanner.rag.scanner import scan_folder, resolve_scan_settings
+from scanner.rag.dedupe import get_settings_key
+from scanner.rag.archive import open_source_archive, ArchiveError
+from scanner.rag.manifest import find_identical_scan
+from scanner.rag.warmup import ensure_ready
 import logging
 import shutil
 import threading
@@ -20,6 +25,103 @@ scan_thread_lock = threading.Lock()
 MEDIA_ROOT = os.path.join(settings.BASE_DIR, "media", "scans")
 os.makedirs(MEDIA_ROOT, exist_ok=True)
 
+def scan_settings_key(project_id, params):
+    """The settings key (see dedupe.get_settings_key) a scan with these options runs with."""
+    return get_settings_key(*resolve_scan_settings(project_id, params.get("triage_level"), params.get("cascade")))
+
+def scan_in_progress():
+    return scan_thread is not None and scan_thread.is_alive()
+
+def start_archive_scan(archive_path, temp_dir, archive_sha256, project_id, triggered_by, params):
+    """
+    Scan an uploaded archive in the background, unless the project already has a completed
+    scan of an identical archive in which no file failed (see find_identical_scan), whose
+    results are returned instead.
+    temp_dir, which holds the archive, is removed once the archive is no longer needed, or when
+    it is rejected (400/500). On 409 (another scan is running) it is left to the caller, so the
+    scan can be retried without uploading the archive again.
+    Returns (response body, HTTP status).
+    """
+    settings_key = scan_settings_key(project_id, params)
+    identical = find_identical_scan(project_id, archive_sha256, settings_key)
+    if identical:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        logging.info(f"Archive {archive_sha256} was already scanned in {identical['_id']}, reusing its results")
+        return {"detail": "Identical archive already scanned.", "duplicate": True, "scan": ScanModel.serialize(identical)}, status.HTTP_200_OK
+
+    if scan_in_progress():
+        return {"detail": "Scan already in progress."}, status.HTTP_409_CONFLICT
+
+    try:
+        source = open_source_archive(archive_path)
+        logging.info(f"Archive has {source.members} members, {source.files} source files to scan")
+
+    except ArchiveError as e:
+        logging.error(f"Rejected uploaded archive: {e}")
+        shutil.rmtree(temp_dir)
+        return {"error": str(e)}, status.HTTP_400_BAD_REQUEST
+
+    except Exception as e:
+        logging.error(f"Failed to process uploaded file: {e}")
+        shutil.rmtree(temp_dir)
+        return {"detail": "Failed to process uploaded file."}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    # Start scan in background thread
+    def run_scan():
+        try:
+            kb_path = str(settings.SCANNER_KB_PATH)
+            logging.info(f"Starting scan with scan_name={params['scan_name']}, kb_path={kb_path}")
+
+            findings = scan_folder(folder_path=archive_path, source=source, scan_id=scan_id, triggered_by=triggered_by, kb_path=kb_path,
+                                   scan_name=params["scan_name"], project_id=project_id, scan_mode=params["scan_mode"], priority=params["priority"],
+                                   triage_level=params.get("triage_level"), cascade=params.get("cascade"))
+            logging.info(f"Scan completed successfully. Found {len(findings) if findings else 0} vulnerabilities.")
+
+        except Exception as e:
+            logging.error(f"Error during scan: {e}")
+            import traceback
+            logging.error(traceback.format_exc())
+        finally:
+            # Cleanup temp files and directory
+            try:
+                source.close()
+                shutil.rmtree(temp_dir)
+                logging.info(f"Cleaned up temporary directory: {temp_dir}")
+            except Exception as e:
+                logging.error(f"Error cleaning up temporary files: {e}")
+
+    global scan_thread
+    with scan_thread_lock:
+        # Checked again before the scan doc exists, so a 409 leaves no queued scan behind
+        if scan_in_progress():
+            source.close()
+            return {"detail": "Scan already in progress."}, status.HTTP_409_CONFLICT
+
+        # Create scan doc
+        scan_data = {
+            "scan_name": params["scan_name"],
+            "project_id": project_id,
+            "status": "queued",
+            "scan_mode": params["scan_mode"],
+            "priority": params["priority"],
+            "archive_sha256": archive_sha256,
+            "settings_key": settings_key,
+            "triggered_by": triggered_by if triggered_by else None
+        }
+        scan = ScanModel.create(scan_data)
+        scan_id = scan["id"]
+        scan_thread = threading.Thread(target=run_scan, daemon=True)
+        scan_thread.start()
+
+    return {"detail": "Scan started successfully.", "scan": scan}, status.HTTP_202_ACCEPTED
+
+
+def scanner_warming_up_response():
+    response = JsonResponse({"detail": "Scanner is warming up. Please try again shortly."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response["Retry-After"] = "10"
+    return response
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class ScanCreateView(APIView):
     @require_permission("create_scan")
@@ -29,85 +131,34 @@ class ScanCreateView(APIView):
         triggered_by = user.get("id", "68863cf8ee93d4964a00d585")
 
         if serializer.is_valid():
-            scan_name = serializer.validated_data['scan_name']
             project_id = serializer.validated_data['project_id']
             zip_file = serializer.validated_data['zip_file']
 
-            # Create scan doc
-            scan_data = {
-                "scan_name": scan_name,
-                "project_id": project_id,
-                "status": "queued",
-                "triggered_by": triggered_by if triggered_by else None
-            }
-            scan = ScanModel.create(scan_data)
-            scan_id = scan["id"]
-
-            # Create temporary directory for both ZIP file and extraction
+            if not ensure_ready(str(settings.SCANNER_KB_PATH)):
+                return scanner_warming_up_response()
+
+            # The upload is scanned in place: source files are read straight from the archive
             temp_dir = tempfile.mkdtemp()
-            temp_zip_path = os.path.join(temp_dir, zip_file.name)
-            extracted_folder_path = os.path.join(temp_dir, 'extracted')
-    
+            temp_zip_path = os.path.join(temp_dir, os.path.basename(zip_file.name))
+
             try:
-                # Save uploaded ZIP file
+                # Save uploaded archive, hashing it on the way
+                digest = hashlib.sha256()
                 with open(temp_zip_path, 'wb+') as f:
                     for chunk in zip_file.chunks():
                         f.write(chunk)
-                logging.info(f"Uploaded zipped folder saved to {temp_zip_path}")
-
-                os.makedirs(extracted_folder_path, exist_ok=True)
-                with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(extracted_folder_path)
-                logging.info(f"ZIP file extracted to {extracted_folder_path}")
-                
-                # List contents for debugging
-                extracted_contents = []
-                for root, dirs, files in os.walk(extracted_folder_path):
-                    for file in files:
-                        extracted_contents.append(os.path.join(root, file))
-                logging.info(f"Extracted {len(extracted_contents)} files: {extracted_contents[:10]}...")  # Show first 10 files
-
-            except zipfile.BadZipFile:
-                logging.error("Uploaded file is not a valid ZIP file")
-                shutil.rmtree(temp_dir)
-                return JsonResponse({"error": "Invalid zip file"}, status=status.HTTP_400_BAD_REQUEST)
+                        digest.update(chunk)
+                logging.info(f"Uploaded archive saved to {temp_zip_path}")
 
             except Exception as e:
                 logging.error(f"Failed to process uploaded file: {e}")
                 shutil.rmtree(temp_dir)
                 return JsonResponse({"detail": "Failed to process uploaded file."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            
-            # Start scan in background thread
-            def run_scan():
-                try:
-                    # Get kb_path - assuming it's in the scanner directory
-                    kb_path = os.path.join(os.getcwd(), 'scanner')
-                    logging.info(f"Starting scan with scan_name={scan_name}, kb_path={kb_path}")
-                    
-                    # Call scan_folder with extracted folder path
-                    findings = scan_folder(folder_path=extracted_folder_path, scan_id=scan_id, triggered_by=triggered_by, kb_path=kb_path, scan_name=scan_name)
-                    logging.info(f"Scan completed successfully. Found {len(findings) if findings else 0} vulnerabilities.")
-                    
-                except Exception as e:
-                    logging.error(f"Error during scan: {e}")
-                    import traceback
-                    logging.error(traceback.format_exc())
-                finally:
-                    # Cleanup temp files and directory
-                    try:
-                        shutil.rmtree(temp_dir)
-                        logging.info(f"Cleaned up temporary directory: {temp_dir}")
-                    except Exception as e:
-                        logging.error(f"Error cleaning up temporary files: {e}")
-
-            global scan_thread
-            with scan_thread_lock:
-                if scan_thread and scan_thread.is_alive():
-                    return JsonResponse({"detail": "Scan already in progress."}, status=status.HTTP_409_CONFLICT)
-                scan_thread = threading.Thread(target=run_scan, daemon=True)
-                scan_thread.start()
-
-            return JsonResponse({"detail": "Scan started successfully.", "scan": scan}, status=status.HTTP_202_ACCEPTED)
+
+            body, status_code = start_archive_scan(temp_zip_path, temp_dir, digest.hexdigest(), project_id, triggered_by, serializer.validated_data)
+            if status_code == status.HTTP_409_CONFLICT:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            return JsonResponse(body, status=status_code)
         else:
             return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
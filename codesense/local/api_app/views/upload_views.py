@@ -0,0 +1,226 @@
+import os
+import hashlib
+import logging
+import shutil
+import threading
+from django.http import JsonResponse
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.decorators import method_decorator
+from rest_framework.views import APIView
+from rest_framework import status
+from local.api_app.models.scan_models import ScanModel
+from local.api_app.models.upload_models import UploadModel
+from local.api_app.serializers.scan_serializers import UploadCreateSerializer, ScanOptionsSerializer
+from local.api_app.views.scan_views import start_archive_scan, scan_settings_key, scanner_warming_up_response
+from local.auth_app.permissions.decorators import require_permission
+from scanner.rag.config import ARCHIVE_MAX_UNCOMPRESSED_BYTES
+from scanner.rag.manifest import find_identical_scan
+from scanner.rag.warmup import ensure_ready
+
+UPLOAD_ROOT = os.path.join(settings.BASE_DIR, "media", "uploads")
+os.makedirs(UPLOAD_ROOT, exist_ok=True)
+
+UPLOAD_MAX_BYTES = ARCHIVE_MAX_UNCOMPRESSED_BYTES
+UPLOAD_READ_BLOCK = 1024 * 1024
+
+# upload id -> [sha256 of the bytes received so far, how many bytes that is]. Lost on restart,
+# in which case it is rebuilt from the stored part of the archive.
+upload_hashes = {}
+upload_locks = {}
+upload_lock = threading.Lock()
+
+
+def _upload_dir(upload_id):
+    return os.path.join(UPLOAD_ROOT, upload_id)
+
+
+def _archive_path(upload_id):
+    return os.path.join(_upload_dir(upload_id), "archive")
+
+
+def _lock_for(upload_id):
+    with upload_lock:
+        return upload_locks.setdefault(upload_id, threading.Lock())
+
+
+def _forget(upload_id):
+    with upload_lock:
+        upload_locks.pop(upload_id, None)
+        upload_hashes.pop(upload_id, None)
+
+
+def _hash_state(upload_id, offset):
+    """Hash of the first `offset` bytes of the upload; called with the upload's lock held."""
+    state = upload_hashes.get(upload_id)
+    if state is None or state[1] != offset:
+        digest = hashlib.sha256()
+        with open(_archive_path(upload_id), "rb") as f:
+            remaining = offset
+            while remaining:
+                block = f.read(min(UPLOAD_READ_BLOCK, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+        state = upload_hashes[upload_id] = [digest, offset]
+    return state
+
+
+def _find_upload(upload_id):
+    try:
+        return UploadModel.find_by_id(upload_id)
+    except Exception:
+        return None
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadCreateView(APIView):
+    """
+    Start a chunked upload of a scan archive. When the client already knows the archive's
+    sha256 and the project has a completed scan of it with the same triage level and
+    cascade setting in which no file failed, that scan is returned instead.
+    """
+
+    @require_permission("create_scan")
+    def post(self, request):
+        serializer = UploadCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = dict(serializer.validated_data)
+        if data["total_size"] > UPLOAD_MAX_BYTES:
+            return JsonResponse({"error": f"Archive is larger than {UPLOAD_MAX_BYTES} bytes"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if data.get("sha256"):
+            data["sha256"] = data["sha256"].lower()
+            identical = find_identical_scan(data["project_id"], data["sha256"], scan_settings_key(data["project_id"], data))
+            if identical:
+                return JsonResponse({"detail": "Identical archive already scanned.", "duplicate": True,
+                                     "scan": ScanModel.serialize(identical)}, status=status.HTTP_200_OK)
+
+        data.pop("triage_level", None)
+        data.pop("cascade", None)
+        upload = UploadModel.create(data)
+        os.makedirs(_upload_dir(upload["id"]), exist_ok=True)
+        open(_archive_path(upload["id"]), "wb").close()
+        return JsonResponse({"upload": upload}, status=status.HTTP_201_CREATED)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadDetailView(APIView):
+    """
+    GET reports how much of the archive has arrived, i.e. where to resume.
+    PUT appends the raw request body at ?offset=, which must equal received_bytes;
+    a dropped request keeps what was received before it dropped.
+    DELETE abandons the upload.
+    """
+
+    @require_permission("create_scan")
+    def get(self, request, upload_id):
+        upload = _find_upload(upload_id)
+        if not upload:
+            return JsonResponse({"error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse({"upload": upload}, status=status.HTTP_200_OK)
+
+    @require_permission("create_scan")
+    def put(self, request, upload_id):
+        try:
+            offset = int(request.query_params.get("offset"))
+        except (TypeError, ValueError):
+            return JsonResponse({"error": "offset is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        with _lock_for(upload_id):
+            upload = _find_upload(upload_id)
+            if not upload:
+                return JsonResponse({"error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+            if upload["status"] != "uploading":
+                return JsonResponse({"error": "Upload is already complete", "upload": upload}, status=status.HTTP_409_CONFLICT)
+            if offset != upload["received_bytes"]:
+                return JsonResponse({"error": "offset does not match the bytes received", "upload": upload},
+                                    status=status.HTTP_409_CONFLICT)
+
+            state = _hash_state(upload_id, offset)
+            received = offset
+            error = None
+            stream = request.stream
+            with open(_archive_path(upload_id), "r+b") as f:
+                f.seek(offset)
+                f.truncate()
+                while stream is not None:
+                    try:
+                        block = stream.read(UPLOAD_READ_BLOCK)
+                    except Exception as e:
+                        logging.warning(f"Upload {upload_id} interrupted at {received} bytes: {e}")
+                        error = "Upload interrupted"
+                        break
+                    if not block:
+                        break
+                    if received + len(block) > upload["total_size"]:
+                        error = "More data than total_size"
+                        break
+                    f.write(block)
+                    state[0].update(block)
+                    received += len(block)
+            state[1] = received
+            UploadModel.advance(upload_id, offset, received)
+
+        upload = UploadModel.find_by_id(upload_id)
+        if error:
+            return JsonResponse({"error": error, "upload": upload}, status=status.HTTP_400_BAD_REQUEST)
+        return JsonResponse({"upload": upload}, status=status.HTTP_200_OK)
+
+    @require_permission("create_scan")
+    def delete(self, request, upload_id):
+        with _lock_for(upload_id):
+            if not UploadModel.delete_upload(upload_id):
+                return JsonResponse({"error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+            shutil.rmtree(_upload_dir(upload_id), ignore_errors=True)
+        _forget(upload_id)
+        return JsonResponse({"detail": "Upload deleted"}, status=status.HTTP_204_NO_CONTENT)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadCompleteView(APIView):
+    """
+    Finish an upload and scan the archive, or reuse the scan of an identical one.
+    When another scan is running (409) the upload stays complete-able and can be retried.
+    """
+
+    @require_permission("create_scan")
+    def post(self, request, upload_id):
+        serializer = ScanOptionsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        triggered_by = request.user.get("id", "68863cf8ee93d4964a00d585")
+
+        if not ensure_ready(str(settings.SCANNER_KB_PATH)):
+            return scanner_warming_up_response()
+
+        with _lock_for(upload_id):
+            upload = _find_upload(upload_id)
+            if not upload:
+                return JsonResponse({"error": "Upload not found"}, status=status.HTTP_404_NOT_FOUND)
+            if upload["status"] != "uploading":
+                return JsonResponse({"error": "Upload is already complete", "upload": upload}, status=status.HTTP_409_CONFLICT)
+            if upload["received_bytes"] != upload["total_size"]:
+                return JsonResponse({"error": "Upload is incomplete", "upload": upload}, status=status.HTTP_409_CONFLICT)
+
+            sha256 = _hash_state(upload_id, upload["received_bytes"])[0].hexdigest()
+            if upload["sha256"] and upload["sha256"] != sha256:
+                return JsonResponse({"error": "sha256 of the received archive does not match", "upload": upload},
+                                    status=status.HTTP_400_BAD_REQUEST)
+
+            body, status_code = start_archive_scan(_archive_path(upload_id), _upload_dir(upload_id), sha256,
+                                                   upload["project_id"], triggered_by, serializer.validated_data)
+            if status_code == status.HTTP_409_CONFLICT:
+                # The archive is kept: complete can be retried once the running scan is done
+                body["upload"] = upload
+                return JsonResponse(body, status=status_code)
+            if status_code in (status.HTTP_200_OK, status.HTTP_202_ACCEPTED):
+                body["upload"] = UploadModel.complete(upload_id, sha256, body["scan"]["id"])
+            else:
+                # start_archive_scan has removed the rejected archive
+                UploadModel.delete_upload(upload_id)
+        _forget(upload_id)
+        return JsonResponse(body, status=status_code)
@@ -1,4 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
+
+
+def start_server_warmup():
+    """
+    Start the scanner warm-up in a process that serves requests, unless SCANNER_EAGER_WARMUP is off.
+    Called from codesense/wsgi.py and asgi.py, which runserver and WSGI/ASGI servers import in their
+    serving process only, so management commands, test runners and scripts never warm up.
+    """
+    if getattr(settings, "SCANNER_EAGER_WARMUP", True):
+        from .rag.warmup import start_warmup
+        start_warmup(str(settings.SCANNER_KB_PATH))
 
 
 class ScannerConfig(AppConfig):
@@ -0,0 +1,50 @@
+# scanner/management/commands/benchmark_kb.py
+
+import json
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from scanner.rag.config import RETRIEVAL_TOP_K
+from scanner.rag.embeddings import embed_queries
+from scanner.rag.kb_index import INDEX_TYPES, benchmark_indexes
+from scanner.rag.kb_store import is_kb_store, load_vectors, resolve_kb_dir
+
+class Command(BaseCommand):
+    help = "Compare recall and latency of the KB index types on a held-out query set"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kb-path", default=str(settings.SCANNER_KB_PATH))
+        parser.add_argument("--queries", help="Query file: a JSON list of strings, or one query per line")
+        parser.add_argument("--holdout", type=int, default=200, help="Without --queries, hold out this many KB documents as queries")
+        parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+        parser.add_argument("--k", type=int, default=RETRIEVAL_TOP_K)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        kb_dir = resolve_kb_dir(options["kb_path"])
+        vectors = load_vectors(kb_dir) if is_kb_store(kb_dir) else None
+        if vectors is None:
+            raise CommandError(f"No vectors.npy in {kb_dir}; rebuild the KB with build_kb first")
+        vectors = np.asarray(vectors, dtype="float32")
+
+        if options["queries"]:
+            with open(options["queries"], "r", encoding="utf-8") as f:
+                raw = f.read()
+            texts = json.loads(raw) if raw.lstrip().startswith("[") else [line for line in raw.splitlines() if line.strip()]
+            queries = np.asarray(embed_queries(texts), dtype="float32")
+            base = vectors
+        else:
+            # Held-out rows are removed from the indexed set so a query never finds itself
+            holdout = min(options["holdout"], len(vectors) // 10)
+            if holdout < 1:
+                raise CommandError("KB is too small to hold out queries; pass --queries")
+            order = np.random.default_rng(options["seed"]).permutation(len(vectors))
+            queries, base = vectors[order[:holdout]], vectors[order[holdout:]]
+
+        self.stdout.write(f"{len(base)} indexed vectors, {len(queries)} queries, k={options['k']}")
+        self.stdout.write(f"{'index':<8}{'recall@k':>10}{'avg ms':>10}{'p95 ms':>10}{'size MB':>10}{'build s':>10}")
+        for row in benchmark_indexes(base, queries, options["types"], options["k"]):
+            self.stdout.write(
+                f"{row['index_type']:<8}{row['recall_at_k']:>10}{row['avg_ms']:>10}{row['p95_ms']:>10}"
+                f"{row['size_mb']:>10}{row['build_seconds']:>10}"
+            )
@@ -0,0 +1,41 @@
+# scanner/management/commands/build_kb.py
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from scanner.rag.config import KB_EMBED_BATCH_SIZE, KB_EMBED_WORKERS, KB_KEEP_VERSIONS, KB_INDEX_TYPE
+from scanner.rag.kb_build import build_kb
+from scanner.rag.kb_index import INDEX_TYPES
+
+class Command(BaseCommand):
+    help = "Build or incrementally update the knowledge base from a local corpus directory"
+
+    def add_arguments(self, parser):
+        parser.add_argument("corpus", help="Directory of CWE/OWASP reference documents (md, txt, html, json, yaml, ...)")
+        parser.add_argument("--kb-path", default=str(settings.SCANNER_KB_PATH), help="KB directory to write the new version into")
+        parser.add_argument("--full", action="store_true", help="Re-embed every document instead of reusing unchanged ones")
+        parser.add_argument("--batch-size", type=int, default=KB_EMBED_BATCH_SIZE)
+        parser.add_argument("--workers", type=int, default=KB_EMBED_WORKERS)
+        parser.add_argument("--index-type", choices=INDEX_TYPES, default=KB_INDEX_TYPE, help="FAISS index type for the new version")
+        parser.add_argument("--keep", type=int, default=KB_KEEP_VERSIONS, help="Number of KB versions to keep on disk")
+
+    def handle(self, *args, **options):
+        try:
+            summary = build_kb(
+                options["corpus"],
+                options["kb_path"],
+                full=options["full"],
+                batch_size=options["batch_size"],
+                workers=options["workers"],
+                keep=options["keep"],
+                index_type=options["index_type"],
+            )
+        except (FileNotFoundError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if summary.get("unchanged"):
+            self.stdout.write(self.style.WARNING(f"KB {summary['kb_version']} is already current; nothing to do."))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Built {summary['index_type']} KB {summary['kb_version']}: {summary['documents']} documents, "
+            f"{summary['embedded']} embedded, {summary['reused']} reused, in {summary['seconds']}s."
+        ))
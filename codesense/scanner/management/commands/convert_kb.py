@@ -0,0 +1,31 @@
+# scanner/management/commands/convert_kb.py
+
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from scanner.rag.kb import compute_kb_version, load_legacy_vector_store
+from scanner.rag.kb_store import write_kb_store, set_current
+
+class Command(BaseCommand):
+    help = "Convert a pickled FAISS knowledge base (index.faiss + index.pkl) to the mmap KB format"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kb-path", default=str(settings.SCANNER_KB_PATH), help="Directory holding index.faiss and index.pkl")
+
+    def handle(self, *args, **options):
+        kb_path = options["kb_path"]
+        try:
+            kb = load_legacy_vector_store(kb_path)
+        except FileNotFoundError as e:
+            raise CommandError(str(e))
+
+        # Keep the legacy version id so LLM cache entries stay valid across the conversion
+        kb_version = compute_kb_version(kb_path)
+        documents = [kb.docstore.search(kb.index_to_docstore_id[row]) for row in range(kb.index.ntotal)]
+
+        version_dir_name = f"kb-{kb_version}"
+        manifest = write_kb_store(os.path.join(kb_path, version_dir_name), kb.index, documents, kb_version=kb_version)
+        set_current(kb_path, version_dir_name)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote KB {manifest['kb_version']} with {manifest['count']} documents to {version_dir_name} and made it current."
+        ))
@@ -1,131 +1,219 @@
 import os
 import logging
 import asyncio
-import aiohttp
 import hashlib
-import psutil
 from .files import read_file
-from .prompts import create_enhanced_prompt
-from .config import get_qa_chain, MAX_TOKENS
-from .extract import extract_relevant_info
-import logging
+from .prompts import create_enhanced_prompt, create_packed_prompt
+from .config import get_qa_chain, LLM_CACHE_ENABLED, LLM_STREAMING_ENABLED, TRIAGE_AGGRESSIVENESS
+from .chunking import chunk_source
+from .cache import get_cached_output, store_output
+from .scheduler import get_scheduler, PRIORITY_BULK, PRIORITY_BACKGROUND
+from .triage import triage_chunk
+from .context import assemble_context, template_tokens
+from .cascade import screen_code
+from .llm import stream_completion, record_timings
+from .extract import extract_relevant_info, extract_packed_info, build_finding, FindingStream
+from .neardup import minhash_signature, relocate_findings
 logger = logging.getLogger(__name__)
 
-def analyze_code_chunk(chunk, file_name, file_extension, scan_id, triggered_by, file_content):
-    """Analyze a single code chunk for vulnerabilities."""
+class AnalysisError(RuntimeError):
+    """
+    Code could not be analysed because a retrieval or LLM call failed. Callers must not
+    treat it as clean; `findings` holds what the parts that were analysed found.
+    """
+
+    def __init__(self, message, findings=()):
+        super().__init__(message)
+        self.findings = list(findings)
+
+async def _stream_documents_chain(combine_chain, documents, instructions, code, stream, scan_id):
+    """Run the stuff chain's prompt through its LLM as a stream, feeding `stream` until it is done."""
+    inputs = combine_chain._get_inputs(documents, instructions=instructions, question=code)
+    full_prompt = combine_chain.llm_chain.prompt.format(**inputs)
+    timings = {}
+    try:
+        await stream_completion(combine_chain.llm_chain.llm, full_prompt, stream.feed, timings)
+    finally:
+        record_timings(scan_id, timings)
+    stream.finish()
+    return stream.output()
+
+async def analyze_prompt(prompt, scan_id, llm_semaphore, cache_enabled=LLM_CACHE_ENABLED, priority=PRIORITY_BULK,
+                         retriever=None, query=None, file_extension=None, stream=None):
+    """
+    Return the LLM output for a prompt, from the cache or through the QA chain's async path.
+    `prompt` is the (instructions, code) pair from prompts.py; the chain's prompt puts the
+    KB documents between the two (see prompts.ANALYSIS_PROMPT_TEMPLATE).
+    With a retriever, KB documents for `query` (the code under analysis, in the language of
+    file_extension) come from the scan's retriever and are fitted to the context window by
+    assemble_context; otherwise from the chain's own retriever.
+    With LLM_STREAMING_ENABLED generation is streamed through `stream` (an
+    extract.FindingStream, which sees each finding as soon as it is complete) and stops
+    early; stream.streamed tells whether it was used rather than the cache.
+    Every LLM call is admitted by the process-wide scheduler.
+    Raises AnalysisError when retrieval or the LLM call fails.
+    """
     qa_chain = get_qa_chain()
     if not qa_chain:
         raise RuntimeError("QA chain not initialized. Call initialize_knowledge_base() first.")
-    
-    findings = []
-    try:
-        prompt = create_enhanced_prompt(chunk, file_name, file_extension)
-        result = qa_chain.invoke({"query": prompt})
-
-        if result and "result" in result:
-            output = result["result"]
-            findings = extract_relevant_info(output, file_name, scan_id, triggered_by, file_content)
-            
-            # Log source documents for debugging
-            if "source_documents" in result and result["source_documents"]:
-                logging.debug(f"Used {len(result['source_documents'])} knowledge base documents")
-        
-    except Exception as e:
-        logging.error(f"Error analyzing chunk: {str(e)}")
-    
-    return findings
-
-def scan_single_file(file_path, scan_id, triggered_by, max_chunk_batch=5, cache_enabled=True):
-    """Scan a single file for vulnerabilities."""
-    file_name = os.path.basename(file_path)
-    file_extension = os.path.splitext(file_name)[1][1:].lower()
-    logger.info(f"Scanning {file_name}...")
-
-    retrieval_cache = {}  # Simple in-memory cache
 
-    def cache_key(prompt):
-        return hashlib.sha256(prompt.encode()).hexdigest()
+    instructions, code = prompt
+    prompt_text = f"{instructions}\n\n{code}"
+    if cache_enabled:
+        output = await asyncio.to_thread(get_cached_output, prompt_text, scan_id)
+        if output is not None:
+            return output
 
-    def batch_chunks(chunks, batch_size):
-        '''Generator Iterator'''    
-        for i in range(0, len(chunks), batch_size):
-            yield chunks[i:i + batch_size]
+    combine_chain = qa_chain.combine_documents_chain
+    try:
+        if retriever is not None:
+            scored_documents = await retriever.retrieve(query or code, file_extension)
+            documents = assemble_context(scored_documents, prompt_text, template_tokens(combine_chain), scan_id)
+        else:
+            documents = await qa_chain.retriever.ainvoke(query or code)
+    except Exception as e:
+        logger.error(f"Error retrieving KB context: {e}")
+        raise AnalysisError(f"KB retrieval failed: {e}") from e
 
-    async def async_invoke(prompt):
-        qa_chain = get_qa_chain()
-        if not qa_chain:
-            raise RuntimeError("QA chain not initialized. Call initialize_knowledge_base() first.")
+    async with llm_semaphore, get_scheduler().slot(scan_id, priority):
         try:
-            result = qa_chain.invoke({"query": prompt})
-            return result.get("result", "")
+            if LLM_STREAMING_ENABLED:
+                output = await _stream_documents_chain(combine_chain, documents, instructions, code,
+                                                       stream or FindingStream(scan_id), scan_id)
+            else:
+                result = await combine_chain.ainvoke({"input_documents": documents, "instructions": instructions, "question": code})
+                output = result.get(combine_chain.output_key, "")
         except Exception as e:
             logger.error(f"Error invoking QA chain: {e}")
-            return ""
-
-    async def analyze_chunk_batch(chunk_batch, session):
+            raise AnalysisError(f"LLM call failed: {e}") from e
+
+    if cache_enabled:
+        await asyncio.to_thread(store_output, prompt_text, output)
+    return output
+
+def _finding_key(finding):
+    return hashlib.sha256((finding.get("title", "") + finding.get("cwe", "") + finding.get("affected_url", "")).encode()).hexdigest()
+
+def _dedupe_findings(findings):
+    unique = []
+    seen = set()
+    for finding in findings:
+        dedup_key = _finding_key(finding)
+        if dedup_key not in seen:
+            seen.add(dedup_key)
+            unique.append(finding)
+    return unique
+
+async def scan_file(file_path, scan_id, triggered_by, llm_semaphore, cache_enabled=LLM_CACHE_ENABLED, priority=PRIORITY_BULK,
+                    file_content=None, triage_level=TRIAGE_AGGRESSIVENESS, retriever=None, cascade=None, on_finding=None,
+                    near_duplicates=None, source_path=None):
+    """
+    Scan a single file for vulnerabilities on the caller's event loop.
+    All chunks are analysed concurrently; llm_semaphore bounds in-flight LLM calls.
+    Chunks are triaged first and, depending on triage_level, skipped or deprioritized
+    when they contain no security-relevant sinks. Pass file_content when the caller
+    has already read the file, and the scan's retriever (see retrieval.get_retriever).
+    With enabled `cascade` settings, a small model screens each chunk first and only
+    chunks it flags get the full analysis.
+    on_finding(finding) is called for every unique finding as soon as it is extracted,
+    while generation of streamed chunks is still running.
+    With the project's `near_duplicates` index (see neardup.py), a chunk similar enough to
+    one analysed before in another file reuses its findings, re-located in this file,
+    instead of the LLM; source_path is the file's path within the project.
+    Raises AnalysisError when the file or any of its chunks could not be analysed.
+    """
+    file_name = os.path.basename(file_path)
+    file_extension = os.path.splitext(file_name)[1][1:].lower()
+    logger.info(f"Scanning {file_name}...")
+    seen = set()
+
+    def accept(finding):
+        key = _finding_key(finding)
+        if key in seen:
+            return False
+        seen.add(key)
+        if on_finding:
+            on_finding(finding)
+        return True
+
+    async def analyze_chunk(chunk):
+        decision = triage_chunk(chunk["text"], file_extension, triage_level, scan_id)
+        if decision == "skip":
+            return []
+        chunk_priority = PRIORITY_BACKGROUND if decision == "deprioritize" else priority
+        signature = None
+        if near_duplicates:
+            signature = await asyncio.to_thread(minhash_signature, chunk["text"], file_extension)
+            similar = await asyncio.to_thread(near_duplicates.find, signature, file_extension, scan_id, source_path) if signature else None
+            if similar is not None:
+                reused = relocate_findings(similar, file_name, file_content, scan_id, triggered_by)
+                return [finding for finding in reused if accept(finding)]
+        if cascade and cascade["enabled"]:
+            if not await screen_code(chunk["text"], file_extension, cascade, scan_id, llm_semaphore, chunk_priority):
+                return []
         findings = []
-        for chunk in chunk_batch:
-            prompt = create_enhanced_prompt(chunk, file_name, file_extension)
-            key = cache_key(prompt)
-
-            if cache_enabled and key in retrieval_cache:
-                output = retrieval_cache[key]
-                logger.debug(f"Cache hit for chunk in {file_name}")
-            else:
-                cpu_percent = psutil.cpu_percent(interval=0.1)
-                mem = psutil.virtual_memory()
-                if cpu_percent > 90 or mem.percent > 90:
-                    logger.warning(f"High system load, throttling...")
-                    await asyncio.sleep(1)
-
-                output = await async_invoke(prompt)
-                if cache_enabled:
-                    retrieval_cache[key] = output
-
-            findings.extend(extract_relevant_info(llm_output=output, file_name=file_name, file_content=file_content, scan_id=scan_id, triggered_by=triggered_by))
 
+        def on_match(_, match):
+            try:
+                finding = build_finding(match, file_name, scan_id, triggered_by, file_content)
+            except Exception as e:
+                logger.warning(f"Error processing vulnerability match: {e}")
+                return
+            if finding and accept(finding):
+                findings.append(finding)
+
+        stream = FindingStream(scan_id, on_match)
+        prompt = create_enhanced_prompt(chunk["text"], file_name, file_extension)
+        output = await analyze_prompt(prompt, scan_id, llm_semaphore, cache_enabled, chunk_priority, retriever, chunk["text"], file_extension, stream)
+        if stream.streamed:
+            stream.count_parse_path()
+        else:
+            extracted = extract_relevant_info(llm_output=output, file_name=file_name, file_content=file_content, scan_id=scan_id, triggered_by=triggered_by)
+            findings = [finding for finding in extracted if accept(finding)]
+        if signature and output:
+            await asyncio.to_thread(near_duplicates.add, signature, file_extension, findings, source_path)
         return findings
 
-    async def process_chunks(chunks):
-        all_findings = []
-        seen = set()
-
-        async with aiohttp.ClientSession() as session:
-            tasks = [analyze_chunk_batch(batch, session) for batch in batch_chunks(chunks, max_chunk_batch)]
-            for result in await asyncio.gather(*tasks):
-                for finding in result:
-                    dedup_key = hashlib.sha256((finding.get("title", "") + finding.get("cwe", "") + finding.get("affected_url", "")).encode()).hexdigest()
-                    if dedup_key not in seen:
-                        seen.add(dedup_key)
-                        all_findings.append(finding)
-        return all_findings
-
     try:
-        file_content = read_file(file_path=file_path)
+        if file_content is None:
+            file_content = await asyncio.to_thread(read_file, file_path)
 
         if len(file_content.strip()) < 50:
             logger.info(f"Skipping {file_name}: file too small.")
             return []
 
-        # Create overlapping chunks
-        chunks = []
-        start = 0
-        while start < len(file_content):
-            end = min(start + MAX_TOKENS, len(file_content))
-            chunk = file_content[start:end].strip()
-            if chunk:
-                chunks.append(chunk)
-            if end == len(file_content):
-                break
-            start = end - 300  # 300-char overlap
-
-        if not chunks:
-            chunks = [file_content]
-
-        all_findings = asyncio.run(process_chunks(chunks))
-        logger.info(f"Found {len(all_findings)} issues in {file_name}")
-        return all_findings
-
+        chunks = chunk_source(file_content, file_extension)
+        results = await asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks), return_exceptions=True)
     except Exception as e:
         logger.exception(f"Failed scanning {file_name}")
-        return []
+        raise AnalysisError(f"Failed scanning {file_name}: {e}") from e
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    all_findings = [finding for result in results if not isinstance(result, BaseException) for finding in result]
+    if errors:
+        raise AnalysisError(f"{len(errors)} of {len(chunks)} chunks of {file_name} failed: {errors[0]}", all_findings)
+
+    logger.info(f"Found {len(all_findings)} issues in {file_name}")
+    return all_findings
+
+async def scan_packed_files(files, scan_id, triggered_by, llm_semaphore, cache_enabled=LLM_CACHE_ENABLED, priority=PRIORITY_BULK,
+                            retriever=None, cascade=None):
+    """
+    Analyse several small files of one language with a single packed prompt.
+    `files` are dicts with path, name, extension, content and their triage decision;
+    returns {path: findings}. The batch runs in the background class only when
+    triage deprioritized every file in it. With an enabled cascade the batch is
+    screened as a whole. Raises AnalysisError when the batch could not be analysed.
+    """
+    if all(f.get("triage") == "deprioritize" for f in files):
+        priority = PRIORITY_BACKGROUND
+    query = "\n\n".join(f["content"] for f in files)
+    if cascade and cascade["enabled"]:
+        if not await screen_code(query, files[0]["extension"], cascade, scan_id, llm_semaphore, priority):
+            return {f["path"]: [] for f in files}
+    prompt = create_packed_prompt(files, files[0]["extension"])
+    output = await analyze_prompt(prompt, scan_id, llm_semaphore, cache_enabled, priority, retriever, query, files[0]["extension"],
+                                  FindingStream(scan_id, packed=True))
+    results = extract_packed_info(output, files, scan_id, triggered_by)
+    logger.info(f"Found {sum(len(v) for v in results.values())} issues in packed batch of {len(files)} files")
+    return {path: _dedupe_findings(findings) for path, findings in results.items()}
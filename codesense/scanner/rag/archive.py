@@ -0,0 +1,289 @@
+import os
+import lzma
+import gzip
+import stat
+import zlib
+import tarfile
+import zipfile
+import threading
+import posixpath
+import logging
+from .config import (
+    ARCHIVE_MAX_MEMBERS,
+    ARCHIVE_MAX_UNCOMPRESSED_BYTES,
+    SCAN_MAX_FILE_BYTES,
+    SCAN_MAX_TOTAL_BYTES,
+    DISCOVERY_SKIPPED_PATHS_LIMIT,
+)
+from .files import (
+    SUPPORTED_EXTENSIONS,
+    DEFAULT_EXCLUDED_DIRS,
+    IGNORE_FILES,
+    SNIFF_BYTES,
+    IgnoreRules,
+    SourceFileWalker,
+    _is_ignored,
+    is_excluded_file,
+    source_extension,
+    sniff_head,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveError(ValueError):
+    """The upload is not a supported archive, or exceeds the archive limits."""
+
+
+# What a truncated or damaged archive raises while its index or a member is read
+CORRUPT_ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, gzip.BadGzipFile, lzma.LZMAError)
+
+
+def _member_path(name):
+    """Normalized '/'-separated path of an archive member, None if it points outside the archive."""
+    path = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if path in ("", ".") or path == ".." or path.startswith("../"):
+        return None
+    return path
+
+
+class SourceArchive(SourceFileWalker):
+    """
+    The source files of an uploaded archive, selected like SourceFileWalker selects files
+    from a folder, but from the archive's index: nothing is extracted to disk.
+    Iterating yields paths under the archive path (so relative_source_path works as for
+    a folder) and read_bytes() decompresses a member into memory when it is needed.
+    The whole index is checked against ARCHIVE_MAX_MEMBERS and ARCHIVE_MAX_UNCOMPRESSED_BYTES
+    up front; ArchiveError is raised when it exceeds them.
+    """
+
+    # Members are read fastest in archive order rather than path order
+    sequential = False
+
+    def __init__(self, archive_path, extensions=SUPPORTED_EXTENSIONS, max_file_bytes=SCAN_MAX_FILE_BYTES,
+                 max_total_bytes=SCAN_MAX_TOTAL_BYTES, skipped_paths_limit=DISCOVERY_SKIPPED_PATHS_LIMIT,
+                 max_members=ARCHIVE_MAX_MEMBERS, max_uncompressed_bytes=ARCHIVE_MAX_UNCOMPRESSED_BYTES):
+        super().__init__(archive_path, extensions, max_file_bytes, max_total_bytes, skipped_paths_limit)
+        self.max_members = max_members
+        self.max_uncompressed_bytes = max_uncompressed_bytes
+        self.members = 0
+        self.uncompressed_bytes = 0
+        # file path -> member, in the order the files are scanned
+        self._members = {}
+        try:
+            self._select()
+        except ArchiveError:
+            self.close()
+            raise
+        except CORRUPT_ARCHIVE_ERRORS as e:
+            self.close()
+            raise ArchiveError(f"Corrupt archive: {e}") from e
+
+    def _index(self):
+        """(name, size, kind, member) for every archive member; kind is file, dir, symlink or other."""
+        raise NotImplementedError
+
+    def _read(self, member, limit=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _select(self):
+        candidates = []
+        # directory -> {ignore file name: IgnoreRules}
+        ignore_files = {}
+        skipped_dirs = set()
+        for name, size, kind, member in self._index():
+            self.members += 1
+            self.uncompressed_bytes += size
+            if self.members > self.max_members:
+                raise ArchiveError(f"Archive has more than {self.max_members} members")
+            if self.uncompressed_bytes > self.max_uncompressed_bytes:
+                raise ArchiveError(f"Archive expands to more than {self.max_uncompressed_bytes} bytes")
+
+            path = _member_path(name)
+            if path is None:
+                self._skip(name, "unsafe_path")
+                continue
+            if kind == "symlink":
+                self._skip(path, "symlink")
+                continue
+            if kind != "file":
+                continue
+
+            parts = path.split("/")
+            excluded = next((i for i, part in enumerate(parts[:-1]) if part in DEFAULT_EXCLUDED_DIRS), None)
+            if excluded is not None:
+                directory = "/".join(parts[:excluded + 1])
+                if directory not in skipped_dirs:
+                    skipped_dirs.add(directory)
+                    self._skip(directory, "excluded_dir")
+                continue
+
+            file_name = parts[-1]
+            if file_name in IGNORE_FILES:
+                base = "/".join(parts[:-1])
+                try:
+                    lines = self._read(member).decode("utf-8", errors="ignore").splitlines()
+                except Exception as e:
+                    logger.warning(f"Could not read {path} from {self.folder_path}: {e}")
+                    continue
+                ignore_files.setdefault(base, {})[file_name] = IgnoreRules(base, lines)
+                continue
+            if source_extension(file_name) not in self.extensions:
+                self._skip(path, "unsupported", record=False)
+                continue
+            if is_excluded_file(file_name):
+                self._skip(path, "excluded_file")
+                continue
+            if size > self.max_file_bytes:
+                self._skip(path, "too_large")
+                continue
+            try:
+                kind = sniff_head(self._read(member, SNIFF_BYTES))
+            except Exception as e:
+                logger.warning(f"Could not read {path} from {self.folder_path}: {e}")
+                self._skip(path, "unreadable")
+                continue
+            candidates.append((path, size, member, kind))
+
+        def rule_sets(path):
+            # Rules of every ignore file in a directory above path, outermost first
+            parts = path.split("/")[:-1]
+            bases = [""] + ["/".join(parts[:i + 1]) for i in range(len(parts))]
+            return [rules for base in bases for name in IGNORE_FILES
+                    for rules in [ignore_files.get(base, {}).get(name)] if rules is not None and rules.rules]
+
+        if not self.sequential:
+            candidates.sort(key=lambda candidate: candidate[0])
+        for path, size, member, kind in candidates:
+            parts = path.split("/")
+            ignored_dir = next((d for d in ("/".join(parts[:i + 1]) for i in range(len(parts) - 1))
+                                if _is_ignored(rule_sets(d), d, True)), None)
+            if ignored_dir is not None:
+                if ignored_dir not in skipped_dirs:
+                    skipped_dirs.add(ignored_dir)
+                    self._skip(ignored_dir, "ignored")
+                continue
+            if _is_ignored(rule_sets(path), path, False):
+                self._skip(path, "ignored")
+                continue
+            if kind:
+                self._skip(path, kind)
+                continue
+            if self.bytes + size > self.max_total_bytes:
+                self._skip(path, "scan_size_cap")
+                continue
+            self.files += 1
+            self.bytes += size
+            self._members[os.path.join(self.folder_path, *parts)] = member
+
+    def __iter__(self):
+        return iter(list(self._members))
+
+    def restrict(self, file_paths):
+        """Only these files will be read from now on."""
+        keep = set(file_paths)
+        self._members = {path: member for path, member in self._members.items() if path in keep}
+
+    def read_bytes(self, file_path):
+        return self._read(self._members[file_path])
+
+    def stats(self):
+        stats = super().stats()
+        stats["archive_members"] = self.members
+        stats["archive_uncompressed_bytes"] = self.uncompressed_bytes
+        return stats
+
+
+class ZipSourceArchive(SourceArchive):
+    """Members come from the zip's central directory and are read concurrently."""
+
+    def __init__(self, archive_path, **kwargs):
+        try:
+            self.zip = zipfile.ZipFile(archive_path)
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f"Invalid zip file: {e}") from e
+        super().__init__(archive_path, **kwargs)
+
+    def _index(self):
+        for info in self.zip.infolist():
+            mode = info.external_attr >> 16
+            kind = "dir" if info.is_dir() else "symlink" if stat.S_ISLNK(mode) else "file"
+            yield info.filename, info.file_size, kind, info
+
+    def _read(self, info, limit=None):
+        with self.zip.open(info) as f:
+            return f.read(limit) if limit else f.read()
+
+    def close(self):
+        self.zip.close()
+
+
+class TarSourceArchive(SourceArchive):
+    """
+    Members of a (usually gzip-compressed) tarball. A compressed tarball can only be read
+    forwards cheaply, so files are scanned in archive order and members skipped over to
+    reach a requested one are kept in memory until they are asked for.
+    """
+
+    sequential = True
+
+    def __init__(self, archive_path, **kwargs):
+        try:
+            # Opening reads the first member header, so a truncated tarball can fail here already
+            self.tar = tarfile.open(archive_path, "r:*")
+        except CORRUPT_ARCHIVE_ERRORS as e:
+            raise ArchiveError(f"Invalid tar archive: {e}") from e
+        self._lock = threading.Lock()
+        self._ahead = {}
+        self._position = 0
+        super().__init__(archive_path, **kwargs)
+        self._order = list(self._members)
+        self._positions = {path: i for i, path in enumerate(self._order)}
+
+    def _index(self):
+        for member in self.tar:
+            kind = "file" if member.isfile() else "dir" if member.isdir() else "symlink" if member.issym() or member.islnk() else "other"
+            yield member.name, member.size if member.isfile() else 0, kind, member
+
+    def _read(self, member, limit=None):
+        f = self.tar.extractfile(member)
+        return f.read(limit) if limit else f.read()
+
+    def restrict(self, file_paths):
+        with self._lock:
+            super().restrict(file_paths)
+            self._ahead.clear()
+
+    def read_bytes(self, file_path):
+        with self._lock:
+            if file_path in self._ahead:
+                return self._ahead.pop(file_path)
+            position = self._positions[file_path]
+            if position >= self._position:
+                for path in self._order[self._position:position]:
+                    if path in self._members:
+                        self._ahead[path] = self._read(self._members[path])
+            data = self._read(self._members[file_path])
+            self._position = position + 1
+            return data
+
+    def close(self):
+        self.tar.close()
+
+
+def open_source_archive(archive_path):
+    """SourceArchive for a .zip or tar(.gz/.bz2/.xz) upload; raises ArchiveError for anything else."""
+    if zipfile.is_zipfile(archive_path):
+        return ZipSourceArchive(archive_path)
+    if tarfile.is_tarfile(archive_path):
+        return TarSourceArchive(archive_path)
+    raise ArchiveError("Unsupported archive format, expected .zip or .tar.gz")
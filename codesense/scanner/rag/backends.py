@@ -0,0 +1,513 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+import weakref
+from collections import deque
+import ollama
+from .config import (
+    get_llm_hosts,
+    LLM_REQUEST_TIMEOUT_SECONDS,
+    LLM_BACKEND_MAX_FAILURES,
+    LLM_HEALTH_CHECK_INTERVAL_SECONDS,
+    LLM_RATE_LIMIT_PER_SECOND,
+    LLM_RATE_LIMIT_BURST,
+)
+
+logger = logging.getLogger(__name__)
+
+# Latencies kept per backend for the stats
+LATENCY_WINDOW = 200
+
+# Per-call timing fields of a finished Ollama generation (durations in nanoseconds)
+GENERATION_TIMING_FIELDS = ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration", "load_duration")
+
+# Ollama unloads a model this long after its last use when a request sets no keep_alive
+DEFAULT_KEEP_ALIVE_SECONDS = 5 * 60
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def keep_alive_seconds(keep_alive):
+    """
+    How long Ollama keeps a model loaded after a request with this keep_alive: seconds as
+    a number, or a duration such as "30m" or "1h30m". None for ever (a negative value).
+    """
+    if keep_alive is None:
+        return DEFAULT_KEEP_ALIVE_SECONDS
+    if isinstance(keep_alive, str):
+        text = keep_alive.strip()
+        try:
+            keep_alive = float(text)
+        except ValueError:
+            sign = -1 if text.startswith("-") else 1
+            body = text.lstrip("+-")
+            parts = _DURATION_PART.findall(body)
+            if not parts or "".join(number + unit for number, unit in parts) != body:
+                return DEFAULT_KEEP_ALIVE_SECONDS
+            keep_alive = sign * sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+    return None if keep_alive < 0 else float(keep_alive)
+
+
+class TokenBucket:
+    """Thread-safe token bucket; reserve() returns how long the caller must wait for its token."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class OllamaBackend:
+    """
+    One Ollama host. The client's HTTP connection pool is shared by every thread and
+    scan of the process. Async callers get an AsyncClient of their own event loop, since
+    its connections belong to the loop that opened them.
+    """
+
+    def __init__(self, host, timeout=LLM_REQUEST_TIMEOUT_SECONDS, rate=LLM_RATE_LIMIT_PER_SECOND, burst=LLM_RATE_LIMIT_BURST):
+        self.host = host
+        self.timeout = timeout
+        self.client = ollama.Client(host=host, timeout=timeout)
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+        # Generations sent to this host
+        self.bucket = TokenBucket(rate, burst)
+        self.rate_limit_wait = 0.0
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.last_error = None
+        self.generation = dict.fromkeys(GENERATION_TIMING_FIELDS, 0)
+        # model -> monotonic time this host last served it
+        self.models_used = {}
+
+    def async_client(self):
+        """The AsyncClient for the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._async_clients[loop] = ollama.AsyncClient(host=self.host, timeout=self.timeout)
+            return client
+
+    def pop_async_client(self):
+        with self._async_lock:
+            return self._async_clients.pop(asyncio.get_running_loop(), None)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "host": self.host,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "avg_latency_seconds": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "p95_latency_seconds": round(latencies[int(0.95 * (len(latencies) - 1))], 3) if latencies else 0.0,
+            "last_error": self.last_error,
+            "rate_limit_wait_seconds": round(self.rate_limit_wait, 3),
+            "prompt_eval_tokens": self.generation["prompt_eval_count"],
+            "prompt_eval_seconds": round(self.generation["prompt_eval_duration"] / 1e9, 3),
+            "eval_tokens": self.generation["eval_count"],
+            "eval_seconds": round(self.generation["eval_duration"] / 1e9, 3),
+        }
+
+
+class BackendPool:
+    """
+    Spreads Ollama requests over several hosts: each request goes to the healthy host
+    with the fewest outstanding requests and fails over to the next one on error.
+    A background thread health-checks every host and reloads the models a host served
+    within their keep_alive if the host unloaded them; idle models are left to expire.
+    Generations wait for a token of the host they were sent to.
+    """
+
+    def __init__(self, hosts, max_failures=LLM_BACKEND_MAX_FAILURES, health_check_interval=LLM_HEALTH_CHECK_INTERVAL_SECONDS):
+        self.backends = [OllamaBackend(host) for host in hosts]
+        self.max_failures = max_failures
+        self.health_check_interval = health_check_interval
+        self.keep_alive_models = {}
+        # num_ctx each model is used with, so health checks reload it the same way
+        self.model_num_ctx = {}
+        self._lock = threading.Lock()
+        self._health_thread = None
+
+    def _acquire(self, exclude):
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            # With every host marked down, still try them rather than stalling the scan
+            healthy = [b for b in candidates if b.healthy] or candidates
+            backend = min(healthy, key=lambda b: (b.outstanding, b.requests))
+            backend.outstanding += 1
+            return backend
+
+    def _reserve_token(self, backend):
+        """Seconds until `backend`'s token bucket admits one more generation."""
+        delay = backend.bucket.reserve()
+        if delay:
+            with self._lock:
+                backend.rate_limit_wait += delay
+        return delay
+
+    def _wait_for_token(self, backend):
+        delay = self._reserve_token(backend)
+        if delay:
+            time.sleep(delay)
+
+    async def _await_token(self, backend):
+        delay = self._reserve_token(backend)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _release(self, backend, started, error=None, model=None):
+        """Release a backend after a request; `model` is the model it served, if it did."""
+        with self._lock:
+            backend.outstanding -= 1
+            backend.requests += 1
+            if error is None:
+                backend.latencies.append(time.monotonic() - started)
+                if model:
+                    backend.models_used[model] = time.monotonic()
+                backend.consecutive_failures = 0
+                backend.healthy = True
+                return
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            backend.last_error = str(error)[:200]
+            if backend.healthy and backend.consecutive_failures >= self.max_failures:
+                backend.healthy = False
+                logger.warning(f"LLM backend {backend.host} marked unhealthy: {error}")
+
+    def _release_failed(self, backend, started, method, error):
+        """Release a backend after a failed request; re-raises errors another host would fail on too."""
+        if isinstance(error, ollama.ResponseError) and error.status_code < 500:
+            # The request itself is bad (e.g. unknown model); another host will not help
+            self._release(backend, started)
+            raise error
+        self._release(backend, started, error)
+        logger.warning(f"LLM backend {backend.host} failed on {method}, trying next: {error}")
+
+    def call(self, method, with_host=False, rate_limited=False, **kwargs):
+        """
+        Run an ollama.Client method on the least loaded healthy host, failing over on errors.
+        With with_host, returns (result, host). With rate_limited, each attempt first waits
+        for a token of the host it goes to.
+        """
+        self.start_health_checks()
+        tried = []
+        last_error = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise RuntimeError(f"All LLM backends failed: {last_error}")
+            tried.append(backend)
+            if rate_limited:
+                self._wait_for_token(backend)
+            started = time.monotonic()
+            try:
+                result = getattr(backend.client, method)(**kwargs)
+            except Exception as e:
+                self._release_failed(backend, started, method, e)
+                last_error = e
+                continue
+            self._release(backend, started, model=kwargs.get("model"))
+            return (result, backend.host) if with_host else result
+
+    async def acall(self, method, with_host=False, rate_limited=False, **kwargs):
+        """call() through the hosts' AsyncClients, without blocking a thread for the request."""
+        self.start_health_checks()
+        tried = []
+        last_error = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise RuntimeError(f"All LLM backends failed: {last_error}")
+            tried.append(backend)
+            started = time.monotonic()
+            try:
+                if rate_limited:
+                    await self._await_token(backend)
+                started = time.monotonic()
+                result = await getattr(backend.async_client(), method)(**kwargs)
+            except asyncio.CancelledError:
+                self._release(backend, started)
+                raise
+            except Exception as e:
+                self._release_failed(backend, started, method, e)
+                last_error = e
+                continue
+            self._release(backend, started, model=kwargs.get("model"))
+            return (result, backend.host) if with_host else result
+
+    async def aclose_clients(self):
+        """Close the running event loop's AsyncClients; call before the loop ends."""
+        for backend in self.backends:
+            client = backend.pop_async_client()
+            if client is not None:
+                try:
+                    # ollama.AsyncClient has no close() of its own
+                    await client._client.aclose()
+                except Exception as e:
+                    logger.debug(f"Closing the async client of {backend.host} failed: {e}")
+
+    def _record_generation(self, host, response, timings):
+        """Add a finished generation's prompt-eval and eval timings to its backend and to `timings`."""
+        values = {name: response.get(name) or 0 for name in GENERATION_TIMING_FIELDS}
+        with self._lock:
+            backend = next((b for b in self.backends if b.host == host), None)
+            if backend is not None:
+                for name, value in values.items():
+                    backend.generation[name] += value
+        if timings is not None:
+            timings.update(values)
+
+    def _remember(self, model, keep_alive, options):
+        self.keep_alive_models[model] = keep_alive
+        if options and "num_ctx" in options:
+            self.model_num_ctx[model] = options["num_ctx"]
+
+    def _load_options(self, model):
+        return {"num_ctx": self.model_num_ctx[model]} if model in self.model_num_ctx else None
+
+    def generate(self, model, prompt, options=None, keep_alive=None, stop=None, format=None, timings=None):
+        """
+        Completion text for a prompt; `format` is "json" or a JSON schema the output must
+        follow. The call's timings are added to the `timings` dict when one is given.
+        """
+        options = dict(options or {})
+        if stop:
+            options["stop"] = stop
+        self._remember(model, keep_alive, options)
+        kwargs = {"format": format} if format else {}
+        started = time.monotonic()
+        response, host = self.call("generate", model=model, prompt=prompt, options=options, keep_alive=keep_alive,
+                                   with_host=True, rate_limited=True, **kwargs)
+        self._record_generation(host, response, timings)
+        if timings is not None:
+            timings["total_seconds"] = time.monotonic() - started
+        return response["response"]
+
+    async def agenerate(self, model, prompt, options=None, keep_alive=None, stop=None, format=None, timings=None):
+        """generate() for callers on an event loop."""
+        options = dict(options or {})
+        if stop:
+            options["stop"] = stop
+        self._remember(model, keep_alive, options)
+        kwargs = {"format": format} if format else {}
+        started = time.monotonic()
+        response, host = await self.acall("generate", model=model, prompt=prompt, options=options, keep_alive=keep_alive,
+                                          with_host=True, rate_limited=True, **kwargs)
+        self._record_generation(host, response, timings)
+        if timings is not None:
+            timings["total_seconds"] = time.monotonic() - started
+        return response["response"]
+
+    def stream_generate(self, model, prompt, options=None, keep_alive=None, stop=None, format=None, timings=None):
+        """
+        Yield the completion of a prompt piece by piece. Fails over like call() until the
+        first piece arrives. Closing the generator closes the response, which makes the
+        host stop generating. `timings` gets the time to the first piece, which is mostly
+        prompt evaluation, and the server's timings when the generation runs to its end.
+        """
+        options = dict(options or {})
+        if stop:
+            options["stop"] = stop
+        self._remember(model, keep_alive, options)
+        kwargs = {"format": format} if format else {}
+        self.start_health_checks()
+        tried = []
+        last_error = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise RuntimeError(f"All LLM backends failed: {last_error}")
+            tried.append(backend)
+            self._wait_for_token(backend)
+            started = time.monotonic()
+            received = False
+            error = None
+            pieces = None
+            try:
+                pieces = backend.client.generate(model=model, prompt=prompt, options=options, keep_alive=keep_alive,
+                                                 stream=True, **kwargs)
+                for piece in pieces:
+                    if not received and timings is not None:
+                        timings["first_token_seconds"] = time.monotonic() - started
+                    received = True
+                    if piece.get("done"):
+                        self._record_generation(backend.host, piece, timings)
+                    yield piece["response"]
+                return
+            except ollama.ResponseError as e:
+                if e.status_code >= 500:
+                    error = e
+                if error is None or received:
+                    raise
+            except Exception as e:
+                error = e
+                if received:
+                    raise
+            finally:
+                if pieces is not None:
+                    pieces.close()
+                if timings is not None:
+                    timings["total_seconds"] = time.monotonic() - started
+                self._release(backend, started, error, model if received else None)
+            last_error = error
+            logger.warning(f"LLM backend {backend.host} failed on generate, trying next: {error}")
+
+    async def astream_generate(self, model, prompt, options=None, keep_alive=None, stop=None, format=None, timings=None):
+        """stream_generate() for callers on an event loop; aclose() it to stop the generation."""
+        options = dict(options or {})
+        if stop:
+            options["stop"] = stop
+        self._remember(model, keep_alive, options)
+        kwargs = {"format": format} if format else {}
+        self.start_health_checks()
+        tried = []
+        last_error = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise RuntimeError(f"All LLM backends failed: {last_error}")
+            tried.append(backend)
+            started = time.monotonic()
+            received = False
+            error = None
+            pieces = None
+            try:
+                await self._await_token(backend)
+                started = time.monotonic()
+                pieces = await backend.async_client().generate(model=model, prompt=prompt, options=options,
+                                                               keep_alive=keep_alive, stream=True, **kwargs)
+                async for piece in pieces:
+                    if not received and timings is not None:
+                        timings["first_token_seconds"] = time.monotonic() - started
+                    received = True
+                    if piece.get("done"):
+                        self._record_generation(backend.host, piece, timings)
+                    yield piece["response"]
+                return
+            except ollama.ResponseError as e:
+                if e.status_code >= 500:
+                    error = e
+                if error is None or received:
+                    raise
+            except Exception as e:
+                error = e
+                if received:
+                    raise
+            finally:
+                if pieces is not None:
+                    await pieces.aclose()
+                if timings is not None:
+                    timings["total_seconds"] = time.monotonic() - started
+                self._release(backend, started, error, model if received else None)
+            last_error = error
+            logger.warning(f"LLM backend {backend.host} failed on generate, trying next: {error}")
+
+    def embed(self, model, prompt, keep_alive=None, options=None):
+        self._remember(model, keep_alive, options)
+        return self.call("embeddings", model=model, prompt=prompt, options=options, keep_alive=keep_alive)["embedding"]
+
+    def warm_up(self, model, keep_alive, num_ctx=None):
+        """Load a model on every host; an empty prompt only loads it. Fails if no host could."""
+        self._remember(model, keep_alive, {"num_ctx": num_ctx} if num_ctx else None)
+        for backend in self.backends:
+            self._check(backend, load=[model])
+        if not any(backend.healthy for backend in self.backends):
+            raise RuntimeError(f"No LLM backend could load {model}")
+
+    def _recently_used(self, backend):
+        """Models `backend` served within their keep_alive, i.e. ones Ollama should still hold."""
+        now = time.monotonic()
+        with self._lock:
+            used = list(backend.models_used.items())
+        recent = []
+        for model, last_used in used:
+            window = keep_alive_seconds(self.keep_alive_models.get(model))
+            if window is None or now - last_used < window:
+                recent.append(model)
+        return recent
+
+    def _check(self, backend, load=()):
+        """
+        Health-check a host. Models in `load` are loaded; recently used ones the host has
+        unloaded (to make room for another, say) are loaded again.
+        """
+        try:
+            loaded = {m.get("model") or m.get("name") for m in backend.client.ps()["models"]}
+            reload = [model for model in self._recently_used(backend) if model not in loaded and model not in load]
+            for model in list(load) + reload:
+                backend.client.generate(model=model, prompt="", keep_alive=self.keep_alive_models.get(model),
+                                        options=self._load_options(model))
+        except Exception as e:
+            with self._lock:
+                backend.last_error = str(e)[:200]
+                if backend.healthy:
+                    logger.warning(f"LLM backend {backend.host} failed its health check: {e}")
+                backend.healthy = False
+            return
+        with self._lock:
+            if not backend.healthy:
+                logger.info(f"LLM backend {backend.host} is healthy again")
+            backend.healthy = True
+            backend.consecutive_failures = 0
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            for backend in self.backends:
+                self._check(backend)
+
+    def start_health_checks(self):
+        if self._health_thread is not None:
+            return
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(target=self._health_loop, name="llm-health", daemon=True)
+                self._health_thread.start()
+
+    def get_stats(self):
+        with self._lock:
+            return [backend.stats() for backend in self.backends]
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_backend_pool():
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = BackendPool(get_llm_hosts())
+    return _POOL
+
+
+async def closing_clients(coro):
+    """Await coro, then close the pool's AsyncClients of this event loop before it ends."""
+    try:
+        return await coro
+    finally:
+        if _POOL is not None:
+            await _POOL.aclose_clients()
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from pymongo import ASCENDING
+from common.db import MongoDBClient
+from .config import (
+    get_kb_version,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL_SECONDS,
+    STRUCTURED_OUTPUT_ENABLED,
+    RETRIEVAL_MODE,
+    RETRIEVAL_TOP_K,
+    RETRIEVAL_REFINE_BY_SINKS,
+    CONTEXT_RELATIVE_DISTANCE,
+    CONTEXT_MAX_DISTANCE,
+    CONTEXT_SAFETY_MARGIN_TOKENS,
+    KB_IVF_NPROBE,
+    KB_HNSW_EF_SEARCH,
+)
+from .llm import LLM_MODEL, LLM_PARAMS
+from .embeddings import EMBEDDING_MODEL
+from .stats import ScanCounters
+
+logger = logging.getLogger(__name__)
+
+CACHE_COLLECTION = MongoDBClient.get_database()["llm_cache"]
+
+# Check the collection size every N inserts rather than on every write
+EVICTION_CHECK_INTERVAL = 100
+
+_INDEX_LOCK = threading.Lock()
+_indexes_ready = False
+
+CACHE_COUNTERS = ScanCounters("hits", "misses")
+
+_EVICTION_LOCK = threading.Lock()
+_inserts_since_eviction = 0
+
+
+def _ensure_indexes():
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _INDEX_LOCK:
+        if _indexes_ready:
+            return
+        try:
+            # TTL index expires entries that have not been read for LLM_CACHE_TTL_SECONDS
+            CACHE_COLLECTION.create_index("last_used", expireAfterSeconds=LLM_CACHE_TTL_SECONDS)
+        except Exception as e:
+            logger.warning(f"Could not create TTL index on LLM cache: {e}")
+        _indexes_ready = True
+
+
+def _settings_hash(settings) -> str:
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:8]
+
+
+def get_retrieval_settings() -> dict:
+    """Settings that decide which KB context goes into a prompt, besides the KB itself."""
+    return {
+        "embedding_model": EMBEDDING_MODEL,
+        "mode": RETRIEVAL_MODE,
+        "top_k": RETRIEVAL_TOP_K,
+        "refine_by_sinks": RETRIEVAL_REFINE_BY_SINKS,
+        "relative_distance": CONTEXT_RELATIVE_DISTANCE,
+        "max_distance": CONTEXT_MAX_DISTANCE,
+        "safety_margin_tokens": CONTEXT_SAFETY_MARGIN_TOKENS,
+        "ivf_nprobe": KB_IVF_NPROBE,
+        "hnsw_ef_search": KB_HNSW_EF_SEARCH,
+    }
+
+
+def get_analysis_version() -> str:
+    """
+    Identifies everything besides the prompt that determines an LLM result: model, LLM
+    params (num_ctx and num_predict also size the context budget), output format, KB
+    version and retrieval settings.
+    """
+    output_format = "json" if STRUCTURED_OUTPUT_ENABLED else "text"
+    return (f"{LLM_MODEL}:{_settings_hash(LLM_PARAMS)}:{output_format}:{get_kb_version()}:"
+            f"{_settings_hash(get_retrieval_settings())}")
+
+
+def make_cache_key(prompt: str) -> str:
+    """Content address for a prompt: prompt hash + model + LLM params + KB version + retrieval settings."""
+    prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+    return hashlib.sha256(f"{prompt_hash}:{get_analysis_version()}".encode()).hexdigest()
+
+
+def get_cache_stats(scan_id):
+    return CACHE_COUNTERS.get(scan_id)
+
+
+def pop_cache_stats(scan_id):
+    return CACHE_COUNTERS.pop(scan_id)
+
+
+def get_cached_output(prompt: str, scan_id=None):
+    """Return the cached LLM output for a prompt, or None on a miss."""
+    _ensure_indexes()
+    key = make_cache_key(prompt)
+    try:
+        entry = CACHE_COLLECTION.find_one_and_update(
+            {"_id": key},
+            {"$set": {"last_used": datetime.now(timezone.utc)}, "$inc": {"hits": 1}},
+            projection={"output": 1},
+        )
+    except Exception as e:
+        logger.warning(f"LLM cache lookup failed: {e}")
+        entry = None
+
+    CACHE_COUNTERS.incr(scan_id, "hits" if entry else "misses")
+    return entry["output"] if entry else None
+
+
+def store_output(prompt: str, output: str):
+    """Persist an LLM output. Empty outputs (failed calls) are never cached."""
+    global _inserts_since_eviction
+    if not output:
+        return
+    _ensure_indexes()
+    now = datetime.now(timezone.utc)
+    try:
+        CACHE_COLLECTION.update_one(
+            {"_id": make_cache_key(prompt)},
+            {
+                "$set": {"output": output, "last_used": now},
+                "$setOnInsert": {
+                    "model": LLM_MODEL,
+                    "kb_version": get_kb_version(),
+                    "created_at": now,
+                    "hits": 0,
+                },
+            },
+            upsert=True,
+        )
+    except Exception as e:
+        logger.warning(f"LLM cache write failed: {e}")
+        return
+
+    with _EVICTION_LOCK:
+        _inserts_since_eviction += 1
+        due = _inserts_since_eviction >= EVICTION_CHECK_INTERVAL
+        if due:
+            _inserts_since_eviction = 0
+    if due:
+        evict_lru()
+
+
+def evict_lru(max_entries: int = LLM_CACHE_MAX_ENTRIES):
+    """Drop the least recently used entries once the cache grows past max_entries."""
+    try:
+        overflow = CACHE_COLLECTION.estimated_document_count() - max_entries
+        if overflow <= 0:
+            return 0
+        stale = CACHE_COLLECTION.find({}, {"_id": 1}).sort("last_used", ASCENDING).limit(overflow)
+        result = CACHE_COLLECTION.delete_many({"_id": {"$in": [doc["_id"] for doc in stale]}})
+        logger.info(f"Evicted {result.deleted_count} LLM cache entries")
+        return result.deleted_count
+    except Exception as e:
+        logger.warning(f"LLM cache eviction failed: {e}")
+        return 0
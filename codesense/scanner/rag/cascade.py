@@ -0,0 +1,96 @@
+import logging
+import re
+from local.api_app.models.project_models import ProjectModel
+from .backends import get_backend_pool
+from .config import (
+    CASCADE_ENABLED,
+    CASCADE_TRIAGE_MODEL,
+    CASCADE_ESCALATION_THRESHOLD,
+    CASCADE_TRIAGE_PARAMS,
+)
+from .llm import LLM_KEEP_ALIVE
+from .scheduler import get_scheduler, PRIORITY_BULK
+from .stats import ScanCounters
+
+logger = logging.getLogger(__name__)
+
+CASCADE_COUNTERS = ScanCounters("screened", "escalated", "cleared", "errors")
+
+SCORE_PATTERN = re.compile(r"\b(10|[0-9])\b")
+
+
+def resolve_cascade_settings(project_id=None, enabled=None):
+    """
+    Cascade settings for a scan: config defaults, overridden by the project's
+    scan_settings.cascade, then by an explicit per-scan `enabled`.
+    """
+    settings = {
+        "enabled": CASCADE_ENABLED,
+        "triage_model": CASCADE_TRIAGE_MODEL,
+        "escalation_threshold": CASCADE_ESCALATION_THRESHOLD,
+    }
+    if project_id:
+        try:
+            project_settings = (ProjectModel.get_scan_settings(project_id) or {}).get("cascade") or {}
+            settings.update({key: value for key, value in project_settings.items() if key in settings and value is not None})
+        except Exception as e:
+            logger.warning(f"Could not load cascade settings for project {project_id}: {e}")
+    if enabled is not None:
+        settings["enabled"] = enabled
+    return settings
+
+
+def create_screening_prompt(code, file_extension):
+    return f"""You are a security reviewer doing a quick first pass over {file_extension.upper()} code.
+Rate from 0 to 10 how likely it is that the code below contains an exploitable security vulnerability
+(0 = clearly safe, 10 = clearly vulnerable). Answer with the number only.
+
+```{file_extension}
+{code}
+```
+
+Rating:"""
+
+
+def parse_screening_score(output):
+    """Score in [0, 1], or None when the model did not answer with a number."""
+    match = SCORE_PATTERN.search(output or "")
+    return int(match.group(1)) / 10 if match else None
+
+
+async def screen_code(code, file_extension, settings, scan_id, llm_semaphore, priority=PRIORITY_BULK):
+    """
+    Ask the small triage model whether code is worth the full analysis.
+    Returns True to escalate. Errors and unparseable answers escalate, so the cascade
+    can only cost recall when the triage model explicitly rates code as safe.
+    """
+    prompt = create_screening_prompt(code, file_extension)
+    CASCADE_COUNTERS.incr(scan_id, "screened")
+    try:
+        async with llm_semaphore, get_scheduler().slot(scan_id, priority):
+            output = await get_backend_pool().agenerate(settings["triage_model"], prompt, CASCADE_TRIAGE_PARAMS, LLM_KEEP_ALIVE)
+        score = parse_screening_score(output)
+    except Exception as e:
+        logger.warning(f"Cascade screening failed, escalating: {e}")
+        score = None
+
+    if score is None:
+        CASCADE_COUNTERS.incr(scan_id, "errors")
+        escalate = True
+    else:
+        escalate = score >= settings["escalation_threshold"]
+    CASCADE_COUNTERS.incr(scan_id, "escalated" if escalate else "cleared")
+    return escalate
+
+
+def _with_rate(counters, settings):
+    rate = round(counters["escalated"] / counters["screened"], 3) if counters["screened"] else None
+    return {**settings, **counters, "escalation_rate": rate}
+
+
+def get_cascade_stats(scan_id, settings):
+    return _with_rate(CASCADE_COUNTERS.get(scan_id), settings)
+
+
+def pop_cascade_stats(scan_id, settings):
+    return _with_rate(CASCADE_COUNTERS.pop(scan_id), settings)
@@ -0,0 +1,230 @@
+import ast
+import logging
+from .tokens import count_tokens
+from .config import CHUNK_TOKEN_BUDGET, CHUNK_OVERLAP_LINES
+
+logger = logging.getLogger(__name__)
+
+# Languages whose blocks are delimited by braces
+BRACE_EXTENSIONS = {
+    "c", "h", "cpp", "cc", "cxx", "hpp", "hh", "hxx", "java", "js", "jsx", "ts", "tsx",
+    "cs", "go", "php", "kt", "kts", "scala", "swift", "rs", "dart", "css", "m", "pl", "pm", "r",
+}
+# Languages made of `;`-terminated statements
+STATEMENT_EXTENSIONS = {"sql"}
+
+# Lines that close a block belong to the unit above them, never start a new one
+CLOSING_PREFIXES = ("end", "}", ")", "]", "</", "fi", "done", "esac", "else", "elif", "elsif", "rescue", "ensure", "-->")
+# Lines that belong to the unit below them
+LEADING_PREFIXES = ("#", "//", "/*", "*", "--", "<!--", "@")
+
+
+def _python_levels(content, lines):
+    """Nesting depth at every line that starts a Python statement, None elsewhere."""
+    tree = ast.parse(content)
+    levels = [None] * len(lines)
+
+    def visit(body, depth):
+        for node in body:
+            decorators = getattr(node, "decorator_list", [])
+            start = min([node.lineno] + [d.lineno for d in decorators]) - 1
+            if 0 <= start < len(levels) and (levels[start] is None or levels[start] > depth):
+                levels[start] = depth
+            for field in ("body", "handlers", "orelse", "finalbody"):
+                children = getattr(node, field, None)
+                if isinstance(children, list) and children and hasattr(children[0], "lineno"):
+                    visit(children, depth + 1)
+
+    visit(tree.body, 0)
+    return levels
+
+
+def _brace_levels(lines):
+    """Brace depth at the start of every line, ignoring braces inside strings and comments."""
+    levels = []
+    depth = 0
+    in_block_comment = False
+    in_template = False
+    for line in lines:
+        levels.append(depth)
+        quote = "`" if in_template else None
+        i = 0
+        while i < len(line):
+            ch = line[i]
+            pair = line[i:i + 2]
+            if in_block_comment:
+                if pair == "*/":
+                    in_block_comment = False
+                    i += 1
+            elif quote:
+                if ch == "\\":
+                    i += 1
+                elif ch == quote:
+                    quote = None
+            elif pair == "//":
+                break
+            elif pair == "/*":
+                in_block_comment = True
+                i += 1
+            elif ch in "\"'`":
+                quote = ch
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth = max(0, depth - 1)
+            i += 1
+        # Only template literals span lines; stray quotes (e.g. Rust lifetimes) end with the line
+        in_template = quote == "`"
+    return levels
+
+
+def _indent_levels(lines):
+    """Indentation width of every line that can start a block, None for blank and closing lines."""
+    levels = []
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(CLOSING_PREFIXES):
+            levels.append(None)
+        else:
+            levels.append(len(line) - len(line.lstrip()))
+    return levels
+
+
+def _statement_levels(lines):
+    """Mark the first line of every `;`-terminated statement."""
+    levels = []
+    at_statement_start = True
+    for line in lines:
+        stripped = line.strip()
+        levels.append(0 if at_statement_start and stripped else None)
+        if stripped:
+            at_statement_start = stripped.endswith(";")
+    return levels
+
+
+def _attach_leading_lines(lines, levels):
+    """Move each unit's start up over the comments and annotations directly above it."""
+    for i in range(len(levels)):
+        level = levels[i]
+        if level is None:
+            continue
+        j = i
+        while j > 0 and lines[j - 1].strip().startswith(LEADING_PREFIXES) and levels[j - 1] in (None, level):
+            j -= 1
+        if j < i:
+            for k in range(j + 1, i + 1):
+                levels[k] = None
+            levels[j] = level
+    return levels
+
+
+def _line_levels(content, lines, file_extension):
+    if file_extension == "py":
+        try:
+            return _python_levels(content, lines)
+        except (SyntaxError, ValueError):
+            logger.debug("Python source did not parse, falling back to indentation")
+            return _indent_levels(lines)
+    if file_extension in BRACE_EXTENSIONS:
+        return _brace_levels(lines)
+    if file_extension in STATEMENT_EXTENSIONS:
+        return _statement_levels(lines)
+    # Ruby, shell, YAML and markup: indentation is the best structural signal
+    return _indent_levels(lines)
+
+
+def _runs(levels, start, end):
+    """Split lines[start:end] into runs that each begin on the range's outermost level."""
+    marked = [level for level in levels[start:end] if level is not None]
+    if not marked:
+        return [(start, end)]
+    base = min(marked)
+    runs = []
+    run_start = start
+    for i in range(start + 1, end):
+        if levels[i] == base:
+            runs.append((run_start, i))
+            run_start = i
+    runs.append((run_start, end))
+    return runs
+
+
+def _windows(line_tokens, start, end, budget, overlap):
+    """Fixed line windows for a unit that has no structure left to split on."""
+    windows = []
+    window_start = start
+    while window_start < end:
+        window_end = window_start
+        used = 0
+        while window_end < end and (window_end == window_start or used + line_tokens[window_end] <= budget):
+            used += line_tokens[window_end]
+            window_end += 1
+        windows.append((window_start, window_end))
+        if window_end >= end:
+            break
+        window_start = max(window_start + 1, window_end - overlap)
+    return windows
+
+
+def _split(levels, line_tokens, start, end, budget, overlap):
+    """Split a range into syntactic units that each fit the budget where the structure allows."""
+    if sum(line_tokens[start:end]) <= budget:
+        return [(start, end)]
+
+    runs = _runs(levels, start, end)
+    if len(runs) > 1:
+        units = []
+        for run_start, run_end in runs:
+            units.extend(_split(levels, line_tokens, run_start, run_end, budget, overlap))
+        return units
+
+    # A single oversized unit: keep its header line and split the body one level down
+    if end - start > 1 and any(level is not None for level in levels[start + 1:end]):
+        return [(start, start + 1)] + _split(levels, line_tokens, start + 1, end, budget, overlap)
+
+    return _windows(line_tokens, start, end, budget, overlap)
+
+
+def chunk_source(content, file_extension, token_budget=CHUNK_TOKEN_BUDGET, overlap_lines=CHUNK_OVERLAP_LINES):
+    """
+    Split source into chunks along function/class/block boundaries.
+
+    Whole units are packed together up to token_budget; only a unit that is larger than the
+    budget on its own is cut into overlapping line windows. Returns dicts with the chunk
+    `text` and its 1-based inclusive `start_line`/`end_line`.
+    """
+    content = content.replace("\r\n", "\n").replace("\r", "\n")
+    lines = content.split("\n")
+    levels = _attach_leading_lines(lines, _line_levels(content, lines, file_extension))
+    line_tokens = [count_tokens(line) + 1 for line in lines]
+
+    units = _split(levels, line_tokens, 0, len(lines), token_budget, overlap_lines)
+
+    packed = []
+    current_start, current_end, current_tokens = None, None, 0
+    for unit_start, unit_end in units:
+        unit_tokens = sum(line_tokens[unit_start:unit_end])
+        if current_start is not None and current_tokens + unit_tokens > token_budget:
+            packed.append((current_start, current_end))
+            current_start = None
+        if current_start is None:
+            current_start, current_tokens = unit_start, 0
+        current_end = unit_end
+        current_tokens += unit_tokens
+    if current_start is not None:
+        packed.append((current_start, current_end))
+
+    chunks = []
+    for chunk_start, chunk_end in packed:
+        while chunk_start < chunk_end and not lines[chunk_start].strip():
+            chunk_start += 1
+        while chunk_end > chunk_start and not lines[chunk_end - 1].strip():
+            chunk_end -= 1
+        # A last window that is only overlap once blank lines are trimmed repeats the previous chunk
+        if chunk_start < chunk_end and (not chunks or chunk_end > chunks[-1]["end_line"]):
+            chunks.append({
+                "text": "\n".join(lines[chunk_start:chunk_end]),
+                "start_line": chunk_start + 1,
+                "end_line": chunk_end,
+            })
+    return chunks
@@ -0,0 +1,152 @@
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+import psutil
+from .backends import get_backend_pool
+from .config import (
+    CONCURRENCY_ADJUST_INTERVAL_SECONDS,
+    CONCURRENCY_DECREASE_FACTOR,
+    CONCURRENCY_LATENCY_TOLERANCE,
+    CONCURRENCY_MIN_SAMPLES,
+    CONCURRENCY_MAX_ERROR_RATE,
+    CONCURRENCY_MEMORY_HIGH_PERCENT,
+    CONCURRENCY_CPU_HIGH_PERCENT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Limit changes kept for the stats
+HISTORY_SIZE = 500
+# How fast the uncongested latency estimate may rise per adjustment, so it follows
+# workloads that are slower rather than congested
+BASELINE_DRIFT = 1.05
+
+
+class ResourceSampler:
+    """Host CPU and memory use. cpu_percent(None) measures since the previous sample, so sampling never blocks."""
+
+    def __init__(self):
+        psutil.cpu_percent(None)
+        self.cpu_percent = 0.0
+        self.memory_percent = 0.0
+
+    def sample(self):
+        self.cpu_percent = psutil.cpu_percent(None)
+        self.memory_percent = psutil.virtual_memory().percent
+        return self.cpu_percent, self.memory_percent
+
+
+class AIMDController:
+    """
+    Adapts the scheduler's limit on in-flight LLM calls from a background thread, with
+    additive increase and multiplicative decrease: one more slot per adjustment while all
+    slots are busy and calls stay fast, a fraction fewer as soon as latency, backend errors
+    or host memory show overload. Latency is the duration of scheduler slots, compared
+    with the best median seen.
+    """
+
+    def __init__(self, scheduler, min_limit, max_limit, interval=CONCURRENCY_ADJUST_INTERVAL_SECONDS):
+        self.scheduler = scheduler
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, scheduler.max_in_flight)
+        self.interval = interval
+        self.sampler = None
+        self.baseline = None
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self._latencies = []
+        self._pool_counts = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._record(scheduler.max_in_flight, "initial")
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self.sampler = ResourceSampler()
+                self._thread = threading.Thread(target=self._loop, name="llm-concurrency", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.adjust()
+            except Exception as e:
+                logger.warning(f"LLM concurrency adjustment failed: {e}")
+
+    def _error_rate(self):
+        """Share of backend requests that failed since the previous adjustment."""
+        stats = get_backend_pool().get_stats()
+        counts = (sum(s["requests"] for s in stats), sum(s["failures"] for s in stats))
+        previous, self._pool_counts = self._pool_counts, counts
+        if previous is None or counts[0] == previous[0]:
+            return 0.0
+        return (counts[1] - previous[1]) / (counts[0] - previous[0])
+
+    def _record(self, limit, reason, **signals):
+        with self._lock:
+            self.history.append({"at": datetime.now(timezone.utc), "limit": limit, "reason": reason, **signals})
+
+    def adjust(self):
+        cpu_percent, memory_percent = self.sampler.sample()
+        error_rate = self._error_rate()
+        with self._lock:
+            latencies, self._latencies = self._latencies, []
+        median = statistics.median(latencies) if len(latencies) >= CONCURRENCY_MIN_SAMPLES else None
+        limit = self.scheduler.max_in_flight
+        in_flight, waiting = self.scheduler.load()
+
+        if memory_percent >= CONCURRENCY_MEMORY_HIGH_PERCENT:
+            reason = "memory"
+        elif error_rate > CONCURRENCY_MAX_ERROR_RATE:
+            reason = "errors"
+        elif median is not None and self.baseline is not None and median > self.baseline * CONCURRENCY_LATENCY_TOLERANCE:
+            reason = "latency"
+        else:
+            reason = None
+
+        if reason:
+            new_limit = max(self.min_limit, int(limit * CONCURRENCY_DECREASE_FACTOR))
+        else:
+            if median is not None:
+                self.baseline = median if self.baseline is None else min(self.baseline * BASELINE_DRIFT, median)
+            saturated = in_flight >= limit or waiting > 0
+            if saturated and limit < self.max_limit and cpu_percent < CONCURRENCY_CPU_HIGH_PERCENT:
+                new_limit, reason = limit + 1, "increase"
+            else:
+                new_limit = limit
+
+        if new_limit != limit:
+            self.scheduler.set_max_in_flight(new_limit)
+            self._record(
+                new_limit, reason,
+                cpu_percent=cpu_percent,
+                memory_percent=memory_percent,
+                error_rate=round(error_rate, 3),
+                median_latency_seconds=round(median, 3) if median is not None else None,
+            )
+            log = logger.info if reason == "increase" else logger.warning
+            log(f"LLM concurrency limit {limit} -> {new_limit} ({reason})")
+
+    def get_stats(self, since=None):
+        """Current limit and signals, and the limit changes since `since` (a UTC datetime)."""
+        with self._lock:
+            history = [entry for entry in self.history if since is None or entry["at"] >= since]
+        return {
+            "limit": self.scheduler.max_in_flight,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "baseline_latency_seconds": round(self.baseline, 3) if self.baseline is not None else None,
+            "cpu_percent": self.sampler.cpu_percent if self.sampler else None,
+            "memory_percent": self.sampler.memory_percent if self.sampler else None,
+            "history": history,
+        }
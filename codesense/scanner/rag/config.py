@@ -1,11 +1,152 @@
+import os
 import threading
 from local.api_app.models.finding_models import FindingModel
 KB_PATH = None
+KB_VERSION = None
 GLOBAL_KNOWLEDGE_BASE = None
 GLOBAL_QA_CHAIN = None
 
 FINDING_MODEL = FindingModel
-MAX_TOKENS = 2048
+# Chunking (see chunking.py): whole syntactic units are packed up to this many tokens;
+# overlapping line windows are only used for a single unit larger than the budget
+CHUNK_TOKEN_BUDGET = 768
+CHUNK_OVERLAP_LINES = 5
+
+# Batched KB retrieval (see retrieval.py): chunk queries are collected for up to
+# RETRIEVAL_BATCH_WAIT_SECONDS, embedded together and searched with one FAISS call
+RETRIEVAL_TOP_K = 5
+RETRIEVAL_BATCH_SIZE = 32
+RETRIEVAL_BATCH_WAIT_SECONDS = 0.05
+EMBEDDING_CONCURRENCY = 4
+# "precomputed": KB context is retrieved once per scan for each language's focus areas and
+# sink categories and reused by every chunk; "per_chunk": every chunk runs its own retrieval
+RETRIEVAL_MODE = "precomputed"
+# Refine precomputed context with the sink categories triage finds in the chunk
+RETRIEVAL_REFINE_BY_SINKS = True
+# Context assembly (see context.py): retrieved documents are ordered by distance, those
+# farther than CONTEXT_RELATIVE_DISTANCE x the best match (or CONTEXT_MAX_DISTANCE) are
+# dropped, and the rest are fitted into num_ctx minus num_predict minus the prompt
+CONTEXT_RELATIVE_DISTANCE = 1.5
+CONTEXT_MAX_DISTANCE = None
+CONTEXT_SAFETY_MARGIN_TOKENS = 64
+
+# KB builds (see kb_build.py): corpus documents are split into chunks of this many
+# tokens and embedded in batches of KB_EMBED_BATCH_SIZE on KB_EMBED_WORKERS threads
+KB_DOC_TOKEN_BUDGET = 384
+KB_EMBED_BATCH_SIZE = 64
+KB_EMBED_WORKERS = 4
+KB_KEEP_VERSIONS = 3
+
+# KB index type (see kb_index.py): flat, ivf, hnsw or ivfpq, chosen when the KB is built.
+# Build-time shape, then the search-time recall/speed knobs applied on load.
+KB_INDEX_TYPE = "flat"
+KB_IVF_NLIST = None  # None: 4*sqrt(number of documents)
+KB_HNSW_M = 32
+KB_HNSW_EF_CONSTRUCTION = 200
+KB_PQ_SUBQUANTIZERS = 64
+KB_PQ_BITS = 8
+KB_IVF_NPROBE = 16
+KB_HNSW_EF_SEARCH = 64
+
+# File discovery (see files.py): files larger than SCAN_MAX_FILE_BYTES are skipped, and so is
+# everything past SCAN_MAX_TOTAL_BYTES of source per scan. The first
+# DISCOVERY_SKIPPED_PATHS_LIMIT skipped paths are recorded on the scan with their reason.
+SCAN_MAX_FILE_BYTES = 1024 * 1024
+SCAN_MAX_TOTAL_BYTES = 256 * 1024 * 1024
+DISCOVERY_SKIPPED_PATHS_LIMIT = 1000
+
+# Uploaded archives (see archive.py) are read member by member, never extracted. Archives with
+# more members, or whose members add up to more uncompressed bytes, are rejected outright.
+ARCHIVE_MAX_MEMBERS = 200000
+ARCHIVE_MAX_UNCOMPRESSED_BYTES = 4 * 1024 * 1024 * 1024
+
+# Pre-LLM triage (see triage.py): off, low, medium or high
+TRIAGE_AGGRESSIVENESS = "medium"
+
+# Prompt packing (see packing.py): files up to PACK_FILE_MAX_TOKENS are combined with other
+# small files of the same language into one prompt. The reserve leaves room in num_ctx for
+# the instruction preamble and the retrieved KB documents.
+PACK_FILE_MAX_TOKENS = 384
+PACKED_PROMPT_RESERVE_TOKENS = 1600
+
+# Two-tier model cascade (see cascade.py): a small model rates every chunk 0-10 and only
+# chunks rated at or above the threshold (as a 0-1 fraction) reach the full analysis.
+# Projects override these under scan_settings.cascade.
+CASCADE_ENABLED = False
+CASCADE_TRIAGE_MODEL = "codellama:7b"
+CASCADE_ESCALATION_THRESHOLD = 0.3
+CASCADE_TRIAGE_PARAMS = {
+    "temperature": 0.0,
+    "num_ctx": 2048,
+    "num_predict": 4,
+}
+
+# Structured LLM output (see extract.py): the model server constrains generation to the
+# findings JSON schema (llm.FINDINGS_SCHEMA) and prompts ask for JSON instead of the
+# labelled text format. Output that is not valid JSON still goes through the regex parser.
+STRUCTURED_OUTPUT_ENABLED = True
+# Streamed generation (see extract.FindingStream): findings are extracted and saved as their
+# blocks complete, and generation stops once the model reports no findings or repeats one
+LLM_STREAMING_ENABLED = True
+
+# Scan engine concurrency: files read/chunked at once, and in-flight LLM calls per scan
+SCAN_FILE_CONCURRENCY = 20
+SCAN_LLM_CONCURRENCY = 8
+
+# LLM backends (see backends.py): requests are spread over settings.OLLAMA_HOSTS;
+# a host is taken out of rotation after LLM_BACKEND_MAX_FAILURES consecutive failures
+# until a health check succeeds again
+DEFAULT_OLLAMA_HOST = "http://localhost:11434"
+LLM_REQUEST_TIMEOUT_SECONDS = 300
+LLM_BACKEND_MAX_FAILURES = 3
+LLM_HEALTH_CHECK_INTERVAL_SECONDS = 30
+
+# Process-wide LLM scheduler (see scheduler.py): slots shared by all scans (per backend host), and
+# a token bucket per backend host (requests/second, burst size) that generations sent to the host
+# wait for (see backends.py). A rate of None disables the buckets.
+LLM_MAX_IN_FLIGHT = 4
+LLM_RATE_LIMIT_PER_SECOND = 5.0
+LLM_RATE_LIMIT_BURST = 10
+
+# Adaptive LLM concurrency (see concurrency.py): every CONCURRENCY_ADJUST_INTERVAL_SECONDS the
+# scheduler's slot limit (starting at LLM_MAX_IN_FLIGHT) grows by one while it is saturated, and
+# is multiplied by CONCURRENCY_DECREASE_FACTOR when host memory is above
+# CONCURRENCY_MEMORY_HIGH_PERCENT, backend errors exceed CONCURRENCY_MAX_ERROR_RATE, or the
+# median call latency exceeds CONCURRENCY_LATENCY_TOLERANCE x the uncongested one. No increases
+# while host CPU is above CONCURRENCY_CPU_HIGH_PERCENT. Limits are per backend host.
+CONCURRENCY_ADAPTIVE = True
+LLM_MIN_IN_FLIGHT = 1
+LLM_MAX_IN_FLIGHT_CEILING = 8
+CONCURRENCY_ADJUST_INTERVAL_SECONDS = 5.0
+CONCURRENCY_DECREASE_FACTOR = 0.7
+CONCURRENCY_LATENCY_TOLERANCE = 2.0
+CONCURRENCY_MIN_SAMPLES = 4
+CONCURRENCY_MAX_ERROR_RATE = 0.1
+CONCURRENCY_MEMORY_HIGH_PERCENT = 90
+CONCURRENCY_CPU_HIGH_PERCENT = 95
+
+# Persistent LLM result cache (see cache.py)
+LLM_CACHE_ENABLED = True
+LLM_CACHE_MAX_ENTRIES = 100_000
+LLM_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Content dedupe (see dedupe.py): files with the same normalized content are analysed once per
+# scan, and whole-file results are reused across scans and projects for CONTENT_ANALYSIS_TTL_SECONDS
+CONTENT_DEDUPE_ENABLED = True
+CONTENT_ANALYSIS_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Near-duplicate chunk reuse (see neardup.py): a chunk whose estimated similarity to a chunk analysed
+# earlier in the same project is at least NEAR_DUPLICATE_THRESHOLD reuses that chunk's findings.
+# Signatures are MINHASH_PERMUTATIONS MinHashes of MINHASH_SHINGLE_SIZE-token shingles, indexed in
+# MINHASH_BANDS LSH bands; chunks with fewer than NEAR_DUPLICATE_MIN_TOKENS tokens are not indexed.
+NEAR_DUPLICATE_ENABLED = True
+NEAR_DUPLICATE_THRESHOLD = 0.85
+NEAR_DUPLICATE_MIN_TOKENS = 40
+NEAR_DUPLICATE_MAX_CANDIDATES = 20
+NEAR_DUPLICATE_TTL_SECONDS = 30 * 24 * 60 * 60
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 16
+MINHASH_SHINGLE_SIZE = 5
 
 DB_LOCK = threading.Lock()
 PROGRESS_LOCK = threading.Lock()
@@ -15,6 +156,16 @@ SCAN_PROGRESS = {
     "status": "not_started"
 }
 
+def get_llm_hosts():
+    from django.conf import settings
+    return list(getattr(settings, "OLLAMA_HOSTS", None) or [DEFAULT_OLLAMA_HOST])
+
+def get_embedding_cache_path():
+    """sqlite file of the on-disk query embedding cache (settings.SCANNER_EMBEDDING_CACHE_PATH)."""
+    from django.conf import settings
+    path = getattr(settings, "SCANNER_EMBEDDING_CACHE_PATH", None) or os.path.join(settings.BASE_DIR, "scanner", "embedding_cache.sqlite3")
+    return str(path)
+
 def set_kb_path(path: str):
     global KB_PATH
     KB_PATH = path
@@ -22,6 +173,13 @@ def set_kb_path(path: str):
 def get_kb_path():
     return KB_PATH
 
+def set_kb_version(version: str):
+    global KB_VERSION
+    KB_VERSION = version
+
+def get_kb_version():
+    return KB_VERSION
+
 def set_knowledge_base(kb):
     global GLOBAL_KNOWLEDGE_BASE
     GLOBAL_KNOWLEDGE_BASE = kb
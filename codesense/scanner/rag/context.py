@@ -0,0 +1,87 @@
+import logging
+from .config import CONTEXT_RELATIVE_DISTANCE, CONTEXT_MAX_DISTANCE, CONTEXT_SAFETY_MARGIN_TOKENS
+from .llm import LLM_PARAMS
+from .stats import ScanCounters
+from .tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+TOKEN_COUNTERS = ScanCounters(
+    "calls", "prompt_tokens", "context_tokens", "docs_used",
+    "docs_dropped_distance", "docs_dropped_budget", "overflows",
+)
+
+# Separator the stuff chain puts between documents
+DOCUMENT_SEPARATOR_TOKENS = 2
+
+_template_tokens = {}
+
+
+def template_tokens(combine_chain):
+    """Tokens of the stuff chain's own prompt text around {context} and {question}."""
+    key = id(combine_chain)
+    if key not in _template_tokens:
+        try:
+            prompt = combine_chain.llm_chain.prompt
+            _template_tokens[key] = count_tokens(prompt.format(**{name: "" for name in prompt.input_variables}))
+        except Exception:
+            _template_tokens[key] = 0
+    return _template_tokens[key]
+
+
+def context_budget(prompt_tokens, overhead_tokens=0):
+    """Tokens left for KB documents once the prompt, the template and num_predict are accounted for."""
+    return LLM_PARAMS["num_ctx"] - LLM_PARAMS["num_predict"] - CONTEXT_SAFETY_MARGIN_TOKENS - prompt_tokens - overhead_tokens
+
+
+def assemble_context(scored_documents, prompt, overhead_tokens=0, scan_id=None,
+                     relative_distance=CONTEXT_RELATIVE_DISTANCE, max_distance=CONTEXT_MAX_DISTANCE):
+    """
+    Pick the documents to stuff into a prompt from (document, L2 distance) pairs:
+    closest first, without the ones too far from the best match, up to the token budget.
+    Records the call's token usage for the scan and returns the documents.
+    """
+    prompt_tokens = count_tokens(prompt)
+    budget = context_budget(prompt_tokens, overhead_tokens)
+    ranked = sorted(scored_documents, key=lambda pair: pair[1])
+
+    cutoff = None
+    if ranked and relative_distance and ranked[0][1] > 0:
+        cutoff = ranked[0][1] * relative_distance
+    if max_distance is not None:
+        cutoff = max_distance if cutoff is None else min(cutoff, max_distance)
+
+    documents = []
+    used = 0
+    dropped_distance = dropped_budget = 0
+    for document, distance in ranked:
+        if cutoff is not None and distance > cutoff and documents:
+            dropped_distance += 1
+            continue
+        tokens = count_tokens(document.page_content) + DOCUMENT_SEPARATOR_TOKENS
+        if used + tokens > budget:
+            dropped_budget += 1
+            continue
+        documents.append(document)
+        used += tokens
+
+    if budget < 0:
+        logger.warning(f"Prompt of {prompt_tokens} tokens leaves no room in num_ctx={LLM_PARAMS['num_ctx']}")
+    TOKEN_COUNTERS.incr(scan_id, "calls")
+    TOKEN_COUNTERS.incr(scan_id, "prompt_tokens", prompt_tokens + overhead_tokens)
+    TOKEN_COUNTERS.incr(scan_id, "context_tokens", used)
+    TOKEN_COUNTERS.incr(scan_id, "docs_used", len(documents))
+    TOKEN_COUNTERS.incr(scan_id, "docs_dropped_distance", dropped_distance)
+    TOKEN_COUNTERS.incr(scan_id, "docs_dropped_budget", dropped_budget)
+    TOKEN_COUNTERS.incr(scan_id, "overflows", int(budget < 0))
+    logger.debug(f"Context: {prompt_tokens} prompt + {overhead_tokens} template + {used} context tokens, "
+                 f"{len(documents)} docs, {dropped_distance} too far, {dropped_budget} over budget")
+    return documents
+
+
+def get_token_stats(scan_id):
+    return TOKEN_COUNTERS.get(scan_id)
+
+
+def pop_token_stats(scan_id):
+    return TOKEN_COUNTERS.pop(scan_id)
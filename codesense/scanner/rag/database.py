@@ -1,9 +1,17 @@
+import asyncio
+from bson import ObjectId
+from datetime import datetime, timezone
 from .config import FINDING_MODEL, DB_LOCK
 import logging
 
 logger = logging.getLogger(__name__)
 collection = FINDING_MODEL
 
+# Keep `$in` lists well below Mongo's document size limit
+PATH_QUERY_BATCH = 1000
+# Findings per insert_many of the background writer
+FINDING_WRITE_BATCH = 100
+
 def save_findings_to_db(findings):
     """Save findings to MongoDB database."""
     if not findings:
@@ -14,6 +22,60 @@ def save_findings_to_db(findings):
         except Exception as e:
             logging.error(f"Error saving findings to database: {e}")
 
+class FindingWriter:
+    """
+    Saves a scan's findings on a background task as they are produced, in batches of up
+    to FINDING_WRITE_BATCH. A finding handed in twice (streamed, then again with its
+    file's results) is saved once. Used from a single event loop.
+    """
+
+    def __init__(self, batch_size=FINDING_WRITE_BATCH):
+        self.batch_size = batch_size
+        self._queue = []
+        self._added = set()
+        self._task = None
+
+    def add(self, findings):
+        for finding in findings:
+            # Findings stay referenced by the scan until it ends, so their ids are not reused
+            if id(finding) not in self._added:
+                self._added.add(id(finding))
+                self._queue.append(finding)
+        if self._queue and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        while self._queue:
+            batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            await asyncio.to_thread(save_findings_to_db, batch)
+
+    async def flush(self):
+        """Wait until every added finding is saved."""
+        while self._task is not None and not self._task.done():
+            await self._task
+
+def carry_forward_findings(previous_scan_id, scan_id, source_paths):
+    """
+    Copy the findings of unchanged files from a previous scan into the new scan.
+    Triage state (status/approved) is preserved; `carried_from` links back to the original.
+    """
+    paths = sorted(source_paths)
+    carried = []
+    for i in range(0, len(paths), PATH_QUERY_BATCH):
+        cursor = collection.collection.find({
+            "scan_id": ObjectId(previous_scan_id),
+            "source_path": {"$in": paths[i:i + PATH_QUERY_BATCH]},
+            "deleted": False,
+        })
+        for finding in cursor:
+            finding["carried_from"] = finding.pop("_id")
+            finding["scan_id"] = ObjectId(scan_id)
+            finding["created_at"] = datetime.now(timezone.utc)
+            carried.append(finding)
+
+    save_findings_to_db(carried)
+    return carried
+
 def get_severity_counts(scan_id):
     pipeline = [
         {"$match": {"scan_id": scan_id}},
@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from bson import ObjectId
+from common.db import MongoDBClient
+from .cache import get_analysis_version
+from .config import CONTENT_ANALYSIS_TTL_SECONDS
+from .extract import new_finding_code
+from .stats import ScanCounters
+
+logger = logging.getLogger(__name__)
+
+CONTENT_COLLECTION = MongoDBClient.get_database()["content_analyses"]
+
+# Fields that belong to one finding in one scan rather than to the analysed content
+SCAN_FINDING_FIELDS = {"_id", "scan_id", "code", "file_path", "source_path", "status", "deleted", "approved",
+                       "created_at", "created_by", "carried_from"}
+
+DEDUPE_COUNTERS = ScanCounters("unique_files", "duplicate_files", "reused_analyses")
+
+_INDEX_LOCK = threading.Lock()
+_indexes_ready = False
+
+
+def _ensure_indexes():
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _INDEX_LOCK:
+        if _indexes_ready:
+            return
+        try:
+            CONTENT_COLLECTION.create_index("last_used", expireAfterSeconds=CONTENT_ANALYSIS_TTL_SECONDS)
+        except Exception as e:
+            logger.warning(f"Could not create TTL index on content analyses: {e}")
+        _indexes_ready = True
+
+
+def normalize_content(content):
+    """
+    Content with line endings, trailing whitespace and a BOM normalized away. Lines are
+    kept where they are, so findings of one copy point at the same lines in every copy.
+    """
+    content = content.lstrip("\ufeff").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in content.split("\n")).rstrip("\n")
+
+
+def get_settings_key(triage_level, cascade):
+    """The scan settings besides the analysis version that change what a file's analysis finds."""
+    if cascade and cascade["enabled"]:
+        return f"{triage_level}:cascade:{cascade['triage_model']}:{cascade['escalation_threshold']}"
+    return f"{triage_level}:direct"
+
+
+def content_key(content, file_extension, settings_key):
+    """Identifies a file's analysis: normalized content, language, scan settings and analysis version."""
+    digest = hashlib.sha256(normalize_content(content).encode("utf-8", errors="ignore")).hexdigest()
+    return hashlib.sha256(f"{digest}:{file_extension}:{settings_key}:{get_analysis_version()}".encode()).hexdigest()
+
+
+def content_fields(finding):
+    # list() takes the items at once: the finding writer may be adding _id on another thread
+    return {name: value for name, value in list(finding.items()) if name not in SCAN_FINDING_FIELDS}
+
+
+def copy_finding(finding, file_name, scan_id, triggered_by):
+    """A new finding for file_name with the content-derived fields of `finding`."""
+    copy = content_fields(finding)
+    start_line, end_line = copy.get("lines") or [1, 1]
+    copy.update({
+        "scan_id": ObjectId(scan_id),
+        "code": new_finding_code(),
+        "file_path": f"{file_name} [{start_line},{end_line}]",
+        "lines": [start_line, end_line],
+        "status": "open",
+        "deleted": False,
+        "approved": False,
+        "created_at": datetime.now(timezone.utc),
+        "created_by": ObjectId(triggered_by),
+    })
+    return copy
+
+
+def get_content_analysis(key, scan_id=None):
+    """Findings (content fields only) stored for a content key by an earlier scan, or None."""
+    _ensure_indexes()
+    try:
+        entry = CONTENT_COLLECTION.find_one_and_update(
+            {"_id": key},
+            {"$set": {"last_used": datetime.now(timezone.utc)}, "$inc": {"hits": 1}},
+            projection={"findings": 1},
+        )
+    except Exception as e:
+        logger.warning(f"Content analysis lookup failed: {e}")
+        return None
+    if entry is None:
+        return None
+    DEDUPE_COUNTERS.incr(scan_id, "reused_analyses")
+    return entry["findings"]
+
+
+def store_content_analysis(key, findings):
+    _ensure_indexes()
+    now = datetime.now(timezone.utc)
+    try:
+        CONTENT_COLLECTION.update_one(
+            {"_id": key},
+            {
+                "$set": {
+                    "findings": [content_fields(finding) for finding in findings],
+                    "last_used": now,
+                },
+                "$setOnInsert": {"created_at": now, "hits": 0},
+            },
+            upsert=True,
+        )
+    except Exception as e:
+        logger.warning(f"Content analysis write failed: {e}")
+
+
+def get_dedupe_stats(scan_id):
+    return DEDUPE_COUNTERS.get(scan_id)
+
+
+def pop_dedupe_stats(scan_id):
+    return DEDUPE_COUNTERS.pop(scan_id)
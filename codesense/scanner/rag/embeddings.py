@@ -1,4 +1,46 @@
-from langchain_community.embeddings import OllamaEmbeddings
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from langchain_core.embeddings import Embeddings
+from .backends import get_backend_pool
+from .config import EMBEDDING_CONCURRENCY
+from .llm import LLM_MODEL, LLM_PARAMS
+
+EMBEDDING_MODEL = "codellama:13b"
+# Served by the same loaded model as generation: use its num_ctx so Ollama does not reload it
+# (and drop the cached prompt prefix) on every embedding request
+EMBEDDING_OPTIONS = {"num_ctx": LLM_PARAMS["num_ctx"]} if EMBEDDING_MODEL == LLM_MODEL else None
+
+_EMBEDDING_POOL = ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY, thread_name_prefix="embed")
+
+
+class PooledOllamaEmbeddings(Embeddings):
+    """
+    Embeddings through the Ollama backend pool. Uses the same per-text endpoint and
+    instruction prefixes as langchain_community's OllamaEmbeddings, which the KB was
+    built with, so vectors stay comparable with the existing index.
+    """
+
+    def __init__(self, model=EMBEDDING_MODEL, embed_instruction="passage: ", query_instruction="query: "):
+        self.model = model
+        self.embed_instruction = embed_instruction
+        self.query_instruction = query_instruction
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        pool = get_backend_pool()
+        return [list(pool.embed(self.model, f"{self.embed_instruction}{text}", options=EMBEDDING_OPTIONS)) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return list(get_backend_pool().embed(self.model, f"{self.query_instruction}{text}", options=EMBEDDING_OPTIONS))
+
 
 def get_embeddings():
-    return OllamaEmbeddings(model="codellama:13b")
+    return PooledOllamaEmbeddings()
+
+def embed_queries(texts):
+    """
+    Embed a batch of retrieval queries exactly as embed_query would.
+    The Ollama embeddings endpoint the KB was built with takes one input per request,
+    so a batch is sent as one concurrent round of requests, spread over the backend pool.
+    """
+    embeddings = get_embeddings()
+    return list(_EMBEDDING_POOL.map(embeddings.embed_query, texts))
@@ -2,10 +2,20 @@ from datetime import datetime, timezone
 from bson import ObjectId
 import logging
 import re
+import json
 import uuid
 import difflib
+from .llm import FINDINGS_SCHEMA
+from .stats import ScanCounters
  
 logger = logging.getLogger(__name__)
+
+# How each LLM output was parsed: as structured JSON, with the regex patterns, or not at all
+# (free text without any finding, e.g. "no vulnerabilities found"), and how streamed
+# generations ended early
+EXTRACT_COUNTERS = ScanCounters("structured", "regex", "unparsed", "streamed", "stopped_no_findings", "stopped_repeat")
+
+STRUCTURED_FIELDS = tuple(FINDINGS_SCHEMA["properties"]["findings"]["items"]["required"])
  
 # -----------------------------
 # Utilities
@@ -145,130 +155,423 @@ def extract_vulnerable_function(file_content: str, snippet: str):
         return snippet, [1, 1]
  
  
+LLM_OUTPUT_PATTERNS = [
+    re.compile(
+        r"Vulnerability:\s*(.*?)\s*\n"
+        r"CWE:\s*(.*?)\s*\n"
+        r"Severity:\s*(.*?)\s*\n"
+        r"Impact:\s*(.*?)\s*\n"
+        r"Mitigation:\s*(.*?)\s*\n"
+        r"Affected:\s*(.*?)\s*\n"
+        r"Code Snippet:\s*(.*?)\s*(?=\n\n|\nVulnerability:|\Z)",
+        re.DOTALL | re.IGNORECASE
+    ),
+    re.compile(
+        r"(?:Issue|Problem|Security Issue):\s*(.*?)\n"
+        r"(?:CWE|Type|Category):\s*(.*?)\n"
+        r"(?:Risk|Severity|Level):\s*(.*?)\n"
+        r"(?:Description|Impact|Risk Description):\s*(.*?)\n"
+        r"(?:Fix|Solution|Mitigation|Recommendation):\s*(.*?)\n"
+        r"(?:Location|File|Line|Function):\s*(.*?)\n"
+        r"(?:Code|Snippet|Example):\s*(.*?)\s*(?=\n\n|\nIssue:|\Z)",
+        re.DOTALL | re.IGNORECASE
+    )
+]
+
+
+def parse_llm_output(llm_output):
+    """Return the raw 7-field matches (title, cwe, severity, impact, mitigation, affected, snippet)."""
+    if not llm_output or not isinstance(llm_output, str):
+        return []
+    matches = []
+    for pattern in LLM_OUTPUT_PATTERNS:
+        matches.extend(match for match in pattern.findall(llm_output) if len(match) >= 7)
+    return matches
+
+def parse_structured_output(llm_output):
+    """
+    Return [(file, match)] from JSON output following llm.FINDINGS_SCHEMA, with the same
+    7-field matches as parse_llm_output (file is None unless the model named one), or
+    None when the output is not findings JSON.
+    """
+    if not llm_output or not isinstance(llm_output, str):
+        return None
+    try:
+        data = json.loads(llm_output)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("findings"), list):
+        return None
+    return [_structured_match(item) for item in data["findings"] if isinstance(item, dict)]
+
+def _structured_match(item):
+    match = tuple(str(item.get(field) or "") for field in STRUCTURED_FIELDS)
+    return str(item.get("file") or "") or None, match
+
+def parse_findings(llm_output, scan_id=None):
+    """
+    Return [(file, match)] for an LLM output: parsed as structured JSON when it is,
+    otherwise with the regex patterns (file is then always None).
+    """
+    parsed = parse_structured_output(llm_output)
+    if parsed is not None:
+        EXTRACT_COUNTERS.incr(scan_id, "structured")
+        return parsed
+    matches = parse_llm_output(llm_output)
+    if matches:
+        EXTRACT_COUNTERS.incr(scan_id, "regex")
+    elif llm_output and isinstance(llm_output, str) and llm_output.strip():
+        EXTRACT_COUNTERS.incr(scan_id, "unparsed")
+    return [(None, match) for match in matches]
+
+def get_extract_stats(scan_id):
+    return EXTRACT_COUNTERS.get(scan_id)
+
+def pop_extract_stats(scan_id):
+    return EXTRACT_COUNTERS.pop(scan_id)
+
+
+# The model stating up front that there is nothing to report
+NO_FINDINGS_PATTERN = re.compile(
+    r"\b(?:no\s+(?:\w+\s+){0,2}vulnerabilit(?:y|ies)\s+(?:(?:was|were|have\s+been)\s+)?(?:found|detected|identified)"
+    r"|does\s+not\s+(?:appear\s+to\s+)?contain\s+any\s+(?:\w+\s+)?vulnerabilit(?:y|ies))\b",
+    re.IGNORECASE
+)
+# Where a finding block (or a packed prompt's per-file section) starts
+FINDING_MARKER_PATTERN = re.compile(r"\b(?:File|Vulnerability|Issue|Problem|Security Issue):", re.IGNORECASE)
+
+def _match_key(match):
+    return clean_and_validate_field(match[0]).lower(), ' '.join(match[6].split())
+
+class FindingStream:
+    """
+    Incremental parser for a streamed LLM output. feed() takes the text as it arrives and
+    hands every finding whose block is complete to on_match(file, match), with the same
+    matches parse_findings would return. `done` turns True once the rest of the output
+    cannot add findings: the model said there are none before starting any finding,
+    closed the findings array, or started repeating a finding it already reported.
+    With `packed`, the output covers several files: "no vulnerabilities found" may be about
+    one of them only, so it does not end the stream, and only a finding repeated for the
+    same file does. Used from a single event loop.
+    """
+
+    def __init__(self, scan_id=None, on_match=None, packed=False):
+        self.scan_id = scan_id
+        self.on_match = on_match
+        self.packed = packed
+        self.text = ""
+        self.streamed = False
+        self.done = False
+        self.structured = None
+        self.matches = 0
+        self._keys = set()
+        self._pos = 0
+        self._end = None
+        # JSON scanner state
+        self._items = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._item_start = None
+
+    def feed(self, text):
+        """Add streamed text; returns True once generation can stop."""
+        self.streamed = True
+        if self.done:
+            return True
+        self.text += text
+        if self.structured is None:
+            stripped = self.text.lstrip()
+            if not stripped:
+                return False
+            self.structured = stripped.startswith("{")
+        if self.structured:
+            self._scan_json()
+        else:
+            self._scan_text(final=False)
+        return self.done
+
+    def _emit(self, file, match):
+        """
+        Report a match unless it repeats an earlier one; a repeat ends the stream. In a packed
+        output the same finding may hold for several files, so there a repeat is one for the
+        same file, and a finding whose file is unknown never counts as one.
+        """
+        key = (file, _match_key(match)) if self.packed else _match_key(match)
+        if key in self._keys and not (self.packed and file is None):
+            self.done = True
+            EXTRACT_COUNTERS.incr(self.scan_id, "stopped_repeat")
+            return False
+        self._keys.add(key)
+        self.matches += 1
+        if self.on_match:
+            self.on_match(file, match)
+        return True
+
+    def _scan_json(self):
+        # Depth 1 is the top-level object, 2 the findings array, 3 a finding
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                continue
+            if c == '"':
+                self._in_string = True
+            elif c in "{[":
+                self._depth += 1
+                if self._depth == 3 and c == "{":
+                    self._item_start = i
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 2 and c == "}" and self._item_start is not None:
+                    self._emit_item(text[self._item_start:i + 1])
+                    self._item_start = None
+                elif self._depth <= 1:
+                    if not self._items:
+                        EXTRACT_COUNTERS.incr(self.scan_id, "stopped_no_findings")
+                    self.done = True
+                if self.done:
+                    self._pos = i + 1
+                    return
+        self._pos = len(text)
+
+    def _emit_item(self, raw):
+        try:
+            item = json.loads(raw)
+        except ValueError:
+            return
+        if isinstance(item, dict):
+            file, match = _structured_match(item)
+            if self._emit(file, match):
+                self._items.append(item)
+
+    def _scan_text(self, final):
+        while not self.done:
+            # A block is complete once text follows it; at the end of the buffer it may still grow
+            best = None
+            for pattern in LLM_OUTPUT_PATTERNS:
+                m = pattern.search(self.text, self._pos)
+                if m and (final or m.end() < len(self.text)) and (best is None or m.start() < best.start()):
+                    best = m
+            if best is None:
+                break
+            file = self._section_file(best.start()) if self.packed else None
+            if not self._emit(file, best.groups()):
+                self._end = best.start()
+                return
+            self._pos = best.end()
+        if final or self.packed:
+            return
+        no_findings = NO_FINDINGS_PATTERN.search(self.text)
+        if no_findings and not FINDING_MARKER_PATTERN.search(self.text, 0, no_findings.start()):
+            self.done = True
+            EXTRACT_COUNTERS.incr(self.scan_id, "stopped_no_findings")
+
+    def _section_file(self, position):
+        """The file named by the last "File:" header before position in a packed output."""
+        file = None
+        for header in FILE_HEADER_PATTERN.finditer(self.text):
+            if header.start() >= position:
+                break
+            file = header.group(1)
+        return file
+
+    def finish(self):
+        """Parse what is left once generation ended."""
+        if not self.done and self.structured is False:
+            self._scan_text(final=True)
+        EXTRACT_COUNTERS.incr(self.scan_id, "streamed")
+
+    def count_parse_path(self):
+        """Count the output like parse_findings does, for callers that use the streamed matches."""
+        if self.structured and (self._items or self.done):
+            EXTRACT_COUNTERS.incr(self.scan_id, "structured")
+        elif self.matches:
+            EXTRACT_COUNTERS.incr(self.scan_id, "regex")
+        elif self.text.strip():
+            EXTRACT_COUNTERS.incr(self.scan_id, "unparsed")
+
+    def output(self):
+        """The output to cache: it parses into the same findings that were streamed."""
+        if self.structured:
+            return json.dumps({"findings": self._items})
+        return self.text[:self._end] if self._end is not None else self.text
+
+
+def new_finding_code():
+    return 'f-' + str(uuid.uuid4()).replace('-', '')[:8]
+
+
+def build_finding(match, file_name, scan_id, triggered_by, file_content):
+    """
+    Turn one parsed match into a finding document with accurate [start_line, end_line]
+    for where the snippet occurs in the file. Returns None for incomplete matches.
+    """
+    title = clean_and_validate_field(match[0], 200)
+    cwe = clean_and_validate_field(match[1], 100)
+    severity = clean_and_validate_field(match[2], 20).upper()
+    impact = clean_and_validate_field(match[3], 1000)
+    mitigation = clean_and_validate_field(match[4], 1000)
+    affected = clean_and_validate_field(match[5], 200)
+
+    # IMPORTANT: use raw snippet for matching to preserve formatting
+    code_snippet_raw = match[6]
+
+    if not title or not impact:
+        return None
+
+    severity_mapping = {
+        'CRITICAL': ('CRITICAL', '9.8', 'CVSS:3.1/AV:N/AC:L/PR:N/UI:N/S:U/C:H/I:H/A:H'),
+        'HIGH':     ('HIGH', '8.8', 'CVSS:3.1/AV:N/AC:L/PR:L/UI:N/S:U/C:H/I:H/A:H'),
+        'MEDIUM':   ('MEDIUM', '6.5', 'CVSS:3.1/AV:N/AC:L/PR:L/UI:N/S:U/C:L/I:L/A:L'),
+        'LOW':      ('LOW', '3.1', 'CVSS:3.1/AV:L/AC:H/PR:L/UI:R/S:U/C:L/I:N/A:N')
+    }
+
+    severity_normalized, cvss_score, cvss_vector = severity_mapping.get(
+        severity,
+        ('MEDIUM', '5.0', 'CVSS:3.1/AV:L/AC:H/PR:L/UI:N/S:U/C:L/I:L/A:N')
+    )
+
+    # Find exact snippet bounds (returns exact region + [start,end])
+    matched_region, line_numbers = extract_vulnerable_function(
+        file_content, code_snippet_raw
+    )
+    start_line, end_line = line_numbers
+
+    # Normalize/standardize CWE
+    if cwe and not cwe.upper().startswith('CWE-'):
+        if cwe.isdigit():
+            cwe = f"CWE-{cwe}"
+        elif not any(keyword in cwe.lower() for keyword in ['cwe', 'common weakness']):
+            cwe = f"CWE-{cwe}"
+
+    cwe_number_match = re.search(r'CWE-(\d+)', cwe)
+    cwe_number = cwe_number_match.group(1) if cwe_number_match else "NA"
+    reference_link = (
+        f"https://cwe.mitre.org/data/definitions/{cwe_number}.html"
+        if cwe_number != "NA" else "NA"
+    )
+
+    pocdesc = (
+        f"This proof of concept demonstrates how {title.lower()} can occur. {impact}"
+        if title and impact else
+        "No PoC description provided."
+    )
+
+    vulnerability = {
+        "scan_id": ObjectId(scan_id),
+        "cwe": cwe or "CWE-Unknown",
+        "cvss_vector": cvss_vector,
+        "cvss_score": cvss_score,
+        "code": new_finding_code(),
+        "title": title,
+        "description": pocdesc,
+        "severity": severity_normalized.lower(),
+        # Keep existing file_path format if your downstream expects it:
+        "file_path": f"{file_name} [{start_line},{end_line}]",
+        # Store exact matched region (not expanded context)
+        "code_snip": matched_region[:2000],
+        "security_risk": impact,
+        "mitigation": mitigation,
+        "status": "open",
+        "deleted": False,
+        "approved": False,
+        "reference": reference_link,
+        "created_at": datetime.now(timezone.utc),
+        "created_by": ObjectId(triggered_by),
+        # Optional: add explicit numeric lines array for your DB if you want true "array form"
+        "lines": [start_line, end_line],
+        "affected": affected
+    }
+
+    return vulnerability
+
+
 def extract_relevant_info(llm_output, file_name, scan_id, triggered_by, file_content):
     """
     Extract relevant security vulnerabilities from the LLM output and attach accurate
     [start_line, end_line] for where the snippet occurs in the file.
     """
-    if not llm_output or not isinstance(llm_output, str):
-        return []
- 
     vulnerabilities = []
- 
-    patterns = [
-        re.compile(
-            r"Vulnerability:\s*(.*?)\s*\n"
-            r"CWE:\s*(.*?)\s*\n"
-            r"Severity:\s*(.*?)\s*\n"
-            r"Impact:\s*(.*?)\s*\n"
-            r"Mitigation:\s*(.*?)\s*\n"
-            r"Affected:\s*(.*?)\s*\n"
-            r"Code Snippet:\s*(.*?)\s*(?=\n\n|\nVulnerability:|\Z)",
-            re.DOTALL | re.IGNORECASE
-        ),
-        re.compile(
-            r"(?:Issue|Problem|Security Issue):\s*(.*?)\n"
-            r"(?:CWE|Type|Category):\s*(.*?)\n"
-            r"(?:Risk|Severity|Level):\s*(.*?)\n"
-            r"(?:Description|Impact|Risk Description):\s*(.*?)\n"
-            r"(?:Fix|Solution|Mitigation|Recommendation):\s*(.*?)\n"
-            r"(?:Location|File|Line|Function):\s*(.*?)\n"
-            r"(?:Code|Snippet|Example):\s*(.*?)\s*(?=\n\n|\nIssue:|\Z)",
-            re.DOTALL | re.IGNORECASE
-        )
-    ]
- 
-    for pattern in patterns:
-        matches = pattern.findall(llm_output)
- 
-        for match in matches:
-            if len(match) < 7:
-                continue
- 
-            try:
-                title = clean_and_validate_field(match[0], 200)
-                cwe = clean_and_validate_field(match[1], 100)
-                severity = clean_and_validate_field(match[2], 20).upper()
-                impact = clean_and_validate_field(match[3], 1000)
-                mitigation = clean_and_validate_field(match[4], 1000)
-                affected = clean_and_validate_field(match[5], 200)
- 
-                # IMPORTANT: use raw snippet for matching to preserve formatting
-                code_snippet_raw = match[6]
-                # But keep a cleaned/truncated version for display/storage
-                code_snippet_clean = clean_and_validate_field(match[6], 1000)
- 
-                if not title or not impact:
-                    continue
- 
-                severity_mapping = {
-                    'CRITICAL': ('CRITICAL', '9.8', 'CVSS:3.1/AV:N/AC:L/PR:N/UI:N/S:U/C:H/I:H/A:H'),
-                    'HIGH':     ('HIGH', '8.8', 'CVSS:3.1/AV:N/AC:L/PR:L/UI:N/S:U/C:H/I:H/A:H'),
-                    'MEDIUM':   ('MEDIUM', '6.5', 'CVSS:3.1/AV:N/AC:L/PR:L/UI:N/S:U/C:L/I:L/A:L'),
-                    'LOW':      ('LOW', '3.1', 'CVSS:3.1/AV:L/AC:H/PR:L/UI:R/S:U/C:L/I:N/A:N')
-                }
- 
-                severity_normalized, cvss_score, cvss_vector = severity_mapping.get(
-                    severity,
-                    ('MEDIUM', '5.0', 'CVSS:3.1/AV:L/AC:H/PR:L/UI:N/S:U/C:L/I:L/A:N')
-                )
- 
-                # Find exact snippet bounds (returns exact region + [start,end])
-                matched_region, line_numbers = extract_vulnerable_function(
-                    file_content, code_snippet_raw
-                )
-                start_line, end_line = line_numbers
- 
-                # Normalize/standardize CWE
-                if cwe and not cwe.upper().startswith('CWE-'):
-                    if cwe.isdigit():
-                        cwe = f"CWE-{cwe}"
-                    elif not any(keyword in cwe.lower() for keyword in ['cwe', 'common weakness']):
-                        cwe = f"CWE-{cwe}"
- 
-                cwe_number_match = re.search(r'CWE-(\d+)', cwe)
-                cwe_number = cwe_number_match.group(1) if cwe_number_match else "NA"
-                reference_link = (
-                    f"https://cwe.mitre.org/data/definitions/{cwe_number}.html"
-                    if cwe_number != "NA" else "NA"
-                )
- 
-                pocdesc = (
-                    f"This proof of concept demonstrates how {title.lower()} can occur. {impact}"
-                    if title and impact else
-                    "No PoC description provided."
-                )
- 
-                vulnerability = {
-                    "scan_id": ObjectId(scan_id),
-                    "cwe": cwe or "CWE-Unknown",
-                    "cvss_vector": cvss_vector,
-                    "cvss_score": cvss_score,
-                    "code": 'f-' + str(uuid.uuid4()).replace('-', '')[:8],
-                    "title": title,
-                    "description": pocdesc,
-                    "severity": severity_normalized.lower(),
-                    # Keep existing file_path format if your downstream expects it:
-                    "file_path": f"{file_name} [{start_line},{end_line}]",
-                    # Store exact matched region (not expanded context)
-                    "code_snip": matched_region[:2000],
-                    "security_risk": impact,
-                    "mitigation": mitigation,
-                    "status": "open",
-                    "deleted": False,
-                    "approved": False,
-                    "reference": reference_link,
-                    "created_at": datetime.now(timezone.utc),
-                    "created_by": ObjectId(triggered_by),
-                    # Optional: add explicit numeric lines array for your DB if you want true "array form"
-                    "lines": [start_line, end_line],
-                    "affected": affected
-                }
- 
+    for _, match in parse_findings(llm_output, scan_id):
+        try:
+            vulnerability = build_finding(match, file_name, scan_id, triggered_by, file_content)
+            if vulnerability:
                 vulnerabilities.append(vulnerability)
- 
-            except Exception as e:
-                logging.warning(f"Error processing vulnerability match: {e}")
-                continue
- 
-    return vulnerabilities
\ No newline at end of file
+        except Exception as e:
+            logging.warning(f"Error processing vulnerability match: {e}")
+            continue
+
+    return vulnerabilities
+
+
+# A "File:" line only opens a section when a finding starts right below it; the alternative
+# output format also uses "File:" as its location field
+FILE_HEADER_PATTERN = re.compile(
+    r"^[ \t]*\**File:\**[ \t]*(.+?)[ \t]*\n(?=[ \t]*\**(?:Vulnerability|Issue|Problem|Security Issue):)",
+    re.MULTILINE | re.IGNORECASE
+)
+
+def _resolve_packed_file(reference, files):
+    """Match the file named by the LLM against the packed files (exact path, path suffix, then basename)."""
+    reference = reference.strip().strip("`'\"[]").replace("\\", "/")
+    for candidate in (
+        lambda f: f["path"] == reference,
+        lambda f: f["path"].endswith("/" + reference) or reference.endswith("/" + f["path"]),
+        lambda f: f["name"] == reference.rsplit("/", 1)[-1],
+    ):
+        matches = [f for f in files if candidate(f)]
+        if len(matches) == 1:
+            return matches[0]
+    return None
+
+def _locate_snippet_file(snippet, files):
+    """Fallback attribution: the only packed file that contains the snippet (exactly or modulo whitespace)."""
+    if not snippet or not snippet.strip():
+        return None
+    pattern = _build_whitespace_flexible_pattern(_normalize_quotes(_normalize_newlines(snippet)))
+    matches = [f for f in files if pattern.search(_normalize_quotes(_normalize_newlines(f["content"])))]
+    return matches[0] if len(matches) == 1 else None
+
+def extract_packed_info(llm_output, files, scan_id, triggered_by):
+    """
+    Extract findings from the output of a packed prompt (see prompts.create_packed_prompt)
+    and attribute each to the file it names. Returns {path: [findings]} with line ranges
+    relative to that file.
+    """
+    results = {f["path"]: [] for f in files}
+    if not llm_output or not isinstance(llm_output, str):
+        return results
+
+    parsed = parse_structured_output(llm_output)
+    if parsed is not None:
+        EXTRACT_COUNTERS.incr(scan_id, "structured")
+        findings = [(_resolve_packed_file(reference, files) if reference else None, match) for reference, match in parsed]
+    else:
+        headers = list(FILE_HEADER_PATTERN.finditer(llm_output))
+        sections = [(None, llm_output[:headers[0].start()] if headers else llm_output)]
+        for i, header in enumerate(headers):
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(llm_output)
+            sections.append((_resolve_packed_file(header.group(1), files), llm_output[header.end():end]))
+        findings = [(target, match) for target, section in sections for match in parse_llm_output(section)]
+        EXTRACT_COUNTERS.incr(scan_id, "regex" if findings else "unparsed")
+
+    for target, match in findings:
+        owner = target or _locate_snippet_file(match[6], files)
+        if not owner:
+            logger.debug(f"Could not attribute packed finding '{match[0][:80]}' to a file")
+            continue
+        try:
+            vulnerability = build_finding(match, owner["name"], scan_id, triggered_by, owner["content"])
+            if vulnerability:
+                results[owner["path"]].append(vulnerability)
+        except Exception as e:
+            logging.warning(f"Error processing vulnerability match: {e}")
+
+    return results
@@ -1,16 +1,262 @@
 import os
-import glob
+import re
+import fnmatch
+import logging
+from collections import Counter
+from .config import SCAN_MAX_FILE_BYTES, SCAN_MAX_TOTAL_BYTES, DISCOVERY_SKIPPED_PATHS_LIMIT
 
-SUPPORTED_EXTENSIONS = ["py", "js", "java", "c", "cpp", "go", "php", "rb", "ts", "jsx", "tsx", "html", "css", "cs", "kt", "kts", "scala", 
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = ["py", "js", "java", "c", "cpp", "go", "php", "rb", "ts", "jsx", "tsx", "html", "css", "cs", "kt", "kts", "scala",
                         "h", "cc", "cxx", "hpp", "hh", "hxx", "htm", "sql", "swift", "rs", "sh", "m", "dart", "r", "pl", "pm", "xml", "yaml", "yml" ]
 
+IGNORE_FILES = (".gitignore", ".codesenseignore")
+
+# Dependencies, vendored code, build output and tool caches
+DEFAULT_EXCLUDED_DIRS = {
+    ".git", ".hg", ".svn", "node_modules", "bower_components", "jspm_packages", "vendor", "third_party",
+    "third-party", "Pods", "Carthage", "dist", "build", "out", "target", "obj", ".next", ".nuxt",
+    ".output", ".svelte-kit", "coverage", ".venv", "venv", "site-packages", "__pycache__", ".tox", ".mypy_cache",
+    ".pytest_cache", ".gradle", ".idea", ".vscode",
+}
+# Bundled, minified and generated files
+DEFAULT_EXCLUDED_FILES = [
+    "*.min.js", "*.min.css", "*-min.js", "*.bundle.js", "*.chunk.js", "*.pb.go", "*_pb2.py", "*_pb2_grpc.py",
+    "*.designer.cs", "*.g.dart", "*.freezed.dart",
+]
+
+# Binary and minified detection looks at the start of each file only
+SNIFF_BYTES = 8192
+MINIFIED_MIN_BYTES = 2048
+MINIFIED_MAX_LINE_LENGTH = 2000
+MINIFIED_AVG_LINE_LENGTH = 300
+
+
+def _translate_ignore_pattern(pattern):
+    """Regex for one gitignore pattern, matched against a '/'-separated path relative to the ignore file."""
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            out.append("/.*")
+            i += 3
+            continue
+        c = pattern[i]
+        if c == "*":
+            out.append(".*" if pattern.startswith("**", i) else "[^/]*")
+            i += 2 if pattern.startswith("**", i) else 1
+            continue
+        if c == "?":
+            out.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append(f"[{body}]")
+            i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile(("" if anchored else "(?:.*/)?") + "".join(out) + "$")
+
+
+class IgnoreRules:
+    """The patterns of one .gitignore or .codesenseignore, for paths below its directory."""
+
+    def __init__(self, base, lines):
+        self.base = base
+        self.rules = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if line:
+                self.rules.append((_translate_ignore_pattern(line), negate, dir_only))
+
+    @classmethod
+    def load(cls, directory, base):
+        rules = []
+        for name in IGNORE_FILES:
+            try:
+                with open(os.path.join(directory, name), "r", encoding="utf-8", errors="ignore") as f:
+                    rules.append(cls(base, f.readlines()))
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Could not read {name} in {directory}: {e}")
+        return [r for r in rules if r.rules]
+
+    def match(self, path, is_dir):
+        """True if the last matching pattern ignores the path, False if it re-includes it, None if none match."""
+        if self.base:
+            if not path.startswith(self.base + "/"):
+                return None
+            path = path[len(self.base) + 1:]
+        result = None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                result = not negate
+        return result
+
+
+def _is_ignored(rule_sets, path, is_dir):
+    ignored = False
+    for rules in rule_sets:
+        result = rules.match(path, is_dir)
+        if result is not None:
+            ignored = result
+    return ignored
+
+
+def source_extension(name):
+    return name.rsplit(".", 1)[-1].lower() if "." in name else ""
+
+
+def is_excluded_file(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in DEFAULT_EXCLUDED_FILES)
+
+
+def sniff_file(file_path):
+    """'binary' or 'minified' from the first SNIFF_BYTES of a file, else None."""
+    with open(file_path, "rb") as f:
+        return sniff_head(f.read(SNIFF_BYTES))
+
+
+def sniff_head(head):
+    """'binary' or 'minified' from the first bytes of a file, else None."""
+    if b"\0" in head:
+        return "binary"
+    if len(head) >= MINIFIED_MIN_BYTES:
+        lines = head.split(b"\n")
+        if max(len(line) for line in lines) >= MINIFIED_MAX_LINE_LENGTH or len(head) / len(lines) >= MINIFIED_AVG_LINE_LENGTH:
+            return "minified"
+    return None
+
+
+class SourceFileWalker:
+    """
+    Single-pass discovery of the source files under a folder, iterated lazily.
+    Directories are walked with os.scandir; .gitignore and .codesenseignore files apply
+    to the directory they are in, and DEFAULT_EXCLUDED_DIRS/DEFAULT_EXCLUDED_FILES are
+    skipped outright. Binary and minified files, files over max_file_bytes and files past
+    the scan's max_total_bytes are skipped too. Symlinks are not followed.
+    stats() reports what was found and why everything else was skipped.
+    """
+
+    def __init__(self, folder_path, extensions=SUPPORTED_EXTENSIONS, max_file_bytes=SCAN_MAX_FILE_BYTES,
+                 max_total_bytes=SCAN_MAX_TOTAL_BYTES, skipped_paths_limit=DISCOVERY_SKIPPED_PATHS_LIMIT):
+        self.folder_path = folder_path
+        self.extensions = {ext.lower() for ext in extensions}
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.skipped_paths_limit = skipped_paths_limit
+        self.files = 0
+        self.bytes = 0
+        self.skipped = Counter()
+        self.skipped_paths = []
+
+    def _skip(self, path, reason, record=True):
+        self.skipped[reason] += 1
+        if record and len(self.skipped_paths) < self.skipped_paths_limit:
+            self.skipped_paths.append({"path": path, "reason": reason})
+
+    def __iter__(self):
+        stack = [(self.folder_path, "", IgnoreRules.load(self.folder_path, ""))]
+        while stack:
+            directory, relative_dir, rule_sets = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                logger.warning(f"Could not list {directory}: {e}")
+                self._skip(relative_dir, "unreadable")
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if entry.is_symlink():
+                    self._skip(path, "symlink")
+                    continue
+                if entry.is_dir():
+                    if entry.name in DEFAULT_EXCLUDED_DIRS:
+                        self._skip(path, "excluded_dir")
+                    elif _is_ignored(rule_sets, path, True):
+                        self._skip(path, "ignored")
+                    else:
+                        subdirectories.append((entry.path, path, rule_sets + IgnoreRules.load(entry.path, path)))
+                    continue
+                if not entry.is_file():
+                    continue
+
+                if source_extension(entry.name) not in self.extensions:
+                    self._skip(path, "unsupported", record=False)
+                    continue
+                if is_excluded_file(entry.name):
+                    self._skip(path, "excluded_file")
+                    continue
+                if _is_ignored(rule_sets, path, False):
+                    self._skip(path, "ignored")
+                    continue
+                try:
+                    size = entry.stat().st_size
+                    if size > self.max_file_bytes:
+                        self._skip(path, "too_large")
+                        continue
+                    if self.bytes + size > self.max_total_bytes:
+                        self._skip(path, "scan_size_cap")
+                        continue
+                    kind = sniff_file(entry.path)
+                except OSError as e:
+                    logger.warning(f"Could not read {entry.path}: {e}")
+                    self._skip(path, "unreadable")
+                    continue
+                if kind:
+                    self._skip(path, kind)
+                    continue
+
+                self.files += 1
+                self.bytes += size
+                yield entry.path
+
+            # Depth-first, in name order
+            stack.extend(reversed(subdirectories))
+
+    def read_bytes(self, file_path):
+        with open(file_path, "rb") as f:
+            return f.read()
+
+    def stats(self):
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "skipped": dict(self.skipped),
+            "skipped_paths": list(self.skipped_paths),
+        }
+
+
 def get_source_files(folder_path):
-    """Recursively collect source code files from the folder."""
-    files = []
-    for ext in SUPPORTED_EXTENSIONS:
-        pattern = os.path.join(folder_path, f"**/*.{ext}")
-        files.extend(glob.glob(pattern, recursive=True))
-    return files
+    """Collect the source code files to scan from the folder (see SourceFileWalker)."""
+    return list(SourceFileWalker(folder_path))
 
 def read_file(file_path):
     """Read content of a file, return as string."""
@@ -19,8 +265,3 @@ def read_file(file_path):
             return f.read()
     except Exception as e:
         return ""
-
-def chunk_code(code, max_lines=80):
-    """Split long files into chunks of N lines."""
-    lines = code.splitlines()
-    return ["\n".join(lines[i:i + max_lines]) for i in range(0, len(lines), max_lines)]
@@ -1,8 +1,11 @@
 import os, logging
+import hashlib
 from langchain_community.vectorstores import FAISS
 from langchain.chains import RetrievalQA
+from langchain_core.prompts import PromptTemplate
 from .config import (
     get_kb_path,
+    set_kb_version,
     set_knowledge_base,
     set_qa_chain,
     get_knowledge_base,
@@ -10,43 +13,80 @@ from .config import (
 )
 from .embeddings import get_embeddings
 from .llm import get_llm
+from .prompts import ANALYSIS_PROMPT_TEMPLATE
+from .kb_store import resolve_kb_dir, is_kb_store, read_manifest, load_index, MmapDocstore, RowIds
 
-def load_knowledge_base(kb_path: str = None):
-    if get_knowledge_base() and get_qa_chain():
-        return get_knowledge_base(), get_qa_chain()
+def compute_kb_version(kb_path: str) -> str:
+    """
+    Version id of the KB, used to invalidate cached LLM results: taken from the
+    manifest for the versioned format, a content hash of the legacy index files otherwise.
+    """
+    kb_dir = resolve_kb_dir(kb_path)
+    if is_kb_store(kb_dir):
+        return read_manifest(kb_dir)["kb_version"]
+    digest = hashlib.sha256()
+    for name in ("index.faiss", "index.pkl"):
+        with open(os.path.join(kb_dir, name), "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    return digest.hexdigest()[:16]
 
-    if not kb_path:
-        kb_path = get_kb_path()
-    if not kb_path:
-        raise ValueError("KB path not set. Provide it or use set_kb_path() before loading.")
-    
-    faiss_path = os.path.join(kb_path, "index.faiss")
-    pkl_path = os.path.join(kb_path, "index.pkl")
+def load_legacy_vector_store(kb_dir: str):
+    """Load an index.faiss / index.pkl pair written by FAISS.save_local."""
+    faiss_path = os.path.join(kb_dir, "index.faiss")
+    pkl_path = os.path.join(kb_dir, "index.pkl")
 
     if not os.path.exists(faiss_path):
         raise FileNotFoundError(f"Missing FAISS index at {faiss_path}")
     if not os.path.exists(pkl_path):
         raise FileNotFoundError(f"Missing pickle at {pkl_path}")
 
-
-    embeddings = get_embeddings()
-    kb = FAISS.load_local(
-        folder_path=kb_path,
-        embeddings=embeddings,
+    return FAISS.load_local(
+        folder_path=kb_dir,
+        embeddings=get_embeddings(),
         allow_dangerous_deserialization=True,
     )
 
+def _load_vector_store(kb_path: str):
+    kb_dir = resolve_kb_dir(kb_path)
+    if not is_kb_store(kb_dir):
+        logging.warning(f"Loading legacy pickled KB from {kb_dir}; run `manage.py convert_kb` to switch to the mmap format")
+        return load_legacy_vector_store(kb_dir)
+
+    manifest = read_manifest(kb_dir)
+    logging.info(f"Loading {manifest.get('index_type', 'flat')} KB {manifest['kb_version']} ({manifest['count']} documents) from {kb_dir}")
+    return FAISS(
+        embedding_function=get_embeddings(),
+        index=load_index(kb_dir, manifest.get("index_type", "flat")),
+        docstore=MmapDocstore(kb_dir),
+        index_to_docstore_id=RowIds(manifest["count"]),
+    )
+
+def load_knowledge_base(kb_path: str = None):
+    if get_knowledge_base() and get_qa_chain():
+        return get_knowledge_base(), get_qa_chain()
+
+    if not kb_path:
+        kb_path = get_kb_path()
+    if not kb_path:
+        raise ValueError("KB path not set. Provide it or use set_kb_path() before loading.")
+    
+    kb = _load_vector_store(kb_path)
 
     qa_chain = RetrievalQA.from_chain_type(
         llm=get_llm(),
         chain_type="stuff",
         retriever=kb.as_retriever(search_type="similarity", search_kwargs={"k": 5}),
         return_source_documents=True,
+        chain_type_kwargs={"prompt": PromptTemplate(
+            template=ANALYSIS_PROMPT_TEMPLATE, input_variables=["instructions", "context", "question"],
+        )},
         verbose=False,
     )
 
     set_knowledge_base(kb)
     set_qa_chain(qa_chain)
+    set_kb_version(compute_kb_version(kb_path))
     logging.info("Knowledge base and QA chain loaded successfully.")
 
     return kb, qa_chain
\ No newline at end of file
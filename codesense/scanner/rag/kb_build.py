@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from langchain_core.documents import Document
+from .config import KB_DOC_TOKEN_BUDGET, KB_EMBED_BATCH_SIZE, KB_EMBED_WORKERS, KB_KEEP_VERSIONS, KB_INDEX_TYPE
+from .embeddings import EMBEDDING_MODEL, get_embeddings
+from .files import read_file
+from .kb_index import build_index
+from .kb_store import (
+    is_kb_store,
+    iter_documents,
+    load_index,
+    load_vectors,
+    read_manifest,
+    resolve_kb_dir,
+    set_current,
+    write_kb_store,
+)
+from .tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+CORPUS_EXTENSIONS = {"md", "txt", "rst", "html", "htm", "xml", "json", "yaml", "yml", "csv"}
+VERSION_DIR_PREFIX = "kb-"
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def get_corpus_files(corpus_path):
+    corpus_files = []
+    for root, dirs, files in os.walk(corpus_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for file in sorted(files):
+            if file.rsplit(".", 1)[-1].lower() in CORPUS_EXTENSIONS:
+                corpus_files.append(os.path.join(root, file))
+    return corpus_files
+
+
+def split_document(text, token_budget=KB_DOC_TOKEN_BUDGET):
+    """Pack paragraphs into chunks of up to token_budget; an oversized paragraph is cut by lines."""
+    pieces = []
+    for paragraph in text.replace("\r\n", "\n").split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= token_budget:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(line for line in paragraph.split("\n") if line.strip())
+
+    chunks = []
+    current, used = [], 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if current and used + tokens > token_budget:
+            chunks.append("\n\n".join(current))
+            current, used = [], 0
+        current.append(piece)
+        used += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def load_corpus(corpus_path, token_budget=KB_DOC_TOKEN_BUDGET):
+    """Chunk every corpus file into Documents tagged with their source and content hash."""
+    documents = []
+    for file_path in get_corpus_files(corpus_path):
+        source = os.path.relpath(file_path, corpus_path).replace(os.sep, "/")
+        for i, chunk in enumerate(split_document(read_file(file_path), token_budget)):
+            documents.append(Document(page_content=chunk, metadata={
+                "source": source,
+                "chunk": i,
+                "content_hash": content_hash(chunk),
+            }))
+    return documents
+
+
+def embedding_dimension():
+    """Dimension of the vectors get_embeddings() currently produces."""
+    return len(get_embeddings().embed_documents(["dimension probe"])[0])
+
+
+def load_previous_vectors(kb_path, embedding_model=EMBEDDING_MODEL, dimension=None):
+    """
+    {content_hash: vector} for the current KB version, so unchanged documents are not re-embedded.
+    Empty when that version was embedded with another (or an unrecorded) model or dimension:
+    vectors from two embedding spaces must not end up in one index.
+    """
+    kb_dir = resolve_kb_dir(kb_path)
+    if not is_kb_store(kb_dir):
+        return {}
+
+    manifest = read_manifest(kb_dir)
+    if manifest.get("embedding_model") != embedding_model:
+        logger.info(f"KB in {kb_dir} was embedded with {manifest.get('embedding_model') or 'an unrecorded model'}, "
+                    f"not {embedding_model}; re-embedding everything")
+        return {}
+    dimension = dimension or embedding_dimension()
+    if manifest.get("dimension") != dimension:
+        logger.info(f"KB in {kb_dir} has {manifest.get('dimension')}-dimensional vectors, {embedding_model} gives {dimension}; "
+                    f"re-embedding everything")
+        return {}
+
+    vectors = load_vectors(kb_dir)
+    if vectors is None:
+        try:
+            index = load_index(kb_dir, manifest.get("index_type", "flat"))
+            vectors = index.reconstruct_n(0, index.ntotal)
+        except RuntimeError:
+            logger.warning(f"KB in {kb_dir} stores no vectors and its index cannot reconstruct them; re-embedding everything")
+            return {}
+
+    previous = {}
+    for document, vector in zip(iter_documents(kb_dir), vectors):
+        key = document.metadata.get("content_hash") or content_hash(document.page_content)
+        previous[key] = vector
+    return previous
+
+
+def embed_documents(texts, batch_size=KB_EMBED_BATCH_SIZE, workers=KB_EMBED_WORKERS):
+    """Embed texts in batches on a thread pool; returns vectors in input order."""
+    if not texts:
+        return []
+    embeddings = get_embeddings()
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    vectors = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-embed") as pool:
+        for i, batch_vectors in enumerate(pool.map(embeddings.embed_documents, batches), start=1):
+            vectors.extend(batch_vectors)
+            logger.info(f"Embedded batch {i}/{len(batches)}")
+    return vectors
+
+
+def prune_versions(kb_path, keep=KB_KEEP_VERSIONS):
+    """Delete the oldest version directories, never the current one."""
+    current = os.path.basename(resolve_kb_dir(kb_path))
+    versions = sorted(
+        (name for name in os.listdir(kb_path) if name.startswith(VERSION_DIR_PREFIX) and name != current),
+        key=lambda name: os.path.getmtime(os.path.join(kb_path, name)),
+        reverse=True,
+    )
+    for name in versions[max(0, keep - 1):]:
+        shutil.rmtree(os.path.join(kb_path, name), ignore_errors=True)
+        logger.info(f"Removed old KB version {name}")
+
+
+def build_kb(corpus_path, kb_path, full=False, batch_size=KB_EMBED_BATCH_SIZE, workers=KB_EMBED_WORKERS,
+             keep=KB_KEEP_VERSIONS, index_type=KB_INDEX_TYPE):
+    """
+    Build a new KB version from a corpus directory and make it current.
+
+    Unless `full` is set, vectors of documents whose content hash is unchanged are
+    taken from the current version, if it was embedded with the same model, and only
+    new or changed documents are embedded.
+    The version is written to a temporary directory, renamed into place and only
+    then published through CURRENT, so loaders never see a partial KB.
+    `index_type` is one of kb_index.INDEX_TYPES. Returns a summary dict.
+    """
+    started = time.monotonic()
+    documents = load_corpus(corpus_path)
+    if not documents:
+        raise ValueError(f"No corpus documents found under {corpus_path}")
+
+    previous = {} if full else load_previous_vectors(kb_path)
+    missing = {}
+    for document in documents:
+        key = document.metadata["content_hash"]
+        if key not in previous:
+            missing.setdefault(key, document.page_content)
+
+    logger.info(f"{len(documents)} KB documents, {len(documents) - len(missing)} reused, {len(missing)} to embed")
+    embedded = dict(zip(missing, embed_documents(list(missing.values()), batch_size, workers)))
+    vectors = np.vstack([
+        np.asarray(previous.get(document.metadata["content_hash"], embedded.get(document.metadata["content_hash"])), dtype="float32")
+        for document in documents
+    ])
+
+    # Index type is part of the version: approximate indexes can retrieve different documents
+    version_digest = hashlib.sha256(f"{EMBEDDING_MODEL}:{index_type}".encode())
+    for document in documents:
+        version_digest.update(f"{document.metadata['source']}:{document.metadata['content_hash']}".encode())
+    kb_version = version_digest.hexdigest()[:16]
+    version_dir_name = f"{VERSION_DIR_PREFIX}{kb_version}"
+    version_dir = os.path.join(kb_path, version_dir_name)
+
+    summary = {
+        "kb_version": kb_version,
+        "documents": len(documents),
+        "embedded": len(missing),
+        "reused": len(documents) - len(missing),
+        "index_type": index_type,
+    }
+    if resolve_kb_dir(kb_path) == version_dir and is_kb_store(version_dir):
+        summary["unchanged"] = True
+        return summary
+
+    os.makedirs(kb_path, exist_ok=True)
+    tmp_dir = os.path.join(kb_path, f".tmp-{version_dir_name}-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    write_kb_store(tmp_dir, build_index(vectors, index_type), documents, kb_version=kb_version, vectors=vectors, index_type=index_type,
+                   embedding_model=EMBEDDING_MODEL)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.replace(tmp_dir, version_dir)
+    set_current(kb_path, version_dir_name)
+    prune_versions(kb_path, keep)
+
+    summary["seconds"] = round(time.monotonic() - started, 1)
+    return summary
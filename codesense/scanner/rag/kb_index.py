@@ -0,0 +1,117 @@
+import logging
+import math
+import time
+import faiss
+import numpy as np
+from .config import (
+    KB_INDEX_TYPE,
+    KB_IVF_NLIST,
+    KB_IVF_NPROBE,
+    KB_HNSW_M,
+    KB_HNSW_EF_CONSTRUCTION,
+    KB_HNSW_EF_SEARCH,
+    KB_PQ_SUBQUANTIZERS,
+    KB_PQ_BITS,
+)
+
+logger = logging.getLogger(__name__)
+
+# flat  - exact search, full vectors
+# ivf   - inverted file over full vectors; nprobe trades recall for speed
+# hnsw  - graph index over full vectors; efSearch trades recall for speed
+# ivfpq - inverted file over product-quantized codes; a fraction of the memory
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+
+# FAISS wants roughly this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+def _nlist(count, nlist=KB_IVF_NLIST):
+    """Number of IVF lists: KB_IVF_NLIST, or 4*sqrt(n), capped by the training set size."""
+    nlist = nlist or int(4 * math.sqrt(count))
+    return max(1, min(nlist, count // MIN_POINTS_PER_CENTROID))
+
+
+def _pq_params(count, dimension, subquantizers=KB_PQ_SUBQUANTIZERS, bits=KB_PQ_BITS):
+    """Largest subquantizer count <= the configured one that divides the dimension, and bits the corpus can train."""
+    m = next(m for m in range(min(subquantizers, dimension), 0, -1) if dimension % m == 0)
+    trainable_bits = int(math.log2(max(2, count // MIN_POINTS_PER_CENTROID)))
+    return m, max(1, min(bits, trainable_bits))
+
+
+def index_factory_string(index_type, count, dimension):
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf":
+        return f"IVF{_nlist(count)},Flat"
+    if index_type == "hnsw":
+        return f"HNSW{KB_HNSW_M}"
+    if index_type == "ivfpq":
+        m, bits = _pq_params(count, dimension)
+        return f"IVF{_nlist(count)},PQ{m}x{bits}"
+    raise ValueError(f"Unknown KB index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}")
+
+
+def build_index(vectors, index_type=KB_INDEX_TYPE):
+    """Build and train an L2 index of the given type over a float32 matrix."""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    count, dimension = vectors.shape
+    description = index_factory_string(index_type, count, dimension)
+    index = faiss.index_factory(dimension, description)
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = KB_HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        logger.info(f"Training {description} index on {count} vectors")
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def apply_search_params(index, index_type, nprobe=KB_IVF_NPROBE, ef_search=KB_HNSW_EF_SEARCH):
+    """Set the recall/speed knobs of an index; a no-op for flat indexes."""
+    if index_type in ("ivf", "ivfpq"):
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    elif index_type == "hnsw":
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def index_size_bytes(index):
+    return int(faiss.serialize_index(index).size)
+
+
+def benchmark_indexes(vectors, queries, index_types=INDEX_TYPES, k=5):
+    """
+    Compare index types on a query matrix against exact search over the same vectors.
+    Returns one row per type with recall@k, per-query latency and serialized size.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        started = time.monotonic()
+        index = apply_search_params(build_index(vectors, index_type), index_type)
+        build_seconds = time.monotonic() - started
+
+        latencies = []
+        hits = 0
+        for i in range(len(queries)):
+            started = time.perf_counter()
+            _, found = index.search(queries[i:i + 1], k)
+            latencies.append(time.perf_counter() - started)
+            hits += len(set(found[0]) & set(truth[i]) - {-1})
+
+        latencies.sort()
+        rows.append({
+            "index_type": index_type,
+            "recall_at_k": round(hits / (len(queries) * k), 4) if len(queries) else 0.0,
+            "avg_ms": round(1000 * sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "p95_ms": round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 3) if latencies else 0.0,
+            "size_mb": round(index_size_bytes(index) / (1024 * 1024), 2),
+            "build_seconds": round(build_seconds, 2),
+        })
+    return rows
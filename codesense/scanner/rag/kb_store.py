@@ -0,0 +1,192 @@
+import hashlib
+import json
+import mmap
+import numbers
+import os
+import struct
+from collections.abc import Mapping
+import logging
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from .kb_index import apply_search_params
+
+logger = logging.getLogger(__name__)
+
+# On-disk KB layout (one directory per version):
+#   manifest.json  - format id, format version, KB version id, document count and index type
+#   index.faiss    - FAISS index, opened with mmap so processes share its pages
+#   docs.jsonl     - one JSON document per line, in FAISS row order
+#   docs.offsets   - little-endian uint64 byte offsets of every line in docs.jsonl, plus the end offset
+#   vectors.npy    - float32 document vectors in row order, reused by incremental builds (optional)
+# A kb_path may instead hold a CURRENT file naming the active version directory.
+KB_FORMAT = "codesense-kb"
+KB_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "index.faiss"
+DOCS_FILE = "docs.jsonl"
+OFFSETS_FILE = "docs.offsets"
+VECTORS_FILE = "vectors.npy"
+CURRENT_FILE = "CURRENT"
+
+_OFFSET = struct.Struct("<Q")
+
+
+def resolve_kb_dir(kb_path):
+    """Follow the CURRENT pointer if there is one."""
+    current = os.path.join(kb_path, CURRENT_FILE)
+    if os.path.exists(current):
+        with open(current, "r", encoding="utf-8") as f:
+            return os.path.join(kb_path, f.read().strip())
+    return kb_path
+
+
+def is_kb_store(kb_dir):
+    return os.path.exists(os.path.join(kb_dir, MANIFEST_FILE))
+
+
+def read_manifest(kb_dir):
+    with open(os.path.join(kb_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != KB_FORMAT:
+        raise ValueError(f"{kb_dir} is not a {KB_FORMAT} directory")
+    if manifest.get("format_version", 0) > KB_FORMAT_VERSION:
+        raise ValueError(f"KB format version {manifest['format_version']} is newer than supported ({KB_FORMAT_VERSION})")
+    return manifest
+
+
+class RowIds(Mapping):
+    """index_to_docstore_id for a store whose document ids are the FAISS row numbers."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def __getitem__(self, row):
+        # FAISS hands back numpy integers
+        row = int(row)
+        if not 0 <= row < self.count:
+            raise KeyError(row)
+        return row
+
+    def __iter__(self):
+        return iter(range(self.count))
+
+    def __len__(self):
+        return self.count
+
+
+class MmapDocstore:
+    """
+    Read-only docstore over docs.jsonl. Only the offsets are loaded up front; a
+    document is decoded when a retrieval hit asks for it. Matches the Docstore.search
+    contract: returns a Document, or an error string for an unknown id.
+    """
+
+    def __init__(self, kb_dir):
+        with open(os.path.join(kb_dir, OFFSETS_FILE), "rb") as f:
+            raw = f.read()
+        self._offsets = [offset for (offset,) in _OFFSET.iter_unpack(raw)]
+        self._file = open(os.path.join(kb_dir, DOCS_FILE), "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if len(self) else b""
+
+    def __len__(self):
+        return max(0, len(self._offsets) - 1)
+
+    def search(self, search):
+        if not isinstance(search, numbers.Integral) or not 0 <= search < len(self):
+            return f"ID {search} not found."
+        search = int(search)
+        record = json.loads(self._data[self._offsets[search]:self._offsets[search + 1]])
+        return Document(page_content=record["page_content"], metadata=record.get("metadata", {}))
+
+
+# Tried in order; older FAISS releases have no IO_FLAG_MMAP_IFC
+_MMAP_FLAGS = [flags for flags in (getattr(faiss, "IO_FLAG_MMAP_IFC", None), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+               if flags is not None]
+
+
+def load_index(kb_dir, index_type="flat"):
+    """
+    Open the index with mmap where FAISS supports it for the index type, and apply its search
+    parameters. IO_FLAG_MMAP_IFC maps the vectors of flat, HNSW and IVF indexes in place, so
+    workers share the page cache; IO_FLAG_MMAP only does so for IVF inverted lists and copies
+    flat codes into each process. Loaded indexes are only searched, never added to.
+    """
+    path = os.path.join(kb_dir, INDEX_FILE)
+    index = None
+    for flags in _MMAP_FLAGS:
+        try:
+            index = faiss.read_index(path, flags)
+            break
+        except RuntimeError as e:
+            logger.debug(f"Could not read {index_type} index with IO flags {flags:#x}: {e}")
+    if index is None:
+        logger.warning(f"Could not mmap {index_type} index, reading it into memory")
+        index = faiss.read_index(path)
+    return apply_search_params(index, index_type)
+
+
+def load_vectors(kb_dir):
+    """Document vectors of a version directory, or None if they were not stored."""
+    path = os.path.join(kb_dir, VECTORS_FILE)
+    return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+
+def iter_documents(kb_dir):
+    """Every document of a version directory, in row order."""
+    docstore = MmapDocstore(kb_dir)
+    for row in range(len(docstore)):
+        yield docstore.search(row)
+
+
+def write_kb_store(kb_dir, index, documents, kb_version=None, vectors=None, index_type="flat", embedding_model=None):
+    """
+    Write a KB version directory. `documents` are Documents in FAISS row order.
+    The KB version defaults to a hash of the written index and documents.
+    `embedding_model` records which model the vectors come from, when it is known.
+    """
+    os.makedirs(kb_dir, exist_ok=True)
+    faiss.write_index(index, os.path.join(kb_dir, INDEX_FILE))
+    if vectors is not None:
+        np.save(os.path.join(kb_dir, VECTORS_FILE), np.asarray(vectors, dtype="float32"))
+
+    digest = hashlib.sha256()
+    offsets = [0]
+    with open(os.path.join(kb_dir, DOCS_FILE), "wb") as f:
+        for document in documents:
+            line = json.dumps({"page_content": document.page_content, "metadata": document.metadata}, ensure_ascii=False).encode() + b"\n"
+            f.write(line)
+            digest.update(line)
+            offsets.append(offsets[-1] + len(line))
+    with open(os.path.join(kb_dir, OFFSETS_FILE), "wb") as f:
+        f.write(b"".join(_OFFSET.pack(offset) for offset in offsets))
+
+    if kb_version is None:
+        with open(os.path.join(kb_dir, INDEX_FILE), "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        kb_version = digest.hexdigest()[:16]
+
+    manifest = {
+        "format": KB_FORMAT,
+        "format_version": KB_FORMAT_VERSION,
+        "kb_version": kb_version,
+        "count": len(offsets) - 1,
+        "dimension": index.d,
+        "index_type": index_type,
+    }
+    if embedding_model:
+        manifest["embedding_model"] = embedding_model
+    with open(os.path.join(kb_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def set_current(kb_path, version_dir_name):
+    """Atomically point kb_path/CURRENT at a version directory."""
+    tmp_path = os.path.join(kb_path, f".{CURRENT_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version_dir_name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(kb_path, CURRENT_FILE))
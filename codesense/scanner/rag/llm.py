@@ -1,9 +1,123 @@
-from langchain_community.llms import Ollama
+from typing import Any, List, Optional
+from langchain_core.language_models.llms import LLM
+from .backends import get_backend_pool
+from .config import STRUCTURED_OUTPUT_ENABLED
+from .stats import ScanCounters
+
+LLM_MODEL = "codellama:13b"
+LLM_PARAMS = {
+    "temperature": 0.1,
+    "num_ctx": 4096,
+    "num_predict": 1024,
+}
+# How long Ollama keeps the model loaded after the last request. The model's KV cache goes
+# with it, so this also bounds how long an evaluated prompt prefix can be reused. Every
+# request for the model (including warm-up and embeddings) uses the same num_ctx, since a
+# different one makes Ollama reload the model.
+LLM_KEEP_ALIVE = "30m"
+
+# Per-scan generation timings (milliseconds): time to first token and total per call, and the
+# server's prompt-eval/eval split for the calls that ran to completion
+LLM_TIMING_COUNTERS = ScanCounters(
+    "calls", "first_token_ms", "total_ms",
+    "completed_calls", "prompt_eval_tokens", "prompt_eval_ms", "eval_tokens", "eval_ms", "load_ms",
+)
+
+_FINDING_FIELDS = ("vulnerability", "cwe", "severity", "impact", "mitigation", "affected", "code_snippet")
+
+# Output schema for structured generation; the fields mirror the labelled text format
+# (see prompts.py) and "file" attributes findings of packed prompts
+FINDINGS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "findings": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "file": {"type": "string"},
+                    **{field: {"type": "string"} for field in _FINDING_FIELDS},
+                    "severity": {"type": "string", "enum": ["Critical", "High", "Medium", "Low"]},
+                },
+                "required": list(_FINDING_FIELDS),
+            },
+        },
+    },
+    "required": ["findings"],
+}
+
+
+class PooledOllama(LLM):
+    """LangChain LLM that sends completions through the process-wide Ollama backend pool."""
+
+    model: str = LLM_MODEL
+    options: dict = LLM_PARAMS
+    keep_alive: Any = LLM_KEEP_ALIVE
+    # None, "json" or a JSON schema the model server constrains the output to
+    format: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled-ollama"
+
+    @property
+    def _identifying_params(self):
+        return {"model": self.model, "options": self.options, "format": self.format}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> str:
+        return get_backend_pool().generate(self.model, prompt, self.options, self.keep_alive, stop, self.format)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> str:
+        return await get_backend_pool().agenerate(self.model, prompt, self.options, self.keep_alive, stop, self.format)
+
 
 def get_llm():
-    return Ollama(
-        model="codellama:13b", 
-        temperature=0.1, 
-        num_ctx=4096,
-        num_predict=1024
-    )
+    return PooledOllama(format=FINDINGS_SCHEMA if STRUCTURED_OUTPUT_ENABLED else None)
+
+
+async def stream_completion(llm, prompt, on_text, timings=None):
+    """
+    Generate llm's completion of a prompt piece by piece, handing each piece to on_text.
+    Generation stops as soon as on_text returns True. The call's timings go into the
+    `timings` dict (see BackendPool.stream_generate).
+    """
+    pieces = get_backend_pool().astream_generate(llm.model, prompt, llm.options, llm.keep_alive, None, llm.format, timings)
+    try:
+        async for piece in pieces:
+            if on_text(piece):
+                break
+    finally:
+        await pieces.aclose()
+
+
+def record_timings(scan_id, timings):
+    """Add one call's timings (from BackendPool.generate/stream_generate) to the scan's counters."""
+    if not timings:
+        return
+    LLM_TIMING_COUNTERS.incr(scan_id, "calls")
+    LLM_TIMING_COUNTERS.incr(scan_id, "first_token_ms", int(1000 * timings.get("first_token_seconds", 0)))
+    LLM_TIMING_COUNTERS.incr(scan_id, "total_ms", int(1000 * timings.get("total_seconds", 0)))
+    if "eval_count" in timings:
+        LLM_TIMING_COUNTERS.incr(scan_id, "completed_calls")
+        LLM_TIMING_COUNTERS.incr(scan_id, "prompt_eval_tokens", timings["prompt_eval_count"])
+        LLM_TIMING_COUNTERS.incr(scan_id, "prompt_eval_ms", timings["prompt_eval_duration"] // 1_000_000)
+        LLM_TIMING_COUNTERS.incr(scan_id, "eval_tokens", timings["eval_count"])
+        LLM_TIMING_COUNTERS.incr(scan_id, "eval_ms", timings["eval_duration"] // 1_000_000)
+        LLM_TIMING_COUNTERS.incr(scan_id, "load_ms", timings["load_duration"] // 1_000_000)
+
+
+def _with_shares(counters):
+    evaluated = counters["prompt_eval_ms"] + counters["eval_ms"]
+    return {
+        **counters,
+        "prompt_eval_share": round(counters["prompt_eval_ms"] / evaluated, 3) if evaluated else None,
+        "avg_first_token_ms": round(counters["first_token_ms"] / counters["calls"]) if counters["calls"] else None,
+    }
+
+
+def get_timing_stats(scan_id):
+    return _with_shares(LLM_TIMING_COUNTERS.get(scan_id))
+
+
+def pop_timing_stats(scan_id):
+    return _with_shares(LLM_TIMING_COUNTERS.pop(scan_id))
@@ -0,0 +1,122 @@
+import os
+import hashlib
+import logging
+from bson import ObjectId
+from pymongo import DESCENDING
+from common.db import MongoDBClient
+from .progress import SCAN_COLLECTION
+from .cache import get_analysis_version
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_COLLECTION = MongoDBClient.get_database()["scan_manifests"]
+MANIFEST_INSERT_BATCH = 1000
+
+
+def relative_source_path(folder_path, file_path):
+    """Stable, OS-independent path of a file inside the scanned tree."""
+    return os.path.relpath(file_path, folder_path).replace(os.sep, "/")
+
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def build_manifest(folder_path, source_files, read_bytes=None):
+    """Map each source file's relative path to its content hash; read_bytes reads files that are not on disk."""
+    manifest = {}
+    for file_path in source_files:
+        try:
+            digest = hash_bytes(read_bytes(file_path)) if read_bytes else hash_file(file_path)
+            manifest[relative_source_path(folder_path, file_path)] = digest
+        except Exception as e:
+            logger.warning(f"Could not hash {file_path}: {e}")
+    return manifest
+
+
+def diff_manifest(previous, current):
+    """Split the current manifest into added/modified/unchanged paths against a previous one."""
+    changes = {"added": set(), "modified": set(), "unchanged": set(), "removed": set()}
+    for path, digest in current.items():
+        if path not in previous:
+            changes["added"].add(path)
+        elif previous[path] != digest:
+            changes["modified"].add(path)
+        else:
+            changes["unchanged"].add(path)
+    changes["removed"] = set(previous) - set(current)
+    return changes
+
+
+def save_manifest(scan_id, manifest, settings_key=None):
+    """
+    Store one document per file so large repos stay well under the BSON size limit.
+    settings_key (dedupe.get_settings_key) records the scan settings it was analysed with.
+    """
+    MANIFEST_COLLECTION.create_index("scan_id")
+    docs = [{"scan_id": ObjectId(scan_id), "path": path, "hash": digest} for path, digest in manifest.items()]
+    for i in range(0, len(docs), MANIFEST_INSERT_BATCH):
+        MANIFEST_COLLECTION.insert_many(docs[i:i + MANIFEST_INSERT_BATCH])
+
+    update_fields = {"manifest_files": len(manifest), "analysis_version": get_analysis_version()}
+    if settings_key:
+        update_fields["settings_key"] = settings_key
+    SCAN_COLLECTION.update_one({"_id": ObjectId(scan_id)}, {"$set": update_fields})
+
+
+def discard_manifest_paths(scan_id, paths):
+    """Forget files whose analysis failed so the next incremental scan retries them."""
+    if paths:
+        MANIFEST_COLLECTION.delete_many({"scan_id": ObjectId(scan_id), "path": {"$in": list(paths)}})
+
+
+def load_manifest(scan_id):
+    cursor = MANIFEST_COLLECTION.find({"scan_id": ObjectId(scan_id)}, {"path": 1, "hash": 1})
+    return {doc["path"]: doc["hash"] for doc in cursor}
+
+
+def find_base_scan(project_id, scan_id, settings_key):
+    """
+    Latest completed scan of the project that stored a manifest and was analysed
+    with the same model, LLM params, KB version and scan settings (triage level and
+    cascade, see dedupe.get_settings_key). Returns None if there is none.
+    """
+    return SCAN_COLLECTION.find_one(
+        {
+            "project_id": ObjectId(project_id),
+            "_id": {"$ne": ObjectId(scan_id)},
+            "status": "completed",
+            "manifest_files": {"$exists": True},
+            "analysis_version": get_analysis_version(),
+            "settings_key": settings_key,
+        },
+        sort=[("created_at", DESCENDING)],
+    )
+
+
+def find_identical_scan(project_id, archive_sha256, settings_key):
+    """
+    Latest completed scan of the project of the very same uploaded archive, analysed with
+    the same model, LLM params, KB version and scan settings, so its results hold as they are.
+    Scans in which files failed (an LLM outage, say) are partial and never reused.
+    Returns None if there is none.
+    """
+    return SCAN_COLLECTION.find_one(
+        {
+            "project_id": ObjectId(project_id),
+            "archive_sha256": archive_sha256,
+            "status": "completed",
+            "failed_files": 0,
+            "analysis_version": get_analysis_version(),
+            "settings_key": settings_key,
+        },
+        sort=[("created_at", DESCENDING)],
+    )
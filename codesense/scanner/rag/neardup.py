@@ -0,0 +1,250 @@
+import re
+import zlib
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+import numpy as np
+from bson import ObjectId
+from common.db import MongoDBClient
+from .cache import get_analysis_version
+from .config import (
+    NEAR_DUPLICATE_THRESHOLD,
+    NEAR_DUPLICATE_MIN_TOKENS,
+    NEAR_DUPLICATE_MAX_CANDIDATES,
+    NEAR_DUPLICATE_TTL_SECONDS,
+    MINHASH_PERMUTATIONS,
+    MINHASH_BANDS,
+    MINHASH_SHINGLE_SIZE,
+)
+from .dedupe import copy_finding, get_settings_key, content_fields
+from .extract import extract_vulnerable_function
+from .stats import ScanCounters
+from .triage import get_sink_patterns
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_COLLECTION = MongoDBClient.get_database()["chunk_signatures"]
+
+NEAR_DUPLICATE_COUNTERS = ScanCounters("chunks", "reused", "unlocated_findings")
+
+_TOKEN_PATTERN = re.compile(
+    r'(?P<string>"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`)'
+    r"|(?P<comment>/\*.*?\*/|//[^\n]*|#[^\n]*|<!--.*?-->)"
+    r"|(?P<word>[A-Za-z_$][\w$]*)"
+    r"|(?P<number>\d[\w.]*)"
+    r"|(?P<symbol>\S)",
+    re.DOTALL,
+)
+
+# Kept as they are, like the names of calls, attributes and keyword arguments; every other
+# identifier becomes "ID"
+KEYWORDS = {
+    "if", "else", "elif", "for", "foreach", "while", "do", "return", "def", "class", "function", "func", "fn", "sub",
+    "var", "let", "const", "import", "from", "package", "use", "require", "include", "try", "except", "catch", "finally",
+    "throw", "throws", "raise", "new", "this", "self", "public", "private", "protected", "static", "final", "void",
+    "true", "false", "null", "nil", "None", "True", "False", "and", "or", "not", "in", "is", "with", "as", "switch",
+    "case", "break", "continue", "yield", "async", "await", "lambda", "struct", "interface", "extends", "implements",
+    "echo", "global", "select", "insert", "update", "delete", "where",
+}
+DEFINITION_KEYWORDS = {"def", "function", "func", "fn", "sub", "class", "struct", "interface"}
+# Symbols (one token per character) that make the next identifier a member name
+MEMBER_ACCESS = {(".",), ("-", ">"), (":", ":")}
+# How far a statement that hits a sink is followed onto the lines below it
+SINK_STATEMENT_MAX_LINES = 20
+
+# Universal hashing (a * x + b) mod p over 32-bit shingle hashes. The seed is fixed: stored
+# signatures are compared with new ones from any process.
+_PRIME = 4294967291
+_RANDOM = np.random.RandomState(20240917)
+_A = _RANDOM.randint(1, 2 ** 31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_B = _RANDOM.randint(0, 2 ** 31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_ROWS = MINHASH_PERMUTATIONS // MINHASH_BANDS
+
+_INDEX_LOCK = threading.Lock()
+_indexes_ready = False
+
+
+def _ensure_indexes():
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _INDEX_LOCK:
+        if _indexes_ready:
+            return
+        try:
+            SIGNATURE_COLLECTION.create_index([("project_id", 1), ("version", 1), ("bands", 1)])
+            SIGNATURE_COLLECTION.create_index("last_used", expireAfterSeconds=NEAR_DUPLICATE_TTL_SECONDS)
+        except Exception as e:
+            logger.warning(f"Could not create indexes on chunk signatures: {e}")
+        _indexes_ready = True
+
+
+def normalize_tokens(code):
+    """
+    Tokens of code with comments dropped and literals and local names abstracted, so
+    copies that differ in naming, formatting, comments or license headers match.
+    Names of called functions, attributes and keyword arguments are kept: they are where
+    the security-relevant behaviour is (yaml.UnsafeLoader, .innerHTML, shell=True).
+    """
+    raw = [(m.lastgroup, m.group()) for m in _TOKEN_PATTERN.finditer(code) if m.lastgroup != "comment"]
+    tokens = []
+    depth = 0
+    for i, (kind, text) in enumerate(raw):
+        if kind == "string":
+            tokens.append("S")
+        elif kind == "number":
+            tokens.append("N")
+        elif kind == "word":
+            after = raw[i + 1][1] if i + 1 < len(raw) else None
+            called = after == "("
+            defined = i > 0 and raw[i - 1][1] in DEFINITION_KEYWORDS
+            member = any(tuple(t for _, t in raw[max(0, i - len(access)):i]) == access for access in MEMBER_ACCESS)
+            keyword_argument = depth > 0 and after == "=" and (i + 2 >= len(raw) or raw[i + 2][1] != "=")
+            kept = text in KEYWORDS or (called and not defined) or member or keyword_argument
+            tokens.append(text if kept else "ID")
+        else:
+            if text == "(":
+                depth += 1
+            elif text == ")":
+                depth = max(0, depth - 1)
+            tokens.append(text)
+    return tokens
+
+
+def sink_fingerprint(code, file_extension):
+    """
+    Hash of the normalized statements of code that hit a triage sink pattern. Chunks only
+    reuse each other's findings when these match exactly: a similar chunk whose sink calls
+    differ in an argument, loader or attribute is analysed on its own.
+    """
+    patterns = list(get_sink_patterns(file_extension).values())
+    lines = code.split("\n")
+    hits = set()
+    for i, line in enumerate(lines):
+        if not any(pattern.search(line) for pattern in patterns):
+            continue
+        # Follow the statement until its parentheses close, so arguments on later lines count
+        tokens = normalize_tokens(line)
+        end = i + 1
+        while tokens.count("(") > tokens.count(")") and end < min(len(lines), i + SINK_STATEMENT_MAX_LINES):
+            tokens += normalize_tokens(lines[end])
+            end += 1
+        hits.add(" ".join(tokens))
+    return hashlib.blake2b("\n".join(sorted(hits)).encode(), digest_size=16).hexdigest()
+
+
+def minhash_signature(code, file_extension):
+    """
+    (MinHash signature, LSH band keys, sink fingerprint) of a chunk, or None when it is too
+    short to compare.
+    """
+    tokens = normalize_tokens(code)
+    if len(tokens) < max(NEAR_DUPLICATE_MIN_TOKENS, MINHASH_SHINGLE_SIZE):
+        return None
+    shingles = {" ".join(tokens[i:i + MINHASH_SHINGLE_SIZE]) for i in range(len(tokens) - MINHASH_SHINGLE_SIZE + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    signature = ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0)
+    bands = [f"{band}:{hashlib.blake2b(signature[band * _ROWS:(band + 1) * _ROWS].tobytes(), digest_size=8).hexdigest()}"
+             for band in range(MINHASH_BANDS)]
+    return signature, bands, sink_fingerprint(code, file_extension)
+
+
+class NearDuplicateIndex:
+    """
+    A project's persisted MinHash/LSH index of analysed chunks and their findings.
+    Chunks are only compared with chunks analysed with the same model, KB, language
+    and scan settings, with the same sink statements, and from another source path: an
+    edited file never reuses the result of its own previous version. Methods block; call
+    them through asyncio.to_thread.
+    """
+
+    def __init__(self, project_id, triage_level, cascade, threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.project_id = ObjectId(project_id)
+        self.settings_key = get_settings_key(triage_level, cascade)
+        self.threshold = threshold
+
+    def _version(self, file_extension):
+        return f"{get_analysis_version()}:{file_extension}:{self.settings_key}"
+
+    def find(self, signature, file_extension, scan_id=None, source_path=None):
+        """Findings of the most similar analysed chunk at or above the threshold, else None."""
+        _ensure_indexes()
+        values, bands, sinks = signature
+        NEAR_DUPLICATE_COUNTERS.incr(scan_id, "chunks")
+        query = {"project_id": self.project_id, "version": self._version(file_extension), "bands": {"$in": bands}, "sinks": sinks}
+        if source_path:
+            query["source_path"] = {"$ne": source_path}
+        try:
+            # Candidates sharing the most bands first: for a common chunk the true near-duplicate
+            # is then compared even when many looser matches share a band or two
+            candidates = list(SIGNATURE_COLLECTION.aggregate([
+                {"$match": query},
+                {"$project": {"signature": 1, "findings": 1, "last_used": 1, "shared": {"$size": {"$setIntersection": ["$bands", bands]}}}},
+                {"$sort": {"shared": -1, "last_used": -1}},
+                {"$limit": NEAR_DUPLICATE_MAX_CANDIDATES},
+            ]))
+        except Exception as e:
+            logger.warning(f"Near-duplicate lookup failed: {e}")
+            return None
+        best, best_similarity = None, 0.0
+        for candidate in candidates:
+            similarity = float(np.mean(np.asarray(candidate["signature"], dtype=np.uint64) == values))
+            if similarity > best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is None or best_similarity < self.threshold:
+            return None
+        try:
+            SIGNATURE_COLLECTION.update_one({"_id": best["_id"]}, {"$set": {"last_used": datetime.now(timezone.utc)}})
+        except Exception as e:
+            logger.warning(f"Near-duplicate touch failed: {e}")
+        NEAR_DUPLICATE_COUNTERS.incr(scan_id, "reused")
+        return best["findings"]
+
+    def add(self, signature, file_extension, findings, source_path=None):
+        _ensure_indexes()
+        values, bands, sinks = signature
+        now = datetime.now(timezone.utc)
+        try:
+            SIGNATURE_COLLECTION.insert_one({
+                "project_id": self.project_id,
+                "version": self._version(file_extension),
+                "bands": bands,
+                "signature": [int(value) for value in values],
+                "sinks": sinks,
+                "source_path": source_path,
+                "findings": [content_fields(finding) for finding in findings],
+                "created_at": now,
+                "last_used": now,
+            })
+        except Exception as e:
+            logger.warning(f"Near-duplicate write failed: {e}")
+
+
+def relocate_findings(findings, file_name, file_content, scan_id, triggered_by):
+    """
+    Findings of a similar chunk for this file, with each snippet re-located in file_content.
+    Findings whose snippet cannot be found in the file are dropped.
+    """
+    relocated = []
+    for finding in findings:
+        snippet = finding.get("code_snip", "")
+        matched_region, lines = extract_vulnerable_function(file_content, snippet)
+        if lines == [1, 1] and snippet not in file_content:
+            NEAR_DUPLICATE_COUNTERS.incr(scan_id, "unlocated_findings")
+            continue
+        relocated.append(copy_finding({**finding, "code_snip": matched_region[:2000], "lines": lines}, file_name, scan_id, triggered_by))
+    return relocated
+
+
+def _with_reuse_rate(stats):
+    stats["reuse_rate"] = round(stats["reused"] / stats["chunks"], 3) if stats["chunks"] else 0.0
+    return stats
+
+
+def get_near_duplicate_stats(scan_id):
+    return _with_reuse_rate(NEAR_DUPLICATE_COUNTERS.get(scan_id))
+
+
+def pop_near_duplicate_stats(scan_id):
+    return _with_reuse_rate(NEAR_DUPLICATE_COUNTERS.pop(scan_id))
@@ -0,0 +1,46 @@
+from .tokens import count_tokens
+from .llm import LLM_PARAMS
+from .config import PACK_FILE_MAX_TOKENS, PACKED_PROMPT_RESERVE_TOKENS
+
+# Code tokens available in one packed prompt: the context window minus the completion
+# budget and room for the instruction preamble and retrieved KB documents
+PACKED_PROMPT_TOKEN_BUDGET = LLM_PARAMS["num_ctx"] - LLM_PARAMS["num_predict"] - PACKED_PROMPT_RESERVE_TOKENS
+# Per-file delimiter header and code fence
+FILE_OVERHEAD_TOKENS = 24
+
+
+class PromptPacker:
+    """
+    Buffers small files per language and hands back batches that fit one packed prompt.
+    Used from a single event loop, so no locking is needed.
+    """
+
+    def __init__(self, token_budget=PACKED_PROMPT_TOKEN_BUDGET, max_file_tokens=PACK_FILE_MAX_TOKENS):
+        self.token_budget = token_budget
+        self.max_file_tokens = max_file_tokens
+        self._buffers = {}
+
+    def accepts(self, content):
+        """Return the file's token cost if it is small enough to pack, else None."""
+        tokens = count_tokens(content) + FILE_OVERHEAD_TOKENS
+        return tokens if tokens <= self.max_file_tokens else None
+
+    def add(self, entry):
+        """
+        Buffer a file entry (dict with path, name, extension, content, tokens).
+        Returns the batches that are full and ready to be analysed.
+        """
+        ready = []
+        files, used = self._buffers.get(entry["extension"], ([], 0))
+        if files and used + entry["tokens"] > self.token_budget:
+            ready.append(files)
+            files, used = [], 0
+        files.append(entry)
+        self._buffers[entry["extension"]] = (files, used + entry["tokens"])
+        return ready
+
+    def drain(self):
+        """Return every partially filled batch."""
+        batches = [files for files, _ in self._buffers.values() if files]
+        self._buffers.clear()
+        return batches
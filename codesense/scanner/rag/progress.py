@@ -4,8 +4,14 @@ from common.db import MongoDBClient
 
 SCAN_COLLECTION = MongoDBClient.get_database()["scans"]
 
-def update_progress(scan_id, scanned=None, total=None, status=None, end_time=None, findings=None, error=None):
-    """Update scan progress in MongoDB scan document."""
+def update_progress(scan_id, scanned=None, total=None, status=None, end_time=None, findings=None, error=None, metrics=None,
+                    failed_files=None):
+    """Update scan progress in MongoDB scan document.
+
+    `metrics` is a dict of named scan statistics, each stored under `metrics.<name>`.
+    `failed_files` counts the files that could not be analysed; a completed scan with any
+    is partial.
+    """
     update_fields = {"last_updated": datetime.now(timezone.utc)}
 
     if scanned is not None:
@@ -20,6 +26,11 @@ def update_progress(scan_id, scanned=None, total=None, status=None, end_time=Non
         update_fields["findings"] = findings
     if error is not None:
         update_fields["error"] = error
+    if failed_files is not None:
+        update_fields["failed_files"] = failed_files
+    if metrics:
+        for name, value in metrics.items():
+            update_fields[f"metrics.{name}"] = value
 
     SCAN_COLLECTION.update_one(
         {"_id": ObjectId(scan_id)},
@@ -1,98 +1,151 @@
+import functools
+from .config import STRUCTURED_OUTPUT_ENABLED
+
+# File-specific vulnerability patterns
+VULNERABILITY_FOCUS = {
+    'php': [
+        'SQL Injection via unsanitized database queries',
+        'Cross-Site Scripting (XSS) in output',
+        'File inclusion vulnerabilities',
+        'Authentication bypass',
+        'Session management issues',
+        'Command injection',
+        'Path traversal'
+    ],
+    'js': [
+        'Cross-Site Scripting (XSS)',
+        'Prototype pollution',
+        'Code injection via eval()',
+        'DOM-based XSS',
+        'Insecure API calls',
+        'Client-side validation bypass'
+    ],
+    'py': [
+        'SQL Injection',
+        'Command injection',
+        'Path traversal',
+        'Insecure deserialization',
+        'Code injection via exec/eval',
+        'LDAP injection',
+        'Template injection'
+    ],
+    'java': [
+        'SQL Injection',
+        'XML External Entity (XXE)',
+        'Insecure deserialization',
+        'Path traversal',
+        'LDAP injection',
+        'Expression Language injection'
+    ],
+    'c': [
+        'Buffer overflow',
+        'Use after free',
+        'Format string vulnerabilities',
+        'Integer overflow',
+        'Null pointer dereference',
+        'Race conditions'
+    ],
+    'cpp': [
+        'Buffer overflow',
+        'Use after free',
+        'Memory corruption',
+        'Integer overflow',
+        'Double free',
+        'Stack overflow'
+    ]
+}
+
+DEFAULT_FOCUS = [
+    'Injection vulnerabilities',
+    'Authentication issues',
+    'Authorization bypass',
+    'Input validation problems',
+    'Output encoding issues'
+]
+
+def get_focus_areas(file_extension):
+    return VULNERABILITY_FOCUS.get(file_extension, DEFAULT_FOCUS)
+
+# Layout of every analysis prompt (the QA chain's prompt, see kb.py): the per-language
+# instructions first, then the KB context, then the code. The instructions are identical for
+# every call of a language and the precomputed KB context for every chunk with the same sink
+# signature, so consecutive prompts share a long prefix the model server evaluates only once.
+ANALYSIS_PROMPT_TEMPLATE = """{instructions}
+
+Security reference material:
+{context}
+
+{question}"""
+
+TEXT_OUTPUT_FORMAT = """For each vulnerability found, use this EXACT format:
+
+{file_line}Vulnerability: [Specific vulnerability name]
+CWE: [CWE-XXX format with description]
+Severity: [Critical/Medium/Low/High]
+Impact: [Detailed explanation of security impact and potential exploitation]
+Mitigation: [Specific technical steps to fix the vulnerability]
+Affected: [Function/method name and exact line numbers]
+Code Snippet: [The exact vulnerable code lines]"""
+
+# With structured output the schema carries the format, so the instructions only name the fields
+STRUCTURED_OUTPUT_FORMAT = """Answer in JSON as {{"findings": [...]}}, with an empty list when the code has no vulnerabilities.
+Per finding: vulnerability (specific name), cwe (CWE-XXX), severity (Critical/High/Medium/Low),
+impact (security impact and exploitation), mitigation (technical fix), affected (function/method
+and line numbers), code_snippet (the exact vulnerable code lines){file_field}."""
+
+@functools.lru_cache(maxsize=None)
+def get_instructions(file_extension, packed=False, structured=STRUCTURED_OUTPUT_ENABLED):
+    """
+    The fixed instruction prefix for a language. Nothing file- or chunk-specific may go
+    in here, or consecutive prompts stop sharing their prefix.
+    """
+    language = file_extension.upper()
+    focus_text = '\n'.join(f"- {area}" for area in get_focus_areas(file_extension))
+    if structured:
+        output_format = STRUCTURED_OUTPUT_FORMAT.format(
+            file_field=", file (path exactly as written in its header)" if packed else ""
+        )
+    else:
+        output_format = TEXT_OUTPUT_FORMAT.format(
+            file_line="File: [Path of the file exactly as written in its header]\n" if packed else ""
+        )
+    packed_text = (
+        "\nThe code consists of separate files, each starting with a \"===== FILE: <path> =====\" header. "
+        "Analyze each file on its own and always name the file the vulnerability is in."
+        if packed else ""
+    )
+
+    return f"""You are a security expert analyzing {language} code for vulnerabilities.{packed_text}
+
+FOCUS AREAS for {language}:
+{focus_text}
+
+IMPORTANT INSTRUCTIONS:
+1. Only report ACTUAL security vulnerabilities with clear exploitation potential, not code quality issues
+2. Be specific about the vulnerability type and impact
+3. Provide concrete mitigation steps
+
+{output_format}"""
+
 def create_enhanced_prompt(chunk, file_name, file_extension):
-    """Create an enhanced prompt tailored to the file type."""
-    
-    # File-specific vulnerability patterns
-    vulnerability_focus = {
-        'php': [
-            'SQL Injection via unsanitized database queries',
-            'Cross-Site Scripting (XSS) in output',
-            'File inclusion vulnerabilities',
-            'Authentication bypass',
-            'Session management issues',
-            'Command injection',
-            'Path traversal'
-        ],
-        'js': [
-            'Cross-Site Scripting (XSS)',
-            'Prototype pollution',
-            'Code injection via eval()',
-            'DOM-based XSS',
-            'Insecure API calls',
-            'Client-side validation bypass'
-        ],
-        'py': [
-            'SQL Injection',
-            'Command injection',
-            'Path traversal',
-            'Insecure deserialization',
-            'Code injection via exec/eval',
-            'LDAP injection',
-            'Template injection'
-        ],
-        'java': [
-            'SQL Injection',
-            'XML External Entity (XXE)',
-            'Insecure deserialization',
-            'Path traversal',
-            'LDAP injection',
-            'Expression Language injection'
-        ],
-        'c': [
-            'Buffer overflow',
-            'Use after free',
-            'Format string vulnerabilities',
-            'Integer overflow',
-            'Null pointer dereference',
-            'Race conditions'
-        ],
-        'cpp': [
-            'Buffer overflow',
-            'Use after free',
-            'Memory corruption',
-            'Integer overflow',
-            'Double free',
-            'Stack overflow'
-        ]
-    }
-    
-    focus_areas = vulnerability_focus.get(file_extension, [
-        'Injection vulnerabilities',
-        'Authentication issues',
-        'Authorization bypass',
-        'Input validation problems',
-        'Output encoding issues'
-    ])
-    
-    focus_text = '\n'.join([f"- {area}" for area in focus_areas])
-    
-    return f"""
-        You are a security expert analyzing {file_extension.upper()} code for vulnerabilities.
-
-        FOCUS AREAS for {file_extension.upper()}:
-        {focus_text}
-
-        IMPORTANT INSTRUCTIONS:
-        1. Only report ACTUAL security vulnerabilities, not code quality issues
-        2. Be specific about the vulnerability type and impact
-        3. Provide concrete mitigation steps
-        4. Use the exact format specified below
-
-        For each vulnerability found, use this EXACT format:
-
-        Vulnerability: [Specific vulnerability name]
-        CWE: [CWE-XXX format with description]
-        Severity: [Critical/Medium/Low/High]
-        Impact: [Detailed explanation of security impact and potential exploitation]
-        Mitigation: [Specific technical steps to fix the vulnerability]
-        Affected: [Function/method name and exact line numbers]
-        Code Snippet: [The exact vulnerable code lines]
-
-        ANALYZE THIS CODE:
-        ```{file_extension}
-        {chunk}
-        ```
-
-        File: {file_name}
-
-        Remember: Only report actual security vulnerabilities with clear exploitation potential.
-        """
+    """
+    Create an enhanced prompt tailored to the file type, as (instructions, code):
+    the language's fixed prefix and the variable part naming the file and its code.
+    """
+    return get_instructions(file_extension), f"""ANALYZE THIS CODE from {file_name}:
+```{file_extension}
+{chunk}
+```"""
+
+def create_packed_prompt(files, file_extension):
+    """
+    Create one prompt covering several small files of the same language, as
+    (instructions, code). Each file is delimited by a header carrying its path, and
+    every finding must name the file it was found in so it can be attributed back.
+    """
+    code_text = '\n\n'.join(
+        f"===== FILE: {f['path']} =====\n```{file_extension}\n{f['content']}\n```"
+        for f in files
+    )
+    return get_instructions(file_extension, packed=True), f"""ANALYZE THESE {len(files)} FILES:
+{code_text}"""
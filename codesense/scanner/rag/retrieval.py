@@ -0,0 +1,293 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import numpy as np
+from .config import (
+    get_knowledge_base,
+    get_embedding_cache_path,
+    RETRIEVAL_MODE,
+    RETRIEVAL_REFINE_BY_SINKS,
+    RETRIEVAL_TOP_K,
+    RETRIEVAL_BATCH_SIZE,
+    RETRIEVAL_BATCH_WAIT_SECONDS,
+)
+from .embeddings import EMBEDDING_MODEL, embed_queries
+from .prompts import get_focus_areas
+from .stats import ScanCounters
+from .triage import get_sink_patterns, score_chunk
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_COUNTERS = ScanCounters("queries", "batches", "embedding_cache_hits", "embedded", "context_reuses")
+
+# KB queries for the sink categories triage reports (see triage.py)
+SINK_CATEGORY_QUERIES = {
+    "sql": "SQL injection through queries built from untrusted input",
+    "code_exec": "Code injection through eval, exec or dynamic code evaluation",
+    "command": "OS command injection through shell or process execution",
+    "file_io": "Path traversal and unsafe file access or file inclusion",
+    "deserialization": "Insecure deserialization of untrusted data",
+    "templating": "Cross-site scripting and template injection in rendered output",
+    "crypto": "Weak cryptography, insecure randomness and disabled certificate validation",
+    "network": "Server-side request forgery, XML external entities and insecure transport",
+    "auth": "Broken authentication, session management and access control",
+    "prototype": "Prototype pollution through unsafe object merging",
+    "xml": "XML external entity injection in XML parsers",
+    "memory": "Buffer overflow, use after free and memory corruption",
+    "format": "Format string vulnerabilities",
+    "input": "Unchecked input length and untrusted input handling",
+    "config": "Insecure configuration, privileged containers and debug settings",
+    "secrets": "Hard-coded credentials, API keys and private keys",
+}
+
+
+class EmbeddingCache:
+    """
+    Query embeddings on local disk, keyed by embedding model + content hash. The file
+    defaults to get_embedding_cache_path(), resolved on first use.
+    """
+
+    def __init__(self, path=None, model=EMBEDDING_MODEL):
+        self.path = path
+        self.model = model
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self.path = self.path or get_embedding_cache_path()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        return self._conn
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model}:{text}".encode()).hexdigest()
+
+    def get_many(self, keys):
+        """Return {key: vector} for the keys that are cached."""
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype="float32")
+        return found
+
+    def put_many(self, items):
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype="float32").tobytes()) for key, vector in items],
+            )
+            conn.commit()
+
+
+EMBEDDING_CACHE = EmbeddingCache()
+
+
+def embed_texts(texts, scan_id=None):
+    """
+    Embed texts as retrieval queries, reading and filling the disk cache.
+    Duplicate texts are embedded once. Returns a float32 matrix with one row per text.
+    """
+    keys = [EMBEDDING_CACHE.key(text) for text in texts]
+    try:
+        vectors = EMBEDDING_CACHE.get_many(list(set(keys)))
+    except sqlite3.Error as e:
+        logger.warning(f"Embedding cache lookup failed: {e}")
+        vectors = {}
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors:
+            missing.setdefault(key, text)
+    RETRIEVAL_COUNTERS.incr(scan_id, "embedding_cache_hits", len(set(keys)) - len(missing))
+    RETRIEVAL_COUNTERS.incr(scan_id, "embedded", len(missing))
+
+    if missing:
+        embedded = dict(zip(missing, embed_queries(list(missing.values()))))
+        vectors.update(embedded)
+        try:
+            EMBEDDING_CACHE.put_many(embedded.items())
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+
+    return np.vstack([np.asarray(vectors[key], dtype="float32") for key in keys])
+
+
+def retrieve_documents(texts, k=RETRIEVAL_TOP_K, scan_id=None):
+    """
+    Return the top-k (document, L2 distance) pairs for every text, with one batched
+    FAISS search over the matrix of query vectors. Mirrors FAISS.similarity_search_with_score_by_vector.
+    """
+    kb = get_knowledge_base()
+    if kb is None:
+        raise RuntimeError("Knowledge base not initialized. Call load_knowledge_base() first.")
+
+    matrix = embed_texts(texts, scan_id)
+    if getattr(kb, "_normalize_L2", False):
+        import faiss
+        faiss.normalize_L2(matrix)
+    distances, indices = kb.index.search(matrix, k)
+
+    results = []
+    for row_distances, row in zip(distances, indices):
+        documents = []
+        for distance, i in zip(row_distances, row):
+            if i == -1:
+                continue
+            document = kb.docstore.search(kb.index_to_docstore_id[i])
+            if not isinstance(document, str):
+                documents.append((document, float(distance)))
+        results.append(documents)
+    return results
+
+
+def _merge(document_lists, k):
+    """Round-robin over ranked (document, distance) lists, dropping duplicates, up to k documents."""
+    merged = []
+    seen = set()
+    for rank in range(max((len(documents) for documents in document_lists), default=0)):
+        for documents in document_lists:
+            if rank < len(documents) and documents[rank][0].page_content not in seen:
+                seen.add(documents[rank][0].page_content)
+                merged.append(documents[rank])
+                if len(merged) == k:
+                    return merged
+    return merged
+
+
+class PrecomputedContext:
+    """
+    KB context retrieved once per scan and reused by every chunk of a language: the
+    top documents for each of the language's vulnerability focus areas, optionally
+    refined with those for the sink categories triage finds in the chunk. Chunks with
+    the same language and sink signature get identical context, so the prompt prefix
+    stays stable. Used from a single event loop.
+    """
+
+    def __init__(self, scan_id, k=RETRIEVAL_TOP_K, refine=RETRIEVAL_REFINE_BY_SINKS):
+        self.scan_id = scan_id
+        self.k = k
+        self.refine = refine
+        self._contexts = {}
+        self._signatures = {}
+        self._lock = asyncio.Lock()
+
+    async def precompute(self, file_extensions):
+        """Retrieve the context of every given language with one batched search."""
+        queries = []
+        for file_extension in sorted(set(file_extensions) - set(self._contexts)):
+            for area in get_focus_areas(file_extension):
+                queries.append((file_extension, "focus", area))
+            for category in list(get_sink_patterns(file_extension)) + ["secrets"]:
+                queries.append((file_extension, "sinks", category))
+        if not queries:
+            return
+
+        texts = [SINK_CATEGORY_QUERIES.get(key, key) if kind == "sinks" else key for _, kind, key in queries]
+        RETRIEVAL_COUNTERS.incr(self.scan_id, "queries", len(texts))
+        RETRIEVAL_COUNTERS.incr(self.scan_id, "batches")
+        results = await asyncio.to_thread(retrieve_documents, texts, self.k, self.scan_id)
+
+        for (file_extension, kind, key), documents in zip(queries, results):
+            context = self._contexts.setdefault(file_extension, {"focus": [], "sinks": {}})
+            if kind == "focus":
+                context["focus"].append(documents)
+            else:
+                context["sinks"][key] = documents
+
+    async def retrieve(self, text, file_extension=None):
+        file_extension = file_extension or ""
+        if file_extension not in self._contexts:
+            async with self._lock:
+                await self.precompute([file_extension])
+        RETRIEVAL_COUNTERS.incr(self.scan_id, "context_reuses")
+
+        categories = ()
+        if self.refine:
+            _, found = score_chunk(text, file_extension)
+            categories = tuple(sorted(found))
+        signature = (file_extension, categories)
+        if signature not in self._signatures:
+            context = self._contexts[file_extension]
+            sink_lists = [context["sinks"][category] for category in categories if category in context["sinks"]]
+            self._signatures[signature] = _merge(sink_lists + context["focus"], self.k)
+        return self._signatures[signature]
+
+
+class RetrievalBatcher:
+    """
+    Collects retrieval queries from the coroutines of one scan and resolves them in
+    batches: a batch is flushed when it is full or RETRIEVAL_BATCH_WAIT_SECONDS after
+    its first query. Used from a single event loop, so no locking is needed.
+    """
+
+    def __init__(self, scan_id, k=RETRIEVAL_TOP_K, batch_size=RETRIEVAL_BATCH_SIZE, max_wait=RETRIEVAL_BATCH_WAIT_SECONDS):
+        self.scan_id = scan_id
+        self.k = k
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def retrieve(self, text, file_extension=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        texts = [text for text, _ in batch]
+        RETRIEVAL_COUNTERS.incr(self.scan_id, "queries", len(texts))
+        RETRIEVAL_COUNTERS.incr(self.scan_id, "batches")
+        try:
+            results = await asyncio.to_thread(retrieve_documents, texts, self.k, self.scan_id)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), documents in zip(batch, results):
+            if not future.done():
+                future.set_result(documents)
+
+
+def get_retriever(scan_id, mode=RETRIEVAL_MODE):
+    """The scan's retriever for RETRIEVAL_MODE: PrecomputedContext or RetrievalBatcher."""
+    if mode == "precomputed":
+        return PrecomputedContext(scan_id)
+    return RetrievalBatcher(scan_id)
+
+
+def get_retrieval_stats(scan_id):
+    return RETRIEVAL_COUNTERS.get(scan_id)
+
+
+def pop_retrieval_stats(scan_id):
+    return RETRIEVAL_COUNTERS.pop(scan_id)
@@ -1,60 +1,288 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import asyncio
 from .kb import load_knowledge_base
-from .files import get_source_files
-from .analysis import scan_single_file
-from .database import save_findings_to_db
+from .files import SourceFileWalker
+from .analysis import scan_file, scan_packed_files, AnalysisError
+from .packing import PromptPacker
+from .database import FindingWriter, carry_forward_findings
+from .manifest import build_manifest, hash_bytes, diff_manifest, save_manifest, load_manifest, discard_manifest_paths, find_base_scan, relative_source_path
 from .progress import update_progress, display_progress
-from .config import (set_kb_path)
+from .cache import get_cache_stats, pop_cache_stats
+from .scheduler import get_scheduler, PRIORITY_CLASSES, PRIORITY_BACKGROUND
+from .triage import triage_chunk, get_triage_stats, pop_triage_stats
+from .retrieval import get_retriever, get_retrieval_stats, pop_retrieval_stats
+from .context import get_token_stats, pop_token_stats
+from .cascade import resolve_cascade_settings, get_cascade_stats, pop_cascade_stats
+from .extract import get_extract_stats, pop_extract_stats
+from .llm import get_timing_stats, pop_timing_stats
+from .backends import closing_clients
+from .neardup import NearDuplicateIndex, get_near_duplicate_stats, pop_near_duplicate_stats
+from .dedupe import (content_key, copy_finding, get_settings_key, get_content_analysis, store_content_analysis,
+                     DEDUPE_COUNTERS, get_dedupe_stats, pop_dedupe_stats)
+from .config import (set_kb_path, SCAN_FILE_CONCURRENCY, SCAN_LLM_CONCURRENCY, TRIAGE_AGGRESSIVENESS, CONTENT_DEDUPE_ENABLED,
+                     NEAR_DUPLICATE_ENABLED)
 from datetime import datetime, timezone
 import traceback
 import logging
 logger = logging.getLogger(__name__)
 
-def scan_folder(folder_path, kb_path, scan_id, triggered_by, scan_name):
+def resolve_scan_settings(project_id=None, triage_level=None, cascade=None):
+    """(triage level, cascade settings) a scan runs with, given its per-scan overrides."""
+    return triage_level or TRIAGE_AGGRESSIVENESS, resolve_cascade_settings(project_id, cascade)
+
+def scan_folder(folder_path, kb_path, scan_id, triggered_by, scan_name, project_id=None, scan_mode="full", priority="bulk",
+                triage_level=None, cascade=None, source=None):
+    """
+    Scan every supported file under folder_path. `source` is the SourceArchive of an
+    uploaded archive, whose path is then folder_path; its files are read from the
+    archive in place.
+
+    With scan_mode="incremental", only files added or modified since the project's
+    previous completed scan are analysed; findings for unchanged files are carried forward.
+    `priority` ("interactive" or "bulk") is the scheduler class for this scan's LLM calls.
+    `triage_level` overrides TRIAGE_AGGRESSIVENESS for this scan, and `cascade` (True/False)
+    the project's model-cascade setting.
+    """
+    triage_level, cascade = resolve_scan_settings(project_id, triage_level, cascade)
+    settings_key = get_settings_key(triage_level, cascade)
     set_kb_path(kb_path)
     _, _ = load_knowledge_base(kb_path)
-    source_files = get_source_files(folder_path)
-    total_files = len(source_files)
+    discovery = source or SourceFileWalker(folder_path)
+    source_files = list(discovery)
+    logging.info(f"Discovered {discovery.files} source files ({discovery.bytes} bytes), skipped {dict(discovery.skipped)}")
     if not source_files:
         logging.warning(f"No source code files found in {folder_path}")
-        update_progress(scan_id=scan_id, total=0, scanned=0, status="completed", end_time=datetime.now(timezone.utc))
+        update_progress(scan_id=scan_id, total=0, scanned=0, status="completed", end_time=datetime.now(timezone.utc),
+                        failed_files=0, metrics={"discovery": discovery.stats()})
         return []
 
-    
-    update_progress(scan_id=scan_id, total=total_files, scanned=0, status="in_progress")
+    carried_findings = []
+    # Full scans hash each file as it is read for analysis instead of in a pass of their own
+    file_hashes = {}
+    base_scan = find_base_scan(project_id, scan_id, settings_key) if scan_mode == "incremental" and project_id else None
+    if base_scan:
+        manifest = build_manifest(folder_path, source_files, discovery.read_bytes)
+        save_manifest(scan_id, manifest, settings_key)
+        changes = diff_manifest(load_manifest(base_scan["_id"]), manifest)
+        changed_paths = changes["added"] | changes["modified"]
+        source_files = [path for path in source_files if relative_source_path(folder_path, path) in changed_paths]
+        if hasattr(discovery, "restrict"):
+            discovery.restrict(source_files)
+        carried_findings = carry_forward_findings(base_scan["_id"], scan_id, changes["unchanged"])
+        update_progress(scan_id=scan_id, metrics={"incremental": {
+            "base_scan_id": str(base_scan["_id"]),
+            **{name: len(paths) for name, paths in changes.items()},
+            "carried_findings": len(carried_findings),
+        }})
+        logging.info(f"Incremental scan against {base_scan['_id']}: {len(changed_paths)} changed, "
+                     f"{len(changes['unchanged'])} unchanged, {len(carried_findings)} findings carried forward")
+    elif scan_mode == "incremental":
+        logging.info("No compatible previous scan found, falling back to a full scan")
+
+    total_files = len(source_files)
+    update_progress(scan_id=scan_id, total=total_files, scanned=0, status="in_progress", metrics={"discovery": discovery.stats()})
 
     logging.info(f"Starting parallel scan of {total_files} files for project: {scan_name or 'Unknown'}")
 
-    all_findings = []
+    all_findings = list(carried_findings)
+    near_duplicates = NearDuplicateIndex(project_id, triage_level, cascade) if NEAR_DUPLICATE_ENABLED and project_id else None
+    failed_files = asyncio.run(closing_clients(_scan_files(folder_path, discovery, source_files, scan_id, triggered_by, all_findings,
+                                                           PRIORITY_CLASSES[priority], triage_level, cascade, file_hashes, near_duplicates)))
+    if not base_scan:
+        failed = set(failed_files)
+        save_manifest(scan_id, {relative_source_path(folder_path, path): digest
+                                for path, digest in file_hashes.items() if path not in failed}, settings_key)
+
+    finding_count = len(all_findings)
+    update_progress(scan_id, findings=finding_count, status="completed", end_time=datetime.now(timezone.utc),
+                    failed_files=len(failed_files), metrics={
+        "llm_cache": pop_cache_stats(scan_id),
+        "llm_scheduler": get_scheduler().pop_scan_stats(scan_id),
+        "triage": pop_triage_stats(scan_id, triage_level),
+        "retrieval": pop_retrieval_stats(scan_id),
+        "tokens": pop_token_stats(scan_id),
+        "cascade": pop_cascade_stats(scan_id, cascade),
+        "output_parsing": pop_extract_stats(scan_id),
+        "llm_timings": pop_timing_stats(scan_id),
+        "dedupe": pop_dedupe_stats(scan_id),
+        "near_duplicates": pop_near_duplicate_stats(scan_id),
+    })
+    logging.info(f"Scan completed! Found {finding_count} total vulnerabilities across {total_files} files")
+    if failed_files:
+        logging.warning(f"{len(failed_files)} files failed during scan.")
+        discard_manifest_paths(scan_id, [relative_source_path(folder_path, path) for path in failed_files])
+
+    return all_findings
+
+
+async def _scan_files(folder_path, discovery, source_files, scan_id, triggered_by, all_findings, priority, triage_level, cascade, file_hashes,
+                      near_duplicates=None):
+    """
+    Drive every file of a scan on one event loop. A fixed pool of worker coroutines
+    pulls files from a shared iterator and reads them through `discovery`, adding their
+    content hashes to file_hashes; LLM calls are bounded by a per-scan semaphore
+    and KB context for all of them comes from one retriever, precomputed at scan start
+    for every language in the scan when RETRIEVAL_MODE is "precomputed".
+    Small files are buffered per language and analysed together in packed prompts.
+    Findings are saved in the background as they are extracted, streamed ones before
+    their file is done. Files with the same normalized content are analysed once and
+    the others get copies of its findings; an analysis stored by an earlier scan with the
+    same model, KB and settings is reused without calling the LLM. Chunks close to ones
+    analysed before in the project reuse their findings through `near_duplicates`.
+    Returns the files that failed, including those whose LLM or retrieval calls failed;
+    they are left out of the scan's manifest so the next incremental scan retries them.
+    """
+    llm_semaphore = asyncio.Semaphore(SCAN_LLM_CONCURRENCY)
+    retriever = get_retriever(scan_id)
+    if hasattr(retriever, "precompute"):
+        await retriever.precompute({os.path.splitext(path)[1][1:].lower() for path in source_files})
+    packer = PromptPacker()
+    pending = iter(source_files)
     failed_files = []
     completed_files = 0
+    packing_stats = {"packed_prompts": 0, "packed_files": 0}
+    writer = FindingWriter()
+    settings_key = get_settings_key(triage_level, cascade)
+    # Content dedupe: file -> content key, key -> the file analysed for it,
+    # key -> (findings, failed) once that file is done, key -> files waiting for it
+    content_keys = {}
+    content_owners = {}
+    content_results = {}
+    content_waiting = {}
+
+    def stream_to(file_path, streamed):
+        source_path = relative_source_path(folder_path, file_path)
+
+        def on_finding(finding):
+            finding["source_path"] = source_path
+            streamed.append(finding)
+            writer.add([finding])
+        return on_finding
 
+    async def record(file_path, findings, failed=False, streamed=(), reused=False):
+        nonlocal completed_files
+        if failed:
+            failed_files.append(file_path)
+        # Streamed findings are already saved, even when the file failed afterwards
+        returned = {id(finding) for finding in findings}
+        findings = list(findings) + [finding for finding in streamed if id(finding) not in returned]
+        for finding in findings:
+            finding["source_path"] = relative_source_path(folder_path, file_path)
+        if findings:
+            writer.add(findings)
+            all_findings.extend(findings)
+        completed_files += 1
+        await asyncio.to_thread(update_progress, scan_id=scan_id, findings=len(all_findings), scanned=completed_files, metrics={
+            "llm_cache": get_cache_stats(scan_id),
+            "llm_scheduler": get_scheduler().get_scan_stats(scan_id),
+            "packing": packing_stats,
+            "triage": get_triage_stats(scan_id, triage_level),
+            "retrieval": get_retrieval_stats(scan_id),
+            "tokens": get_token_stats(scan_id),
+            "cascade": get_cascade_stats(scan_id, cascade),
+            "output_parsing": get_extract_stats(scan_id),
+            "llm_timings": get_timing_stats(scan_id),
+            "dedupe": get_dedupe_stats(scan_id),
+            "near_duplicates": get_near_duplicate_stats(scan_id),
+        })
+        await asyncio.to_thread(display_progress, scan_id=scan_id)
 
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = {
-            executor.submit(scan_single_file, path, scan_id, triggered_by): path
-            for path in source_files
-        }
+        key = content_keys.get(file_path)
+        if key and content_owners.get(key) == file_path:
+            content_results[key] = (findings, failed)
+            # A failed analysis (an LLM outage, say) is not a clean file: never store it
+            if not failed and not reused:
+                await asyncio.to_thread(store_content_analysis, key, findings)
+            for duplicate in content_waiting.pop(key, []):
+                await record_duplicate(duplicate, key)
+
+    async def record_duplicate(file_path, key):
+        findings, failed = content_results[key]
+        file_name = os.path.basename(file_path)
+        await record(file_path, [copy_finding(finding, file_name, scan_id, triggered_by) for finding in findings], failed=failed)
+
+    async def run_batch(batch):
+        if len(batch) == 1:
+            # Already triaged as a whole file before packing
+            entry = batch[0]
+            entry_priority = PRIORITY_BACKGROUND if entry["triage"] == "deprioritize" else priority
+            streamed = []
+            try:
+                findings = await scan_file(entry["file_path"], scan_id, triggered_by, llm_semaphore, priority=entry_priority,
+                                           file_content=entry["content"], triage_level="off", retriever=retriever, cascade=cascade,
+                                           on_finding=stream_to(entry["file_path"], streamed), near_duplicates=near_duplicates,
+                                           source_path=entry["path"])
+            except AnalysisError as e:
+                logging.error(f"Analysis of {entry['file_path']} failed: {e}")
+                await record(entry["file_path"], e.findings, failed=True, streamed=streamed)
+                return
+            await record(entry["file_path"], findings, streamed=streamed)
+            return
+        try:
+            results = await scan_packed_files(batch, scan_id, triggered_by, llm_semaphore, priority=priority, retriever=retriever, cascade=cascade)
+            packing_stats["packed_prompts"] += 1
+            packing_stats["packed_files"] += len(batch)
+        except Exception as e:
+            logging.error(f"Error processing packed batch: {e}\n{traceback.format_exc()}")
+            results = None
+        for entry in batch:
+            await record(entry["file_path"], results.get(entry["path"], []) if results else [], failed=results is None)
 
-        for index, future in enumerate(as_completed(futures)):
-            file_path = futures[future]
+    async def worker():
+        for file_path in pending:
+            streamed = []
             try:
-                findings = future.result()
-                if findings:
-                    save_findings_to_db(findings)
-                    all_findings.extend(findings)
+                data = await asyncio.to_thread(discovery.read_bytes, file_path)
+                file_hashes[file_path] = hash_bytes(data)
+                content = data.decode("utf-8", errors="ignore")
+                file_name = os.path.basename(file_path)
+                file_extension = os.path.splitext(file_name)[1][1:].lower()
+                if CONTENT_DEDUPE_ENABLED:
+                    key = content_keys[file_path] = content_key(content, file_extension, settings_key)
+                    if key in content_owners:
+                        DEDUPE_COUNTERS.incr(scan_id, "duplicate_files")
+                        if key in content_results:
+                            await record_duplicate(file_path, key)
+                        else:
+                            content_waiting.setdefault(key, []).append(file_path)
+                        continue
+                    content_owners[key] = file_path
+                    stored = await asyncio.to_thread(get_content_analysis, key, scan_id)
+                    if stored is not None:
+                        await record(file_path, [copy_finding(finding, file_name, scan_id, triggered_by) for finding in stored], reused=True)
+                        continue
+                    DEDUPE_COUNTERS.incr(scan_id, "unique_files")
+                tokens = packer.accepts(content) if len(content.strip()) >= 50 else None
+                if tokens:
+                    decision = triage_chunk(content, file_extension, triage_level, scan_id)
+                    if decision == "skip":
+                        await record(file_path, [])
+                        continue
+                    entry = {
+                        "file_path": file_path,
+                        "path": relative_source_path(folder_path, file_path),
+                        "name": file_name,
+                        "extension": file_extension,
+                        "content": content,
+                        "tokens": tokens,
+                        "triage": decision,
+                    }
+                    for batch in packer.add(entry):
+                        await run_batch(batch)
+                    continue
+                findings = await scan_file(file_path, scan_id, triggered_by, llm_semaphore, priority=priority,
+                                           file_content=content, triage_level=triage_level, retriever=retriever, cascade=cascade,
+                                           on_finding=stream_to(file_path, streamed), near_duplicates=near_duplicates,
+                                           source_path=relative_source_path(folder_path, file_path))
+                await record(file_path, findings, streamed=streamed)
+            except AnalysisError as e:
+                logging.error(f"Analysis of {file_path} failed: {e}")
+                await record(file_path, e.findings, failed=True, streamed=streamed)
             except Exception as e:
-                failed_files.append(file_path)
                 logging.error(f"Error processing file {file_path}: {e}\n{traceback.format_exc()}")
-            finally:
-                completed_files += 1
-                update_progress(scan_id=scan_id, findings=len(all_findings), scanned=completed_files)
-                display_progress(scan_id=scan_id)
+                await record(file_path, [], failed=True, streamed=streamed)
 
-    finding_count = len(all_findings)
-    update_progress(scan_id, findings=finding_count, status="completed", end_time=datetime.now(timezone.utc))
-    logging.info(f"Scan completed! Found {finding_count} total vulnerabilities across {total_files} files")
-    if failed_files:
-        logging.warning(f"{len(failed_files)} files failed during scan.")
-
-    return all_findings
+    await asyncio.gather(*(worker() for _ in range(SCAN_FILE_CONCURRENCY)))
+    await asyncio.gather(*(run_batch(batch) for batch in packer.drain()))
+    await writer.flush()
+    return failed_files
@@ -0,0 +1,211 @@
+import asyncio
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from .concurrency import AIMDController
+from .config import (
+    LLM_MAX_IN_FLIGHT,
+    LLM_MIN_IN_FLIGHT,
+    LLM_MAX_IN_FLIGHT_CEILING,
+    CONCURRENCY_ADAPTIVE,
+    get_llm_hosts,
+)
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# Work that triage found no signal in; served only when nothing else is waiting
+PRIORITY_BACKGROUND = 2
+PRIORITY_CLASSES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "bulk": PRIORITY_BULK,
+    "background": PRIORITY_BACKGROUND,
+}
+
+def _empty_stats():
+    return {
+        "queue_depth": 0,
+        "in_flight": 0,
+        "calls": 0,
+        "total_wait_seconds": 0.0,
+        "max_wait_seconds": 0.0,
+    }
+
+
+class LLMScheduler:
+    """
+    Process-wide admission control for LLM calls.
+
+    Scans run on their own event loops (one per scan thread), so waiters are
+    (loop, future) pairs and slots are handed over with call_soon_threadsafe.
+    Slots go to the highest priority class first, round-robin across scans
+    within a class. Requests are rate limited per host by the backend pool, once
+    it has picked the host a call goes to (see backends.TokenBucket).
+    With `adaptive`, an AIMDController tunes the number of slots while scans run.
+    """
+
+    def __init__(self, max_in_flight=None, adaptive=CONCURRENCY_ADAPTIVE):
+        hosts = len(get_llm_hosts())
+        # LLM_MAX_IN_FLIGHT slots for every backend host by default
+        self.max_in_flight = max_in_flight or LLM_MAX_IN_FLIGHT * hosts
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # priority -> OrderedDict(scan_id -> deque of waiters); order of scans is the round-robin order
+        self._queues = {}
+        self._stats = {}
+        self._started = {}
+        self.controller = AIMDController(self, LLM_MIN_IN_FLIGHT * hosts, LLM_MAX_IN_FLIGHT_CEILING * hosts) if adaptive else None
+
+    def _scan_stats(self, scan_id):
+        if scan_id not in self._stats:
+            self._started[scan_id] = datetime.now(timezone.utc)
+        return self._stats.setdefault(scan_id, _empty_stats())
+
+    def _has_waiters(self):
+        return any(self._queues.values())
+
+    def _next_waiter(self):
+        for priority in sorted(self._queues):
+            scans = self._queues[priority]
+            if not scans:
+                continue
+            scan_id, waiters = next(iter(scans.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                scans.move_to_end(scan_id)
+            else:
+                del scans[scan_id]
+            return scan_id, waiter
+        return None
+
+    def _remove_waiter(self, priority, scan_id, waiter):
+        waiters = self._queues.get(priority, {}).get(scan_id)
+        if not waiters or waiter not in waiters:
+            return False
+        waiters.remove(waiter)
+        if not waiters:
+            del self._queues[priority][scan_id]
+        return True
+
+    def _grant(self, scan_id, future):
+        # Runs on the waiter's loop; a waiter cancelled in the meantime passes the slot on
+        if future.done():
+            self.release(scan_id)
+        else:
+            future.set_result(None)
+
+    async def acquire(self, scan_id, priority=PRIORITY_BULK):
+        if self.controller:
+            self.controller.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        enqueued_at = time.monotonic()
+
+        with self._lock:
+            stats = self._scan_stats(scan_id)
+            if self._in_flight < self.max_in_flight and not self._has_waiters():
+                self._in_flight += 1
+                future.set_result(None)
+            else:
+                stats["queue_depth"] += 1
+                self._queues.setdefault(priority, OrderedDict()).setdefault(scan_id, deque()).append(waiter)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                removed = self._remove_waiter(priority, scan_id, waiter)
+                if removed:
+                    stats["queue_depth"] -= 1
+            if not removed and future.done() and not future.cancelled():
+                self.release(scan_id)
+            raise
+
+        waited = time.monotonic() - enqueued_at
+        with self._lock:
+            stats["in_flight"] += 1
+            stats["calls"] += 1
+            stats["total_wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+    def _take_waiters(self):
+        """Waiters that get the free slots; called with the lock held."""
+        granted = []
+        while self._in_flight < self.max_in_flight:
+            following = self._next_waiter()
+            if not following:
+                break
+            self._in_flight += 1
+            self._scan_stats(following[0])["queue_depth"] -= 1
+            granted.append(following)
+        return granted
+
+    def _hand_over(self, granted):
+        for next_scan_id, (loop, future) in granted:
+            try:
+                loop.call_soon_threadsafe(self._grant, next_scan_id, future)
+            except RuntimeError:
+                # The waiter's loop has already closed; hand the slot to the next one
+                self.release(next_scan_id)
+
+    def release(self, scan_id):
+        with self._lock:
+            if scan_id in self._stats and self._stats[scan_id]["in_flight"] > 0:
+                self._stats[scan_id]["in_flight"] -= 1
+            self._in_flight -= 1
+            granted = self._take_waiters()
+        self._hand_over(granted)
+
+    def set_max_in_flight(self, limit):
+        """Change the number of slots. Calls already in flight above a lower limit finish normally."""
+        with self._lock:
+            self.max_in_flight = limit
+            granted = self._take_waiters()
+        self._hand_over(granted)
+
+    def load(self):
+        """(calls in flight, calls waiting for a slot)."""
+        with self._lock:
+            waiting = sum(len(waiters) for scans in self._queues.values() for waiters in scans.values())
+            return self._in_flight, waiting
+
+    @asynccontextmanager
+    async def slot(self, scan_id, priority=PRIORITY_BULK):
+        await self.acquire(scan_id, priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if self.controller:
+                self.controller.observe(time.monotonic() - started)
+            self.release(scan_id)
+
+    def get_scan_stats(self, scan_id):
+        with self._lock:
+            stats = dict(self._stats.get(scan_id) or _empty_stats())
+        stats["avg_wait_seconds"] = round(stats["total_wait_seconds"] / stats["calls"], 3) if stats["calls"] else 0.0
+        stats["total_wait_seconds"] = round(stats["total_wait_seconds"], 3)
+        stats["max_wait_seconds"] = round(stats["max_wait_seconds"], 3)
+        if self.controller:
+            stats["concurrency"] = self.controller.get_stats(since=self._started.get(scan_id))
+        else:
+            stats["concurrency"] = {"limit": self.max_in_flight}
+        return stats
+
+    def pop_scan_stats(self, scan_id):
+        stats = self.get_scan_stats(scan_id)
+        with self._lock:
+            self._stats.pop(scan_id, None)
+            self._started.pop(scan_id, None)
+        return stats
+
+
+SCHEDULER = LLMScheduler()
+
+def get_scheduler():
+    return SCHEDULER
@@ -0,0 +1,25 @@
+import threading
+
+
+class ScanCounters:
+    """Thread-safe named counters kept per scan until the scan reports them."""
+
+    def __init__(self, *names):
+        self.names = names
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def incr(self, scan_id, name, amount=1):
+        if not scan_id:
+            return
+        with self._lock:
+            counters = self._counters.setdefault(scan_id, dict.fromkeys(self.names, 0))
+            counters[name] = counters.get(name, 0) + amount
+
+    def get(self, scan_id):
+        with self._lock:
+            return dict(self._counters.get(scan_id) or dict.fromkeys(self.names, 0))
+
+    def pop(self, scan_id):
+        with self._lock:
+            return self._counters.pop(scan_id, None) or dict.fromkeys(self.names, 0)
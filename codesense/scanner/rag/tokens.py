@@ -0,0 +1,22 @@
+import re
+
+# Approximates codellama's SentencePiece tokenizer closely enough for budgeting:
+# words split into ~4-character pieces, every digit and symbol is its own token,
+# a single space merges into the following word and longer indentation costs extra.
+_PIECE_PATTERN = re.compile(r"[A-Za-z_]+|\d|\n|[ \t]+|[^\sA-Za-z_\d]")
+
+
+def count_tokens(text: str) -> int:
+    """Estimate the number of LLM tokens in text."""
+    total = 0
+    for match in _PIECE_PATTERN.finditer(text):
+        piece = match.group()
+        first = piece[0]
+        if first == " " or first == "\t":
+            if len(piece) > 1:
+                total += (len(piece) + 3) // 4
+        elif first.isalpha() or first == "_":
+            total += (len(piece) + 3) // 4
+        else:
+            total += 1
+    return total
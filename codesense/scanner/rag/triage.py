@@ -0,0 +1,173 @@
+import re
+from .stats import ScanCounters
+
+# Aggressiveness levels:
+#   off    - every chunk is analysed
+#   low    - chunks without any signal are analysed last (background scheduler class)
+#   medium - chunks without any signal are skipped
+#   high   - chunks without a sink are skipped (a source on its own is not enough)
+TRIAGE_LEVELS = ("off", "low", "medium", "high")
+
+SINK_WEIGHT = 2
+SOURCE_WEIGHT = 1
+
+# Sink categories per language, keyed like prompts.VULNERABILITY_FOCUS
+SINK_PATTERNS = {
+    "py": {
+        "sql": [r"\.execute(?:many)?\s*\(", r"\.raw\s*\(", r"\bextra\s*\(", r"text\s*\(\s*f?[\"']"],
+        "code_exec": [r"\beval\s*\(", r"\bexec\s*\(", r"\bcompile\s*\(", r"__import__\s*\("],
+        "command": [r"\bsubprocess\.", r"\bos\.(?:system|popen|exec\w*|spawn\w*)\s*\(", r"\bcommands\.", r"\bpty\.spawn"],
+        "file_io": [r"\bopen\s*\(", r"\bsend_file\s*\(", r"\bshutil\.", r"\bos\.(?:remove|unlink|rename)\s*\(", r"\bextractall\s*\("],
+        "deserialization": [r"\bpickle\.", r"\bcPickle\.", r"\bmarshal\.loads?", r"\byaml\.(?:unsafe_)?load\s*\(", r"\bjsonpickle\.", r"\bshelve\.open"],
+        "templating": [r"render_template_string\s*\(", r"\bTemplate\s*\(", r"\bmark_safe\s*\(", r"\|\s*safe\b", r"autoescape\s*=\s*False"],
+        "crypto": [r"\bhashlib\.(?:md5|sha1)\b", r"\bDES\b", r"\bECB\b", r"\brandom\.(?:random|randint|choice)\s*\(", r"verify\s*=\s*False"],
+        "network": [r"\brequests\.(?:get|post|put|request)\s*\(", r"\burlopen\s*\(", r"\bsocket\.", r"\bldap\.", r"\bxml\.etree", r"\blxml\."],
+        "auth": [r"\bcsrf_exempt\b", r"\bAllowAny\b", r"\bjwt\.decode\s*\(", r"\bset_cookie\s*\(", r"\bsession\["],
+    },
+    "js": {
+        "sql": [r"\.query\s*\(", r"\.raw\s*\(", r"\bsequelize\.query", r"\.execute\s*\("],
+        "code_exec": [r"\beval\s*\(", r"\bnew\s+Function\s*\(", r"\bset(?:Timeout|Interval)\s*\(\s*[\"'`]", r"\bvm\.run"],
+        "command": [r"\bchild_process\b", r"\bexec(?:Sync)?\s*\(", r"\bspawn(?:Sync)?\s*\("],
+        "file_io": [r"\bfs\.\w+", r"\bres\.sendFile\s*\(", r"\bpath\.join\s*\("],
+        "deserialization": [r"\bunserialize\s*\(", r"\bnode-serialize\b", r"\bJSON\.parse\s*\("],
+        "templating": [r"\.innerHTML\s*=", r"\.outerHTML\s*=", r"\bdocument\.write\s*\(", r"dangerouslySetInnerHTML", r"\bv-html\b", r"\$\(\s*[^)]*\)\.html\s*\("],
+        "crypto": [r"\bMath\.random\s*\(", r"createHash\s*\(\s*[\"'](?:md5|sha1)", r"\bcreateCipher\s*\("],
+        "network": [r"\bfetch\s*\(", r"\baxios\.", r"\bXMLHttpRequest\b", r"\bpostMessage\s*\(", r"\blocation\.(?:href|assign|replace)"],
+        "prototype": [r"__proto__", r"\bconstructor\s*\[", r"\bObject\.assign\s*\(", r"\bmerge\s*\("],
+        "auth": [r"\bjwt\.(?:sign|verify|decode)\s*\(", r"\blocalStorage\.", r"\bdocument\.cookie\b", r"\bcors\s*\("],
+    },
+    "php": {
+        "sql": [r"\bmysqli?_query\s*\(", r"->query\s*\(", r"->exec\s*\(", r"\bpg_query\s*\("],
+        "code_exec": [r"\beval\s*\(", r"\bassert\s*\(", r"\bcreate_function\s*\(", r"\bpreg_replace\s*\(.*/e"],
+        "command": [r"\b(?:system|exec|shell_exec|passthru|popen|proc_open)\s*\(", r"`[^`]*\$"],
+        "file_io": [r"\b(?:include|require)(?:_once)?\b", r"\bfile_(?:get|put)_contents\s*\(", r"\bfopen\s*\(", r"\bmove_uploaded_file\s*\(", r"\bunlink\s*\("],
+        "deserialization": [r"\bunserialize\s*\(", r"\bphar://"],
+        "templating": [r"\becho\b", r"\bprint\b", r"<\?=", r"\bprintf\s*\("],
+        "crypto": [r"\bmd5\s*\(", r"\bsha1\s*\(", r"\brand\s*\(", r"\bmt_rand\s*\("],
+        "auth": [r"\$_SESSION\b", r"\bsetcookie\s*\(", r"\bsession_id\s*\(", r"\bheader\s*\(\s*[\"']Location"],
+    },
+    "java": {
+        "sql": [r"\bcreateStatement\s*\(", r"\.execute(?:Query|Update)?\s*\(", r"\bcreate(?:Native)?Query\s*\(", r"\bprepareStatement\s*\(\s*\w+\s*\+"],
+        "code_exec": [r"\bScriptEngine\b", r"\bExpressionFactory\b", r"\bSpelExpressionParser\b", r"\bClass\.forName\s*\(", r"\.getMethod\s*\("],
+        "command": [r"\bRuntime\.getRuntime\s*\(\s*\)\.exec", r"\bProcessBuilder\b"],
+        "file_io": [r"\bnew\s+File(?:InputStream|OutputStream|Reader|Writer)?\s*\(", r"\bFiles\.\w+\s*\(", r"\bPaths\.get\s*\("],
+        "deserialization": [r"\bObjectInputStream\b", r"\.readObject\s*\(", r"\bXMLDecoder\b", r"\bXStream\b", r"\benableDefaultTyping\b"],
+        "xml": [r"\bDocumentBuilderFactory\b", r"\bSAXParserFactory\b", r"\bXMLInputFactory\b", r"\bTransformerFactory\b"],
+        "templating": [r"\bgetWriter\s*\(\s*\)\.(?:print|write)", r"\bVelocity\b", r"\bFreemarker\b"],
+        "crypto": [r"\bMessageDigest\.getInstance\s*\(\s*\"(?:MD5|SHA-?1)\"", r"\bCipher\.getInstance\s*\(\s*\"(?:DES|[^\"]*ECB)", r"\bnew\s+Random\s*\(", r"\bTrustAllCerts\b|\bX509TrustManager\b"],
+        "network": [r"\bnew\s+URL\s*\(", r"\bHttpURLConnection\b", r"\bRestTemplate\b", r"\bInitialDirContext\b|\bDirContext\.search"],
+    },
+    "c": {
+        "memory": [r"\b(?:strcpy|strcat|sprintf|vsprintf|gets|memcpy|memmove|strncpy|alloca)\s*\(", r"\b(?:malloc|calloc|realloc|free)\s*\("],
+        "format": [r"\b(?:printf|fprintf|syslog|snprintf)\s*\(\s*[a-zA-Z_]\w*\s*[,)]"],
+        "command": [r"\b(?:system|popen|execl|execlp|execv|execvp)\s*\("],
+        "file_io": [r"\bfopen\s*\(", r"\bopen\s*\(", r"\b(?:tmpnam|mktemp)\s*\("],
+        "input": [r"\bscanf\s*\(", r"\bread\s*\(", r"\brecv\s*\("],
+        "crypto": [r"\brand\s*\(", r"\bsrand\s*\("],
+    },
+    "cpp": {
+        "memory": [r"\b(?:strcpy|strcat|sprintf|vsprintf|gets|memcpy|memmove|strncpy|alloca)\s*\(", r"\bnew\s+\w+\s*\[", r"\bdelete\b", r"\breinterpret_cast\b"],
+        "format": [r"\b(?:printf|fprintf|syslog|snprintf)\s*\(\s*[a-zA-Z_]\w*\s*[,)]"],
+        "command": [r"\b(?:system|popen|execl|execlp|execv|execvp)\s*\("],
+        "file_io": [r"\bfopen\s*\(", r"\bstd::[io]?fstream\b"],
+        "input": [r"\bscanf\s*\(", r"\brecv\s*\(", r"\bstd::cin\b"],
+        "crypto": [r"\brand\s*\(", r"\bsrand\s*\("],
+    },
+}
+
+# Used for every extension without a language-specific set
+GENERIC_SINK_PATTERNS = {
+    "sql": [r"\b(?:SELECT|INSERT|UPDATE|DELETE)\b[^;\n]*(?:\+|\$\{|%s|\{\w+\}|\|\|)", r"\bEXEC(?:UTE)?\s+(?:IMMEDIATE|sp_executesql)\b", r"\bGRANT\s+ALL\b"],
+    "code_exec": [r"\beval\b", r"\bexec\s*\(", r"\binstance_eval\b", r"\bsend\s*\(\s*params"],
+    "command": [r"\bsystem\s*\(", r"\bpopen\s*\(", r"\bProcess(?:Builder)?\b", r"`[^`]*\$\{?\w+", r"\bos/exec\b|\bexec\.Command\s*\("],
+    "file_io": [r"\bopen\s*\(", r"\bFile\.\w+\s*\(", r"\bos\.(?:Open|Create|ReadFile)\s*\(", r"\bioutil\.\w+\s*\("],
+    "deserialization": [r"\bMarshal\.load\b", r"\bYAML\.load\b", r"\bBinaryFormatter\b", r"\bunserialize\s*\(", r"!!python/"],
+    "templating": [r"\.innerHTML\s*=", r"\bhtml_safe\b", r"\braw\s*\(", r"\btemplate\.HTML\s*\(", r"<script\b", r"\bon\w+\s*=\s*[\"']", r"\bexpression\s*\("],
+    "crypto": [r"\b(?:md5|sha1|MD5|SHA1)\b", r"\bDES\b", r"\bECB\b", r"\bmath/rand\b", r"InsecureSkipVerify\s*:\s*true"],
+    "memory": [r"\bunsafe\s*\{", r"\bunsafe\.Pointer\b", r"\b(?:strcpy|memcpy|sprintf|gets)\s*\("],
+    "config": [r"\bprivileged\s*:\s*true\b", r"\ballowPrivilegeEscalation\s*:\s*true\b", r"\bhostNetwork\s*:\s*true\b", r"\bdebug\s*[:=]\s*true\b", r"0\.0\.0\.0", r"\bchmod\s+(?:-R\s+)?777\b", r"\bcurl\b[^|\n]*\|\s*(?:ba)?sh\b"],
+    "network": [r"\bhttp://", r"\bDOCTYPE\b[^>]*\[", r"<!ENTITY\b"],
+}
+
+# Hard-coded secrets are worth a look in every language
+SECRET_PATTERNS = [
+    r"(?i:\b(?:password|passwd|pwd|secret|api[_-]?key|access[_-]?key|private[_-]?key|token|auth)\w*\s*[:=]\s*[\"'][^\"'\s]{4,}[\"'])",
+    r"-----BEGIN (?:RSA |EC |DSA |OPENSSH )?PRIVATE KEY-----",
+    r"\bAKIA[0-9A-Z]{16}\b",
+]
+
+# Untrusted input; on its own a weak signal
+SOURCE_PATTERNS = [
+    r"\brequest\.(?:GET|POST|args|form|values|json|data|files|cookies|headers|query_params|body|params|query)\b",
+    r"\breq\.(?:body|query|params|headers|cookies)\b",
+    r"\$_(?:GET|POST|REQUEST|COOKIE|FILES|SERVER)\b",
+    r"\bgetParameter\s*\(", r"@RequestParam\b", r"@PathVariable\b", r"@RequestBody\b",
+    r"\binput\s*\(", r"\bsys\.argv\b", r"\bargv\[", r"\bos\.environ\b", r"\bgetenv\s*\(", r"\bprocess\.env\b",
+    r"\blocation\.(?:search|hash)\b", r"\bdocument\.(?:URL|referrer)\b", r"\bwindow\.name\b", r"\bparams\[",
+]
+
+# Extensions that share a language-specific set
+LANGUAGE_ALIASES = {
+    "jsx": "js", "ts": "js", "tsx": "js",
+    "h": "c",
+    "cc": "cpp", "cxx": "cpp", "hpp": "cpp", "hh": "cpp", "hxx": "cpp",
+}
+
+
+def _compile(categories):
+    return {name: re.compile("|".join(f"(?:{p})" for p in patterns)) for name, patterns in categories.items()}
+
+
+_COMPILED_SINKS = {ext: _compile(patterns) for ext, patterns in SINK_PATTERNS.items()}
+_COMPILED_GENERIC_SINKS = _compile(GENERIC_SINK_PATTERNS)
+_COMPILED_SECRETS = re.compile("|".join(f"(?:{p})" for p in SECRET_PATTERNS))
+_COMPILED_SOURCES = re.compile("|".join(f"(?:{p})" for p in SOURCE_PATTERNS))
+
+TRIAGE_COUNTERS = ScanCounters("scored", "analyzed", "deprioritized", "skipped")
+
+
+def get_sink_patterns(file_extension):
+    language = LANGUAGE_ALIASES.get(file_extension, file_extension)
+    return _COMPILED_SINKS.get(language, _COMPILED_GENERIC_SINKS)
+
+
+def score_chunk(text, file_extension):
+    """Return (score, matched sink categories) for a piece of code."""
+    categories = [name for name, pattern in get_sink_patterns(file_extension).items() if pattern.search(text)]
+    if _COMPILED_SECRETS.search(text):
+        categories.append("secrets")
+    score = SINK_WEIGHT * len(categories)
+    if _COMPILED_SOURCES.search(text):
+        score += SOURCE_WEIGHT
+    return score, categories
+
+
+def triage_chunk(text, file_extension, level, scan_id=None):
+    """
+    Decide what to do with a chunk before it reaches the LLM.
+    Returns one of "analyze", "deprioritize" or "skip", and records the decision for the scan.
+    """
+    if level == "off":
+        return "analyze"
+
+    score, categories = score_chunk(text, file_extension)
+    if categories:
+        decision = "analyze"
+    elif score and level != "high":
+        decision = "analyze"
+    elif level == "low":
+        decision = "deprioritize"
+    else:
+        decision = "skip"
+
+    TRIAGE_COUNTERS.incr(scan_id, "scored")
+    TRIAGE_COUNTERS.incr(scan_id, {"analyze": "analyzed", "deprioritize": "deprioritized", "skip": "skipped"}[decision])
+    return decision
+
+
+def get_triage_stats(scan_id, level):
+    return {"aggressiveness": level, **TRIAGE_COUNTERS.get(scan_id)}
+
+
+def pop_triage_stats(scan_id, level):
+    return {"aggressiveness": level, **TRIAGE_COUNTERS.pop(scan_id)}
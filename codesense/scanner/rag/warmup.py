@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+from .backends import get_backend_pool
+from .config import set_kb_path
+from .embeddings import EMBEDDING_MODEL
+from .kb import load_knowledge_base
+from .llm import LLM_MODEL, LLM_PARAMS, LLM_KEEP_ALIVE
+from .retrieval import EMBEDDING_CACHE
+from .scheduler import get_scheduler
+
+logger = logging.getLogger(__name__)
+
+KB_READY = threading.Event()
+
+_WARMUP_LOCK = threading.Lock()
+_warmup_thread = None
+WARMUP_TIMINGS = {}
+
+
+def _timed(name, fn):
+    started = time.monotonic()
+    result = fn()
+    WARMUP_TIMINGS[name] = round(time.monotonic() - started, 3)
+    logger.info(f"Warm-up: {name} took {WARMUP_TIMINGS[name]}s")
+    return result
+
+
+def warm_up(kb_path):
+    """
+    Load the KB and QA chain and get the Ollama model resident, so the first scan
+    does not pay for it. Sets KB_READY on success.
+    """
+    started = time.monotonic()
+    set_kb_path(kb_path)
+    _timed("knowledge_base", lambda: load_knowledge_base(kb_path))
+    # Loads the models on every backend host; the pool's health checks keep them loaded
+    _timed("llm_model", lambda: get_backend_pool().warm_up(LLM_MODEL, LLM_KEEP_ALIVE, LLM_PARAMS["num_ctx"]))
+    if EMBEDDING_MODEL != LLM_MODEL:
+        _timed("embedding_model", lambda: get_backend_pool().warm_up(EMBEDDING_MODEL, LLM_KEEP_ALIVE))
+    _timed("embedding_cache", lambda: EMBEDDING_CACHE.get_many([]))
+    WARMUP_TIMINGS["total"] = round(time.monotonic() - started, 3)
+    KB_READY.set()
+    logger.info(f"Scanner warm-up completed in {WARMUP_TIMINGS['total']}s")
+
+
+def start_warmup(kb_path):
+    """Run warm_up in a background thread unless one is already running or done."""
+    global _warmup_thread
+    with _WARMUP_LOCK:
+        if KB_READY.is_set() or (_warmup_thread and _warmup_thread.is_alive()):
+            return
+
+        def run():
+            try:
+                warm_up(kb_path)
+            except Exception as e:
+                logger.error(f"Scanner warm-up failed: {e}")
+
+        _warmup_thread = threading.Thread(target=run, name="scanner-warmup", daemon=True)
+        _warmup_thread.start()
+
+
+def ensure_ready(kb_path):
+    """
+    Return True once the scanner is warm. Otherwise (re)start the warm-up, e.g. after
+    a failed attempt or with eager warm-up disabled, and return False.
+    """
+    if KB_READY.is_set():
+        return True
+    start_warmup(kb_path)
+    return False
+
+
+def get_warmup_status():
+    controller = get_scheduler().controller
+    return {
+        "ready": KB_READY.is_set(),
+        "timings": dict(WARMUP_TIMINGS),
+        "backends": get_backend_pool().get_stats(),
+        "llm_concurrency": controller.get_stats() if controller else {"limit": get_scheduler().max_in_flight},
+    }
@@ -1,3 +1,1409 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import unittest
+import zipfile
+import faiss
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from unittest import mock
+from django.apps import apps
+from django.test import SimpleTestCase
+from langchain_core.documents import Document
+from scanner.apps import start_server_warmup
+from scanner.rag.backends import BackendPool, TokenBucket, keep_alive_seconds
+from scanner.rag.scheduler import LLMScheduler, PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITY_BACKGROUND
+from scanner.rag.archive import ArchiveError, TarSourceArchive, ZipSourceArchive, _member_path, open_source_archive
+from scanner.rag.files import IgnoreRules, SourceFileWalker, _translate_ignore_pattern
+from scanner.rag.extract import (
+    FindingStream, extract_packed_info, extract_relevant_info, parse_findings, parse_structured_output, pop_extract_stats,
+)
+from scanner.rag.llm import FINDINGS_SCHEMA
+from scanner.rag.packing import PromptPacker
+from scanner.rag.prompts import get_focus_areas
+from scanner.rag.tokens import count_tokens
+from scanner.rag.triage import TRIAGE_LEVELS, pop_triage_stats, score_chunk, triage_chunk
+from scanner.rag.chunking import chunk_source
+from scanner.rag.neardup import NearDuplicateIndex, minhash_signature
+from scanner.rag import cache, context, database, manifest, kb_store, retrieval, scanner as scan_pipeline
+from scanner.rag.analysis import AnalysisError
+from scanner.rag.dedupe import normalize_content, copy_finding
 
-# Create your tests here.
+
+async def _settle():
+    # Slots are handed over with call_soon_threadsafe; let those callbacks and the woken tasks run
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+
+class ServerWarmupTests(SimpleTestCase):
+    def test_warm_up_follows_the_setting(self):
+        with mock.patch("scanner.rag.warmup.start_warmup") as start:
+            with self.settings(SCANNER_EAGER_WARMUP=False):
+                start_server_warmup()
+            start.assert_not_called()
+            with self.settings(SCANNER_EAGER_WARMUP=True, SCANNER_KB_PATH="/srv/kb"):
+                start_server_warmup()
+            start.assert_called_once_with("/srv/kb")
+
+    def test_loading_apps_does_not_warm_up(self):
+        with mock.patch("scanner.rag.warmup.start_warmup") as start:
+            apps.get_app_config("scanner").ready()
+        start.assert_not_called()
+
+
+class LLMSchedulerTests(SimpleTestCase):
+    def grant_order(self, waiters):
+        """Names of `waiters` ((name, scan_id, priority)) in the order a single slot reaches them."""
+        scheduler = LLMScheduler(max_in_flight=1, adaptive=False)
+        order = []
+
+        async def wait(name, scan_id, priority):
+            await scheduler.acquire(scan_id, priority)
+            order.append((name, scan_id))
+
+        async def run():
+            await scheduler.acquire("holder")
+            tasks = []
+            for waiter in waiters:
+                tasks.append(asyncio.ensure_future(wait(*waiter)))
+                await _settle()
+            self.assertEqual(scheduler.load(), (1, len(waiters)))
+            scheduler.release("holder")
+            for _ in waiters:
+                await _settle()
+                scheduler.release(order[-1][1])
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        return [name for name, _ in order]
+
+    def test_higher_priority_classes_are_served_first(self):
+        order = self.grant_order([
+            ("bulk", "a", PRIORITY_BULK),
+            ("background", "b", PRIORITY_BACKGROUND),
+            ("interactive", "c", PRIORITY_INTERACTIVE),
+        ])
+        self.assertEqual(order, ["interactive", "bulk", "background"])
+
+    def test_scans_of_one_class_take_turns(self):
+        order = self.grant_order([
+            ("a1", "a", PRIORITY_BULK),
+            ("a2", "a", PRIORITY_BULK),
+            ("a3", "a", PRIORITY_BULK),
+            ("b1", "b", PRIORITY_BULK),
+            ("b2", "b", PRIORITY_BULK),
+        ])
+        self.assertEqual(order, ["a1", "b1", "a2", "b2", "a3"])
+
+    def test_free_slots_are_granted_without_queueing(self):
+        scheduler = LLMScheduler(max_in_flight=2, adaptive=False)
+
+        async def run():
+            await scheduler.acquire("a")
+            await scheduler.acquire("b")
+            self.assertEqual(scheduler.load(), (2, 0))
+
+        asyncio.run(run())
+        self.assertEqual(scheduler.get_scan_stats("a")["calls"], 1)
+        self.assertEqual(scheduler.get_scan_stats("a")["queue_depth"], 0)
+
+    def test_cancelled_waiter_gives_up_its_place(self):
+        scheduler = LLMScheduler(max_in_flight=1, adaptive=False)
+
+        async def run():
+            await scheduler.acquire("holder")
+            waiter = asyncio.ensure_future(scheduler.acquire("a"))
+            await _settle()
+            waiter.cancel()
+            await _settle()
+            self.assertEqual(scheduler.load(), (1, 0))
+            scheduler.release("holder")
+            self.assertEqual(scheduler.load(), (0, 0))
+
+        asyncio.run(run())
+        self.assertEqual(scheduler.get_scan_stats("a")["queue_depth"], 0)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_wait_then_refill(self):
+        with mock.patch("scanner.rag.backends.time.monotonic", return_value=100.0) as clock:
+            bucket = TokenBucket(rate=10, capacity=2)
+            self.assertEqual(bucket.reserve(), 0.0)
+            self.assertEqual(bucket.reserve(), 0.0)
+            self.assertAlmostEqual(bucket.reserve(), 0.1)
+            self.assertAlmostEqual(bucket.reserve(), 0.2)
+
+            # One second refills ten tokens, capped at the burst size
+            clock.return_value = 101.0
+            self.assertEqual(bucket.reserve(), 0.0)
+            self.assertEqual(bucket.reserve(), 0.0)
+            self.assertAlmostEqual(bucket.reserve(), 0.1)
+
+    def test_no_rate_never_waits(self):
+        bucket = TokenBucket(rate=None, capacity=1)
+        self.assertEqual([bucket.reserve() for _ in range(5)], [0.0] * 5)
+
+    def test_each_host_has_its_own_bucket(self):
+        pool = BackendPool(["http://a:11434", "http://b:11434"])
+        first, second = pool.backends
+        with mock.patch("scanner.rag.backends.time.monotonic", return_value=100.0):
+            for backend in pool.backends:
+                backend.bucket = TokenBucket(rate=1, capacity=1)
+            self.assertEqual(pool._reserve_token(first), 0.0)
+            self.assertAlmostEqual(pool._reserve_token(first), 1.0)
+            self.assertEqual(pool._reserve_token(second), 0.0)
+        self.assertEqual(first.stats()["rate_limit_wait_seconds"], 1.0)
+        self.assertEqual(second.stats()["rate_limit_wait_seconds"], 0.0)
+
+
+class ModelResidencyTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = BackendPool(["http://a:11434", "http://b:11434"])
+        for backend in self.pool.backends:
+            backend.client = mock.Mock()
+            backend.client.ps.return_value = {"models": []}
+            backend.client.generate.return_value = {"response": "ok"}
+
+    def loads(self, backend):
+        return [c.kwargs["model"] for c in backend.client.generate.call_args_list if c.kwargs.get("prompt") == ""]
+
+    def test_keep_alive_durations(self):
+        self.assertEqual(keep_alive_seconds("30m"), 1800)
+        self.assertEqual(keep_alive_seconds("1h30m"), 5400)
+        self.assertEqual(keep_alive_seconds(90), 90)
+        self.assertEqual(keep_alive_seconds("0"), 0)
+        self.assertEqual(keep_alive_seconds(None), 300)
+        self.assertIsNone(keep_alive_seconds(-1))
+        self.assertIsNone(keep_alive_seconds("-1m"))
+
+    def test_unused_models_are_not_reloaded(self):
+        self.pool._remember("qwen", "30m", None)
+        for backend in self.pool.backends:
+            self.pool._check(backend)
+            self.assertEqual(self.loads(backend), [])
+
+    def test_model_is_reloaded_only_on_the_host_that_served_it(self):
+        first, second = self.pool.backends
+        with mock.patch.object(self.pool, "start_health_checks"), mock.patch.object(self.pool, "_acquire", return_value=first):
+            first.outstanding += 1
+            self.pool.call("generate", model="qwen", prompt="p", keep_alive="30m")
+        self.pool._remember("qwen", "30m", None)
+
+        self.pool._check(first)
+        self.pool._check(second)
+        self.assertEqual(self.loads(first), ["qwen"])
+        self.assertEqual(self.loads(second), [])
+
+    def test_loaded_model_is_left_alone(self):
+        first = self.pool.backends[0]
+        first.models_used["qwen"] = time.monotonic()
+        first.client.ps.return_value = {"models": [{"model": "qwen"}]}
+        self.pool._remember("qwen", "30m", None)
+        self.pool._check(first)
+        self.assertEqual(self.loads(first), [])
+
+    def test_model_idle_past_its_keep_alive_expires(self):
+        first = self.pool.backends[0]
+        self.pool._remember("qwen", "30m", None)
+        self.pool._remember("embed", None, None)
+        first.models_used.update(qwen=1000.0, embed=1000.0)
+        with mock.patch("scanner.rag.backends.time.monotonic", return_value=1000.0 + 600):
+            self.pool._check(first)
+        self.assertEqual(self.loads(first), ["qwen"])
+        with mock.patch("scanner.rag.backends.time.monotonic", return_value=1000.0 + 1800):
+            self.pool._check(first)
+        self.assertEqual(self.loads(first), ["qwen"])
+
+    def test_warm_up_loads_only_its_model(self):
+        self.pool._remember("cascade", "30m", None)
+        self.pool.warm_up("qwen", "30m")
+        for backend in self.pool.backends:
+            self.assertEqual(self.loads(backend), ["qwen"])
+
+
+
+class LLMCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.collection = mock.Mock()
+        patches = [
+            mock.patch.object(cache, "CACHE_COLLECTION", self.collection),
+            mock.patch.object(cache, "_indexes_ready", True),
+            mock.patch.object(cache, "_inserts_since_eviction", 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_key_covers_prompt_model_params_and_kb_version(self):
+        key = cache.make_cache_key("prompt")
+        self.assertEqual(cache.make_cache_key("prompt"), key)
+        self.assertNotEqual(cache.make_cache_key("prompt "), key)
+        with mock.patch.object(cache, "LLM_MODEL", "other-model"):
+            self.assertNotEqual(cache.make_cache_key("prompt"), key)
+        with mock.patch.object(cache, "LLM_PARAMS", {**cache.LLM_PARAMS, "num_ctx": 1}):
+            self.assertNotEqual(cache.make_cache_key("prompt"), key)
+        with mock.patch.object(cache, "get_kb_version", return_value="kb-other"):
+            self.assertNotEqual(cache.make_cache_key("prompt"), key)
+        with mock.patch.object(cache, "RETRIEVAL_TOP_K", cache.RETRIEVAL_TOP_K + 1):
+            self.assertNotEqual(cache.make_cache_key("prompt"), key)
+
+    def test_entries_expire_after_the_ttl_since_last_use(self):
+        self.collection.find_one_and_update.return_value = None
+        with mock.patch.object(cache, "_indexes_ready", False):
+            cache.get_cached_output("prompt")
+            cache.get_cached_output("prompt")
+        self.collection.create_index.assert_called_once_with("last_used", expireAfterSeconds=cache.LLM_CACHE_TTL_SECONDS)
+
+    def test_hit_refreshes_last_used_and_counts_per_scan(self):
+        self.collection.find_one_and_update.side_effect = [{"output": "cached"}, None]
+        self.assertEqual(cache.get_cached_output("prompt", scan_id="cache-scan"), "cached")
+        self.assertIsNone(cache.get_cached_output("other", scan_id="cache-scan"))
+
+        query, update = self.collection.find_one_and_update.call_args_list[0].args
+        self.assertEqual(query, {"_id": cache.make_cache_key("prompt")})
+        self.assertIn("last_used", update["$set"])
+        self.assertEqual(cache.pop_cache_stats("cache-scan"), {"hits": 1, "misses": 1})
+
+    def test_lookup_failure_is_a_miss(self):
+        self.collection.find_one_and_update.side_effect = RuntimeError("connection refused")
+        self.assertIsNone(cache.get_cached_output("prompt"))
+
+    def test_empty_output_is_not_stored(self):
+        cache.store_output("prompt", "")
+        self.collection.update_one.assert_not_called()
+
+    def test_eviction_runs_every_interval_and_drops_least_recently_used(self):
+        self.collection.estimated_document_count.return_value = cache.LLM_CACHE_MAX_ENTRIES + 2
+        self.collection.find.return_value.sort.return_value.limit.return_value = [{"_id": "k1"}, {"_id": "k2"}]
+        with mock.patch.object(cache, "evict_lru", wraps=cache.evict_lru) as evict:
+            for i in range(cache.EVICTION_CHECK_INTERVAL - 1):
+                cache.store_output(f"prompt {i}", "output")
+            evict.assert_not_called()
+            cache.store_output("last prompt", "output")
+            evict.assert_called_once_with()
+
+        self.collection.find.return_value.sort.assert_called_once_with("last_used", 1)
+        self.collection.find.return_value.sort.return_value.limit.assert_called_once_with(2)
+        self.assertEqual(self.collection.delete_many.call_args.args[0], {"_id": {"$in": ["k1", "k2"]}})
+
+    def test_cache_under_its_limit_is_not_evicted(self):
+        self.collection.estimated_document_count.return_value = 5
+        self.assertEqual(cache.evict_lru(max_entries=10), 0)
+        self.collection.delete_many.assert_not_called()
+
+
+def _finding(title, snippet="eval(data)"):
+    return {"vulnerability": title, "cwe": "CWE-95", "severity": "High", "impact": "Code execution",
+            "mitigation": "Do not eval input", "affected": "run()", "code_snippet": snippet}
+
+def _text_finding(title, snippet="eval(data)"):
+    return (f"Vulnerability: {title}\nCWE: CWE-95\nSeverity: High\nImpact: Code execution\n"
+            f"Mitigation: Do not eval input\nAffected: run()\nCode Snippet: {snippet}\n\n")
+
+
+
+class StructuredOutputTests(SimpleTestCase):
+    def test_findings_json_becomes_seven_field_matches(self):
+        output = json.dumps({"findings": [
+            _finding("Code injection"),
+            {**_finding("Path traversal", "open(path)"), "file": "app/files.py", "cwe": None},
+            "not a finding",
+        ]})
+        self.assertEqual(parse_structured_output(output), [
+            (None, ("Code injection", "CWE-95", "High", "Code execution", "Do not eval input", "run()", "eval(data)")),
+            ("app/files.py", ("Path traversal", "", "High", "Code execution", "Do not eval input", "run()", "open(path)")),
+        ])
+
+    def test_other_output_is_not_structured(self):
+        for output in ("", None, "Vulnerability: eval", "[]", json.dumps({"issues": []}), '{"findings": [', json.dumps({"findings": {}})):
+            with self.subTest(output=output):
+                self.assertIsNone(parse_structured_output(output))
+
+    def test_parse_path_is_counted_per_scan(self):
+        parse_findings(json.dumps({"findings": []}), "parse-scan")
+        self.assertEqual(len(parse_findings(_text_finding("Code injection"), "parse-scan")), 1)
+        parse_findings("No vulnerabilities found.", "parse-scan")
+        parse_findings("", "parse-scan")
+        stats = pop_extract_stats("parse-scan")
+        self.assertEqual((stats["structured"], stats["regex"], stats["unparsed"]), (1, 1, 1))
+
+    def test_structured_findings_get_their_file_lines(self):
+        content = "import os\n\ndef run(data):\n    return eval(data)\n"
+        findings = extract_relevant_info(json.dumps({"findings": [_finding("Code injection")]}), "views.py",
+                                         str(ObjectId()), str(ObjectId()), content)
+        self.assertEqual([(f["title"], f["severity"], f["lines"]) for f in findings], [("Code injection", "high", [4, 4])])
+
+    def test_schema_is_sent_as_the_generation_format(self):
+        pool = BackendPool(["http://a:11434"])
+        client = pool.backends[0].client = mock.Mock()
+        client.generate.return_value = {"response": "{}"}
+        with mock.patch.object(pool, "start_health_checks"):
+            pool.generate("qwen", "prompt", format=FINDINGS_SCHEMA)
+            self.assertEqual(client.generate.call_args.kwargs["format"], FINDINGS_SCHEMA)
+            pool.generate("qwen", "prompt")
+            self.assertNotIn("format", client.generate.call_args.kwargs)
+
+    def test_output_format_is_part_of_the_cache_key(self):
+        with mock.patch.object(cache, "STRUCTURED_OUTPUT_ENABLED", True):
+            structured = cache.make_cache_key("prompt")
+        with mock.patch.object(cache, "STRUCTURED_OUTPUT_ENABLED", False):
+            self.assertNotEqual(cache.make_cache_key("prompt"), structured)
+
+
+class FindingStreamTests(SimpleTestCase):
+    def stream(self, packed=False):
+        matches = []
+        stream = FindingStream(on_match=lambda file, match: matches.append(match[0]), packed=packed)
+        return stream, matches
+
+    def feed(self, stream, text, step=1):
+        """Feed `text` in pieces of `step` characters; returns the offset at which the stream said to stop."""
+        for i in range(0, len(text), step):
+            if stream.feed(text[i:i + step]):
+                return i + step
+        return None
+
+    def test_json_findings_split_across_deltas(self):
+        stream, matches = self.stream()
+        output = json.dumps({"findings": [_finding("Code injection"), _finding("Path traversal", "open(path)")]})
+        stopped_at = self.feed(stream, output + "\n\nTrailing commentary")
+        self.assertEqual(matches, ["Code injection", "Path traversal"])
+        # The array closing ends generation, before the trailing text
+        self.assertEqual(stopped_at, output.rindex("]") + 1)
+        stream.finish()
+        self.assertEqual(json.loads(stream.output())["findings"][1]["vulnerability"], "Path traversal")
+
+    def test_braces_inside_json_strings_do_not_end_a_finding(self):
+        stream, matches = self.stream()
+        output = json.dumps({"findings": [_finding("Template injection", "render('{{ user }}]')")]})
+        self.feed(stream, output, step=3)
+        self.assertEqual(matches, ["Template injection"])
+        self.assertTrue(stream.done)
+
+    def test_empty_json_findings_stop_early(self):
+        stream, matches = self.stream()
+        self.assertEqual(self.feed(stream, '{"findings": []}  '), len('{"findings": []'))
+        self.assertEqual(matches, [])
+
+    def test_no_findings_response_stops_text_stream(self):
+        stream, matches = self.stream()
+        self.assertIsNotNone(self.feed(stream, "No vulnerabilities found in this code. The input is validated.", step=4))
+        self.assertEqual(matches, [])
+
+    def test_no_findings_after_a_finding_does_not_stop(self):
+        stream, matches = self.stream()
+        text = _text_finding("Code injection") + "No other vulnerabilities were found.\n" + _text_finding("SQL injection", "cursor.execute(q)")
+        self.assertIsNone(self.feed(stream, text, step=5))
+        stream.finish()
+        self.assertEqual(matches, ["Code injection", "SQL injection"])
+
+    def test_no_findings_in_packed_output_does_not_stop(self):
+        stream, matches = self.stream(packed=True)
+        text = "File: a.py\nNo vulnerabilities found.\n\nFile: b.py\n" + _text_finding("Code injection")
+        self.assertIsNone(self.feed(stream, text, step=5))
+        stream.finish()
+        self.assertEqual(matches, ["Code injection"])
+
+    def test_repeated_finding_stops_stream(self):
+        stream, matches = self.stream()
+        text = _text_finding("Code injection") + _text_finding("Code injection") + _text_finding("SQL injection")
+        self.assertIsNotNone(self.feed(stream, text, step=7))
+        stream.finish()
+        self.assertEqual(matches, ["Code injection"])
+        self.assertEqual(stream.output(), _text_finding("Code injection"))
+
+    def test_truncated_json_keeps_complete_findings(self):
+        stream, matches = self.stream()
+        output = json.dumps({"findings": [_finding("Code injection"), _finding("Path traversal")]})
+        cut = output.index("Path traversal")
+        self.assertIsNone(self.feed(stream, output[:cut], step=4))
+        stream.finish()
+        self.assertEqual(matches, ["Code injection"])
+        self.assertEqual([item["vulnerability"] for item in json.loads(stream.output())["findings"]], ["Code injection"])
+
+    def test_truncated_text_keeps_complete_findings(self):
+        stream, matches = self.stream()
+        text = _text_finding("Code injection") + "Vulnerability: SQL injection\nCWE: CWE-89\nSever"
+        self.feed(stream, text, step=6)
+        stream.finish()
+        self.assertEqual(matches, ["Code injection"])
+
+    def test_packed_files_sharing_a_finding_do_not_stop_json_stream(self):
+        stream, matches = self.stream(packed=True)
+        items = [dict(_finding("Code injection"), file=name) for name in ("a.py", "b.py")]
+        items.append(dict(_finding("Path traversal", "open(path)"), file="c.py"))
+        self.feed(stream, json.dumps({"findings": items}), step=7)
+        stream.finish()
+        self.assertEqual(matches, ["Code injection", "Code injection", "Path traversal"])
+        self.assertEqual([item["file"] for item in json.loads(stream.output())["findings"]], ["a.py", "b.py", "c.py"])
+
+    def test_packed_files_sharing_a_finding_do_not_stop_text_stream(self):
+        stream, matches = self.stream(packed=True)
+        text = ("File: a.py\n" + _text_finding("Code injection") + "File: b.py\n" + _text_finding("Code injection")
+                + "File: c.py\n" + _text_finding("Path traversal", "open(path)"))
+        self.assertIsNone(self.feed(stream, text, step=5))
+        stream.finish()
+        self.assertEqual(matches, ["Code injection", "Code injection", "Path traversal"])
+        self.assertEqual(stream.output(), text)
+
+    def test_packed_finding_repeated_for_the_same_file_stops_stream(self):
+        stream, matches = self.stream(packed=True)
+        text = "File: a.py\n" + _text_finding("Code injection") + "File: a.py\n" + _text_finding("Code injection") + "File: b.py\n"
+        self.assertIsNotNone(self.feed(stream, text, step=5))
+        self.assertEqual(matches, ["Code injection"])
+
+
+
+def _packed_file(path, content):
+    return {"path": path, "name": path.rsplit("/", 1)[-1], "extension": "py", "content": content}
+
+
+PACKED_FILES = [
+    _packed_file("app/views.py", "import os\n\ndef run(data):\n    return eval(data)\n"),
+    _packed_file("app/files.py", "def read(path):\n    return open(path).read()\n"),
+    _packed_file("lib/files.py", "def size(path):\n    return os.stat(path).st_size\n"),
+]
+
+
+class PromptPackerTests(SimpleTestCase):
+    def entry(self, extension, tokens):
+        return {"path": f"f{tokens}.{extension}", "extension": extension, "tokens": tokens}
+
+    def test_only_small_files_are_packed(self):
+        packer = PromptPacker(token_budget=1000, max_file_tokens=100)
+        self.assertIsNotNone(packer.accepts("x = 1\n"))
+        self.assertIsNone(packer.accepts("x = 1\n" * 100))
+
+    def test_batches_fill_per_language_up_to_the_budget(self):
+        packer = PromptPacker(token_budget=100, max_file_tokens=100)
+        self.assertEqual(packer.add(self.entry("py", 60)), [])
+        self.assertEqual(packer.add(self.entry("js", 60)), [])
+        self.assertEqual(packer.add(self.entry("py", 40)), [])
+        ready = packer.add(self.entry("py", 30))
+        self.assertEqual([[f["tokens"] for f in batch] for batch in ready], [[60, 40]])
+
+        drained = packer.drain()
+        self.assertEqual(sorted([f["tokens"] for f in batch] for batch in drained), [[30], [60]])
+        self.assertEqual(packer.drain(), [])
+
+    def test_structured_findings_are_attributed_by_path_suffix_and_name(self):
+        output = json.dumps({"findings": [
+            {**_finding("Code injection"), "file": "views.py"},
+            {**_finding("Path traversal", "return open(path).read()"), "file": "codesense/app/files.py"},
+            {**_finding("Unattributed", "os.stat(path)"), "file": "files.py"},
+        ]})
+        results = extract_packed_info(output, PACKED_FILES, str(ObjectId()), str(ObjectId()))
+
+        self.assertEqual([f["title"] for f in results["app/views.py"]], ["Code injection"])
+        self.assertEqual(results["app/views.py"][0]["lines"], [4, 4])
+        self.assertEqual([f["title"] for f in results["app/files.py"]], ["Path traversal"])
+        # "files.py" names two packed files; the snippet settles which one it is
+        self.assertEqual([f["title"] for f in results["lib/files.py"]], ["Unattributed"])
+
+    def test_text_sections_are_attributed_to_their_file_header(self):
+        output = ("File: app/files.py\n" + _text_finding("Path traversal", "return open(path).read()")
+                  + "File: app/views.py\n" + _text_finding("Code injection"))
+        results = extract_packed_info(output, PACKED_FILES, str(ObjectId()), str(ObjectId()))
+
+        self.assertEqual([f["title"] for f in results["app/files.py"]], ["Path traversal"])
+        self.assertEqual(results["app/files.py"][0]["file_path"], "files.py [2,2]")
+        self.assertEqual([f["title"] for f in results["app/views.py"]], ["Code injection"])
+        self.assertEqual(results["lib/files.py"], [])
+
+    def test_finding_that_matches_no_file_is_dropped(self):
+        output = json.dumps({"findings": [_finding("Nowhere", "subprocess.call(cmd, shell=True)")]})
+        results = extract_packed_info(output, PACKED_FILES, str(ObjectId()), str(ObjectId()))
+        self.assertEqual(results, {f["path"]: [] for f in PACKED_FILES})
+
+
+
+class TriageTests(SimpleTestCase):
+    SINK = "def run(cmd):\n    subprocess.call(cmd, shell=True)\n"
+    SOURCE = "def name():\n    return request.args.get('name')\n"
+    PLAIN = "def add(a, b):\n    return a + b\n"
+
+    def test_decisions_per_level(self):
+        expected = {
+            "off": ("analyze", "analyze", "analyze"),
+            "low": ("analyze", "analyze", "deprioritize"),
+            "medium": ("analyze", "analyze", "skip"),
+            "high": ("analyze", "skip", "skip"),
+        }
+        self.assertEqual(set(expected), set(TRIAGE_LEVELS))
+        for level, decisions in expected.items():
+            with self.subTest(level=level):
+                self.assertEqual(tuple(triage_chunk(text, "py", level) for text in (self.SINK, self.SOURCE, self.PLAIN)), decisions)
+
+    def test_sinks_are_matched_per_language(self):
+        self.assertEqual(score_chunk("el.innerHTML = html;", "tsx")[1], ["templating"])
+        self.assertEqual(score_chunk("strcpy(buf, input);", "hpp")[1], ["memory"])
+        # No language-specific set: the generic patterns apply
+        self.assertEqual(score_chunk("exec.Command(name)", "go")[1], ["command"])
+        self.assertEqual(score_chunk("subprocess.call(cmd)", "rb")[1], [])
+
+    def test_hard_coded_secrets_count_as_a_sink(self):
+        self.assertEqual(triage_chunk('API_KEY = "sk-live-1234abcd"\n', "py", "high"), "analyze")
+
+    def test_decisions_are_counted_per_scan(self):
+        for text in (self.SINK, self.PLAIN, self.PLAIN):
+            triage_chunk(text, "py", "medium", scan_id="triage-scan")
+        triage_chunk(self.PLAIN, "py", "off", scan_id="triage-scan")
+        self.assertEqual(pop_triage_stats("triage-scan", "medium"),
+                         {"aggressiveness": "medium", "scored": 3, "analyzed": 1, "deprioritized": 0, "skipped": 2})
+
+
+PYTHON_SOURCE = """import os
+
+
+@decorator
+def first():
+    a = 1
+    return a
+
+
+# helper
+def second():
+    b = 2
+    return b
+"""
+
+
+# Every line costs two tokens (itself plus its newline) so budgets count lines
+@mock.patch("scanner.rag.chunking.count_tokens", lambda line: 1)
+class ChunkSourceTests(SimpleTestCase):
+    def spans(self, content, extension, budget, overlap=1):
+        return [(c["start_line"], c["end_line"]) for c in chunk_source(content, extension, budget, overlap)]
+
+    def test_small_file_is_one_chunk(self):
+        chunks = chunk_source(PYTHON_SOURCE, "py", token_budget=100)
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0]["text"], PYTHON_SOURCE.strip())
+
+    def test_python_splits_on_definitions_with_decorators_and_comments(self):
+        chunks = chunk_source(PYTHON_SOURCE, "py", token_budget=12, overlap_lines=1)
+        self.assertEqual([c["text"].split("\n")[0] for c in chunks], ["import os", "@decorator", "# helper"])
+        self.assertEqual([(c["start_line"], c["end_line"]) for c in chunks], [(1, 1), (4, 7), (10, 13)])
+
+    def test_python_multiline_string_is_not_a_boundary(self):
+        source = 'QUERY = """\ndef not_a_function():\n    pass\n"""\n\n\ndef real():\n    return QUERY\n'
+        self.assertEqual(self.spans(source, "py", 8), [(1, 4), (7, 8)])
+
+    def test_python_syntax_error_falls_back_to_indentation(self):
+        source = PYTHON_SOURCE.replace("def second():", "def second(:")
+        self.assertEqual(self.spans(source, "py", 12), [(1, 1), (4, 7), (10, 13)])
+
+    def test_oversized_unit_is_cut_into_overlapping_windows(self):
+        source = "DATA = [\n" + "    1,\n" * 8 + "]\n"
+        self.assertEqual(self.spans(source, "py", 8), [(1, 4), (4, 7), (7, 10)])
+
+    def test_oversized_function_keeps_header_and_splits_body(self):
+        source = "def big():\n" + "".join(f"    x{i} = {i}\n" for i in range(6))
+        chunks = chunk_source(source, "py", token_budget=8, overlap_lines=1)
+        self.assertEqual(chunks[0]["text"], "def big():\n    x0 = 0\n    x1 = 1\n    x2 = 2")
+        self.assertEqual(chunks[-1]["end_line"], 7)
+
+    def test_brace_language_ignores_braces_in_strings(self):
+        source = 'function a() {\n  const s = "}";\n  return s;\n}\n\n// b docs\nfunction b() {\n  return 2;\n}\n'
+        chunks = chunk_source(source, "js", token_budget=10, overlap_lines=1)
+        self.assertEqual([(c["start_line"], c["end_line"]) for c in chunks], [(1, 4), (6, 9)])
+        self.assertTrue(chunks[1]["text"].startswith("// b docs\nfunction b()"))
+
+    def test_sql_splits_on_statements(self):
+        source = "SELECT *\nFROM users\nWHERE id = 1;\nDELETE FROM users\nWHERE id = 2;\n"
+        self.assertEqual(self.spans(source, "sql", 6), [(1, 3), (4, 5)])
+
+
+# Shared tail that lifts the chunks below over NEAR_DUPLICATE_MIN_TOKENS
+NEAR_DUPLICATE_PADDING = {
+    "py": """
+def summarize(rows, limit):
+    total = 0
+    for row in rows[:limit]:
+        if row.get("active"):
+            total += row["amount"] * 2
+    return {"total": total, "count": len(rows)}
+""",
+    "js": """
+function summarize(rows, limit) {
+  let total = 0;
+  for (const row of rows.slice(0, limit)) {
+    if (row.active) { total += row.amount * 2; }
+  }
+  return { total: total, count: rows.length };
+}
+""",
+}
+
+YAML_LOADER = """def load_config(path):
+    with open(path) as handle:
+        data = handle.read()
+    config = yaml.load(data, Loader=yaml.SafeLoader)
+    return config
+"""
+
+
+class NearDuplicateTests(SimpleTestCase):
+    def signatures(self, first, second, extension="py"):
+        padding = NEAR_DUPLICATE_PADDING[extension]
+        return minhash_signature(first + padding, extension), minhash_signature(second + padding, extension)
+
+    def assertNotReusable(self, first, second, extension="py"):
+        a, b = self.signatures(first, second, extension)
+        self.assertNotEqual(a[2], b[2])
+
+    def test_renamed_copy_matches(self):
+        renamed = (YAML_LOADER.replace("path", "source").replace("data", "text").replace("config", "settings")
+                   + "# vendored copy\n")
+        a, b = self.signatures(YAML_LOADER, renamed)
+        self.assertEqual(float(np.mean(a[0] == b[0])), 1.0)
+        self.assertEqual(a[2], b[2])
+
+    def test_changed_loader_is_not_reused(self):
+        self.assertNotReusable(YAML_LOADER, YAML_LOADER.replace("SafeLoader", "UnsafeLoader"))
+
+    def test_changed_attribute_is_not_reused(self):
+        source = """function render(item, value) {
+  const el = document.getElementById("x");
+  el.total = value;
+  return el;
+}
+"""
+        self.assertNotReusable(source, source.replace("total", "innerHTML"), "js")
+
+    def test_added_keyword_argument_is_not_reused(self):
+        source = """def run(cmd, cwd):
+    result = subprocess.run(
+        cmd,
+        cwd=cwd,
+    )
+    return result.stdout
+"""
+        self.assertNotReusable(source, source.replace("cwd=cwd,", "cwd=cwd,\n        shell=True,"))
+
+    def test_lookup_requires_same_sinks_and_another_source_path(self):
+        signature = minhash_signature(YAML_LOADER + NEAR_DUPLICATE_PADDING["py"], "py")
+        stored = {"_id": "c1", "signature": [int(v) for v in signature[0]], "findings": [{"title": "t"}]}
+        collection = mock.Mock()
+        collection.aggregate.return_value = [stored]
+        with mock.patch("scanner.rag.neardup.SIGNATURE_COLLECTION", collection), \
+                mock.patch("scanner.rag.neardup._ensure_indexes"), \
+                mock.patch("scanner.rag.neardup.get_analysis_version", return_value="v1"):
+            index = NearDuplicateIndex("5f0000000000000000000000", "medium", None)
+            self.assertEqual(index.find(signature, "py", source_path="app/config.py"), [{"title": "t"}])
+            index.add(signature, "py", [], "app/config.py")
+
+        query = collection.aggregate.call_args.args[0][0]["$match"]
+        self.assertEqual(query["sinks"], signature[2])
+        self.assertEqual(query["source_path"], {"$ne": "app/config.py"})
+        document = collection.insert_one.call_args.args[0]
+        self.assertEqual((document["sinks"], document["source_path"]), (signature[2], "app/config.py"))
+
+
+
+class SourceFileWalkerTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def write(self, path, data=b"x = 1\n"):
+        full_path = os.path.join(self.root, *path.split("/"))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(data)
+        return full_path
+
+    def walk(self, **kwargs):
+        walker = SourceFileWalker(self.root, **kwargs)
+        return sorted(os.path.relpath(path, self.root).replace(os.sep, "/") for path in walker), walker.stats()
+
+    def test_gitignore_patterns(self):
+        cases = [
+            ("*.py", ["a.py", "src/a.py"], ["a.pyc", "a.py/x"]),
+            ("/build.py", ["build.py"], ["src/build.py"]),
+            ("docs/*.py", ["docs/a.py"], ["docs/x/a.py", "src/docs/a.py"]),
+            ("**/tmp", ["tmp", "a/b/tmp"], ["tmpx"]),
+            ("gen/**", ["gen/a.py", "gen/x/y.py"], ["gen", "src/gen/a.py"]),
+            ("a/**/b.py", ["a/b.py", "a/x/y/b.py"], ["c/a/b.py"]),
+            ("file?.py", ["file1.py"], ["file10.py", "file/.py"]),
+            ("[ab].py", ["a.py", "b.py"], ["c.py"]),
+            ("[!ab].py", ["c.py"], ["a.py"]),
+            ("\\#notes.py", ["#notes.py"], ["notes.py"]),
+        ]
+        for pattern, matched, unmatched in cases:
+            regex = _translate_ignore_pattern(pattern)
+            for path in matched:
+                with self.subTest(pattern=pattern, path=path):
+                    self.assertTrue(regex.match(path))
+            for path in unmatched:
+                with self.subTest(pattern=pattern, path=path):
+                    self.assertFalse(regex.match(path))
+
+    def test_ignore_rules_negation_directories_and_base(self):
+        rules = IgnoreRules("src", ["# comment", "", "*.py", "!keep.py", "logs/"])
+        self.assertTrue(rules.match("src/a.py", False))
+        self.assertFalse(rules.match("src/keep.py", False))
+        self.assertTrue(rules.match("src/logs", True))
+        self.assertIsNone(rules.match("src/logs", False))
+        self.assertIsNone(rules.match("other/a.py", False))
+
+    def test_ignore_files_apply_to_their_directory(self):
+        self.write(".gitignore", b"secret/\n*.gen.py\n")
+        self.write("app/.codesenseignore", b"local_*.py\n!local_keep.py\n")
+        for path in ("main.py", "models.gen.py", "secret/key.py", "app/views.py", "app/local_a.py", "app/local_keep.py", "local_b.py"):
+            self.write(path)
+
+        files, stats = self.walk()
+        self.assertEqual(files, ["app/local_keep.py", "app/views.py", "local_b.py", "main.py"])
+        self.assertEqual(stats["skipped"]["ignored"], 3)
+
+    def test_dependencies_generated_and_unsupported_files_are_skipped(self):
+        for path in ("node_modules/lib/index.js", "app.min.js", "proto_pb2.py", "README.md", "app.js"):
+            self.write(path)
+
+        files, stats = self.walk()
+        self.assertEqual(files, ["app.js"])
+        self.assertEqual((stats["skipped"]["excluded_dir"], stats["skipped"]["excluded_file"], stats["skipped"]["unsupported"]),
+                         (1, 2, 1))
+        # Unsupported files are counted but not listed
+        self.assertNotIn("README.md", [entry["path"] for entry in stats["skipped_paths"]])
+
+    def test_binary_minified_and_oversized_files_are_skipped(self):
+        self.write("binary.c", b"\0\x01\x02")
+        self.write("minified.js", b"var a=1;" * 400)
+        self.write("large.py", b"x = 1\n" * 1000)
+        self.write("small.py", b"x = 1\n")
+
+        files, stats = self.walk(max_file_bytes=4000)
+        self.assertEqual(files, ["small.py"])
+        self.assertEqual({reason: stats["skipped"][reason] for reason in ("binary", "minified", "too_large")},
+                         {"binary": 1, "minified": 1, "too_large": 1})
+        self.assertEqual((stats["files"], stats["bytes"]), (1, 6))
+
+    def test_scan_stops_taking_files_at_the_total_size_cap(self):
+        for name in ("a.py", "b.py", "c.py"):
+            self.write(name, b"x = 1\n")
+
+        files, stats = self.walk(max_total_bytes=12)
+        self.assertEqual(files, ["a.py", "b.py"])
+        self.assertEqual(stats["skipped_paths"], [{"path": "c.py", "reason": "scan_size_cap"}])
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symlinks")
+    def test_symlinks_are_not_followed(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside, ignore_errors=True)
+        with open(os.path.join(outside, "passwd.py"), "w") as f:
+            f.write("x = 1\n")
+        self.write("main.py")
+        os.symlink(outside, os.path.join(self.root, "linked_dir"))
+        os.symlink(os.path.join(outside, "passwd.py"), os.path.join(self.root, "linked.py"))
+
+        files, stats = self.walk()
+        self.assertEqual(files, ["main.py"])
+        self.assertEqual(stats["skipped"]["symlink"], 2)
+
+
+
+class SourceArchiveTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+    def make_zip(self, members, symlinks=()):
+        path = os.path.join(self.root, "upload.zip")
+        with zipfile.ZipFile(path, "w") as zf:
+            for name, data in members.items():
+                zf.writestr(name, data)
+            for name, target in symlinks:
+                info = zipfile.ZipInfo(name)
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                zf.writestr(info, target)
+        return path
+
+    def make_tar(self, members, links=()):
+        path = os.path.join(self.root, "upload.tar.gz")
+        with tarfile.open(path, "w:gz") as tf:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+            for name, target, link_type in links:
+                info = tarfile.TarInfo(name)
+                info.type, info.linkname = link_type, target
+                tf.addfile(info)
+        return path
+
+    def relative(self, source, path):
+        return os.path.relpath(path, source.folder_path).replace(os.sep, "/")
+
+    def test_member_paths_outside_the_archive_are_rejected(self):
+        cases = {
+            "../etc/passwd": None,
+            "a/../../x.py": None,
+            "a\\..\\..\\x.py": None,
+            "..": None,
+            ".": None,
+            "": None,
+            "/etc/app.py": "etc/app.py",
+            "./a/./b.py": "a/b.py",
+            "a/b/../c.py": "a/c.py",
+            "a\\b.py": "a/b.py",
+            "..hidden/x.py": "..hidden/x.py",
+        }
+        for name, expected in cases.items():
+            with self.subTest(name=name):
+                self.assertEqual(_member_path(name), expected)
+
+    def test_unsafe_members_and_symlinks_are_never_yielded(self):
+        path = self.make_zip({"app/main.py": b"x = 1\n", "../evil.py": b"x = 2\n", "app/../../evil2.py": b"x = 3\n"},
+                             symlinks=[("app/link.py", "/etc/passwd")])
+        with open_source_archive(path) as source:
+            self.assertIsInstance(source, ZipSourceArchive)
+            files = list(source)
+            self.assertEqual([self.relative(source, f) for f in files], ["app/main.py"])
+            self.assertEqual(source.read_bytes(files[0]), b"x = 1\n")
+            stats = source.stats()
+        self.assertEqual((stats["skipped"]["unsafe_path"], stats["skipped"]["symlink"]), (2, 1))
+        self.assertEqual(stats["archive_members"], 4)
+
+    def test_tar_symlinks_and_hard_links_are_skipped(self):
+        path = self.make_tar({"main.py": b"x = 1\n", "../evil.py": b"x = 2\n"},
+                             links=[("soft.py", "/etc/passwd", tarfile.SYMTYPE), ("hard.py", "main.py", tarfile.LNKTYPE)])
+        with open_source_archive(path) as source:
+            self.assertIsInstance(source, TarSourceArchive)
+            self.assertEqual([self.relative(source, f) for f in source], ["main.py"])
+            stats = source.stats()
+        self.assertEqual((stats["skipped"]["unsafe_path"], stats["skipped"]["symlink"]), (1, 2))
+
+    def test_member_count_and_expanded_size_are_limited(self):
+        path = self.make_zip({f"f{i}.py": b"x = 1\n" * 10 for i in range(5)})
+        with mock.patch.object(ZipSourceArchive, "close", autospec=True, side_effect=ZipSourceArchive.close) as close:
+            with self.assertRaisesRegex(ArchiveError, "more than 4 members"):
+                ZipSourceArchive(path, max_members=4)
+            with self.assertRaisesRegex(ArchiveError, "more than 100 bytes"):
+                ZipSourceArchive(path, max_uncompressed_bytes=100)
+        self.assertEqual(close.call_count, 2)
+        with ZipSourceArchive(path, max_members=5, max_uncompressed_bytes=300) as source:
+            self.assertEqual(len(list(source)), 5)
+
+    def test_unsupported_and_corrupt_uploads_raise_archive_error(self):
+        text = os.path.join(self.root, "upload.txt")
+        with open(text, "wb") as f:
+            f.write(b"not an archive")
+        with self.assertRaisesRegex(ArchiveError, "Unsupported archive format"):
+            open_source_archive(text)
+
+        truncated = os.path.join(self.root, "truncated.tar.gz")
+        with open(self.make_tar({"main.py": b"x = 1\n" * 1000}), "rb") as f:
+            data = f.read()
+        with open(truncated, "wb") as f:
+            f.write(data[:len(data) // 2])
+        with self.assertRaises(ArchiveError):
+            TarSourceArchive(truncated)
+
+    def test_files_are_selected_like_a_folder(self):
+        path = self.make_zip({
+            ".gitignore": b"secret/\n",
+            "app/.codesenseignore": b"*.gen.py\n",
+            "app/views.py": b"x = 1\n",
+            "app/models.gen.py": b"x = 1\n",
+            "secret/key.py": b"x = 1\n",
+            "node_modules/lib/index.js": b"x = 1\n",
+            "app.min.js": b"x = 1\n",
+            "data.bin.c": b"\0\0\0",
+            "README.md": b"docs",
+        })
+        with open_source_archive(path) as source:
+            self.assertEqual([self.relative(source, f) for f in source], ["app/views.py"])
+            skipped = source.stats()["skipped"]
+        self.assertEqual({reason: skipped[reason] for reason in ("ignored", "excluded_dir", "excluded_file", "binary", "unsupported")},
+                         {"ignored": 2, "excluded_dir": 1, "excluded_file": 1, "binary": 1, "unsupported": 1})
+
+    def test_tar_members_are_read_in_any_order(self):
+        members = {name: name.encode() for name in ("b.py", "a.py", "c.py")}
+        with open_source_archive(self.make_tar(members)) as source:
+            files = {self.relative(source, f): f for f in source}
+            self.assertEqual(list(files), ["b.py", "a.py", "c.py"])
+            self.assertEqual([source.read_bytes(files[name]) for name in ("c.py", "b.py", "a.py")], [b"c.py", b"b.py", b"a.py"])
+
+
+class FakeCollection:
+    """In-memory collection for the equality, $ne, $in and $exists queries the scanner makes."""
+
+    def __init__(self, docs=()):
+        self.docs = [dict(doc) for doc in docs]
+
+    @staticmethod
+    def _matches(doc, query):
+        for field, condition in query.items():
+            value = doc.get(field)
+            if isinstance(condition, dict):
+                if "$ne" in condition and value == condition["$ne"]:
+                    return False
+                if "$in" in condition and value not in condition["$in"]:
+                    return False
+                if "$exists" in condition and (field in doc) != condition["$exists"]:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def find(self, query, projection=None):
+        return [dict(doc) for doc in self.docs if self._matches(doc, query)]
+
+    def find_one(self, query, sort=None):
+        docs = self.find(query)
+        for field, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return docs[0] if docs else None
+
+    def insert_many(self, docs):
+        self.docs.extend(dict(doc) for doc in docs)
+
+    def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if self._matches(doc, query):
+                doc.update(update.get("$set", {}))
+                return
+
+    def delete_many(self, query):
+        self.docs = [doc for doc in self.docs if not self._matches(doc, query)]
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+
+PROJECT_ID = ObjectId()
+
+
+def _scan(days_ago, **fields):
+    return {"_id": ObjectId(), "project_id": PROJECT_ID, "status": "completed", "analysis_version": "v1", "settings_key": "k1",
+            "archive_sha256": "a" * 64, "failed_files": 0, "created_at": datetime.now(timezone.utc) - timedelta(days=days_ago),
+            **fields}
+
+
+@mock.patch("scanner.rag.manifest.get_analysis_version", lambda: "v1")
+class FindIdenticalScanTests(SimpleTestCase):
+    def find(self, scans, settings_key="k1"):
+        with mock.patch.object(manifest, "SCAN_COLLECTION", FakeCollection(scans)):
+            return manifest.find_identical_scan(str(PROJECT_ID), "a" * 64, settings_key)
+
+    def test_latest_clean_scan_is_reused(self):
+        older, newer = _scan(2), _scan(1)
+        self.assertEqual(self.find([older, newer])["_id"], newer["_id"])
+
+    def test_scan_with_failed_files_is_not_reused(self):
+        clean, partial = _scan(2), _scan(1, failed_files=3)
+        self.assertEqual(self.find([clean, partial])["_id"], clean["_id"])
+        self.assertIsNone(self.find([partial]))
+
+    def test_scan_without_a_failure_count_is_not_reused(self):
+        legacy = _scan(1)
+        del legacy["failed_files"]
+        self.assertIsNone(self.find([legacy]))
+
+    def test_other_settings_running_or_other_version_are_not_reused(self):
+        self.assertIsNone(self.find([_scan(1)], settings_key="k2"))
+        self.assertIsNone(self.find([_scan(1, status="in_progress")]))
+        self.assertIsNone(self.find([_scan(1, analysis_version="v0")]))
+
+
+
+@mock.patch("scanner.rag.manifest.get_analysis_version", lambda: "v1")
+class ManifestTests(SimpleTestCase):
+    def setUp(self):
+        self.manifests = FakeCollection()
+        self.scans = FakeCollection()
+        patches = [
+            mock.patch.object(manifest, "MANIFEST_COLLECTION", self.manifests),
+            mock.patch.object(manifest, "SCAN_COLLECTION", self.scans),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_build_manifest_keys_files_by_relative_path(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        os.makedirs(os.path.join(root, "app"))
+        with open(os.path.join(root, "app", "views.py"), "wb") as f:
+            f.write(b"print(1)")
+
+        built = manifest.build_manifest(root, [os.path.join(root, "app", "views.py"), os.path.join(root, "missing.py")])
+        self.assertEqual(built, {"app/views.py": manifest.hash_bytes(b"print(1)")})
+        self.assertEqual(manifest.build_manifest(root, [os.path.join(root, "app", "views.py")], read_bytes=lambda path: b"print(1)"),
+                         built)
+
+    def test_diff_manifest(self):
+        previous = {"same.py": "h1", "changed.py": "h2", "gone.py": "h3"}
+        current = {"same.py": "h1", "changed.py": "h2b", "new.py": "h4"}
+        self.assertEqual(manifest.diff_manifest(previous, current), {
+            "added": {"new.py"}, "modified": {"changed.py"}, "unchanged": {"same.py"}, "removed": {"gone.py"},
+        })
+
+    def test_saved_manifest_loads_back_without_discarded_paths(self):
+        scan = _scan(0)
+        self.scans.docs.append(scan)
+        manifest.save_manifest(str(scan["_id"]), {"a.py": "h1", "b.py": "h2"}, settings_key="k1")
+        manifest.discard_manifest_paths(str(scan["_id"]), ["b.py"])
+
+        self.assertEqual(manifest.load_manifest(scan["_id"]), {"a.py": "h1"})
+        self.assertEqual(self.scans.docs[0]["manifest_files"], 2)
+        self.assertEqual(self.scans.docs[0]["settings_key"], "k1")
+
+    def test_base_scan_is_the_latest_comparable_scan_with_a_manifest(self):
+        current = _scan(0, manifest_files=3)
+        older, newer = _scan(3, manifest_files=3), _scan(2, manifest_files=3)
+        self.scans.docs = [older, newer, current, _scan(1), _scan(1, manifest_files=3, settings_key="k2")]
+        self.assertEqual(manifest.find_base_scan(str(PROJECT_ID), str(current["_id"]), "k1")["_id"], newer["_id"])
+        self.assertIsNone(manifest.find_base_scan(str(PROJECT_ID), str(current["_id"]), "k3"))
+
+    def test_findings_of_unchanged_files_are_carried_forward(self):
+        previous_id, scan_id = ObjectId(), ObjectId()
+        kept = {"_id": ObjectId(), "scan_id": previous_id, "source_path": "same.py", "deleted": False, "status": "approved"}
+        findings = FakeCollection([
+            kept,
+            {"_id": ObjectId(), "scan_id": previous_id, "source_path": "same.py", "deleted": True},
+            {"_id": ObjectId(), "scan_id": previous_id, "source_path": "changed.py", "deleted": False},
+            {"_id": ObjectId(), "scan_id": ObjectId(), "source_path": "same.py", "deleted": False},
+        ])
+        with mock.patch.object(database.collection, "collection", findings), \
+                mock.patch.object(database, "save_findings_to_db") as save:
+            carried = database.carry_forward_findings(previous_id, str(scan_id), {"same.py"})
+
+        self.assertEqual(len(carried), 1)
+        self.assertEqual((carried[0]["carried_from"], carried[0]["scan_id"], carried[0]["status"]), (kept["_id"], scan_id, "approved"))
+        self.assertNotIn("_id", carried[0])
+        save.assert_called_once_with(carried)
+
+
+
+class FakeKnowledgeBase:
+    """The parts of a langchain FAISS store retrieve_documents reads."""
+
+    def __init__(self, vectors, texts):
+        self.index = faiss.IndexFlatL2(vectors.shape[1])
+        self.index.add(vectors)
+        self.index_to_docstore_id = {i: str(i) for i in range(len(texts))}
+        self.docstore = mock.Mock()
+        self.docstore.search.side_effect = lambda doc_id: Document(page_content=texts[int(doc_id)])
+
+
+class RetrievalBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.embed = mock.Mock(side_effect=lambda texts: [[float(len(text)), 0.0] for text in texts])
+        patches = [
+            mock.patch.object(retrieval, "EMBEDDING_CACHE", retrieval.EmbeddingCache(os.path.join(self.root, "cache", "e.sqlite3"))),
+            mock.patch.object(retrieval, "embed_queries", self.embed),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_embedding_cache_round_trip_is_keyed_by_model(self):
+        cache_file = retrieval.EmbeddingCache(os.path.join(self.root, "e.sqlite3"), model="m1")
+        cache_file.put_many([(cache_file.key("query"), [1.0, 2.0])])
+        found = cache_file.get_many([cache_file.key("query"), cache_file.key("other")])
+        self.assertEqual(list(found), [cache_file.key("query")])
+        np.testing.assert_array_equal(found[cache_file.key("query")], np.array([1.0, 2.0], dtype="float32"))
+        self.assertNotEqual(retrieval.EmbeddingCache(model="m2").key("query"), cache_file.key("query"))
+
+    def test_duplicate_and_cached_texts_are_embedded_once(self):
+        matrix = retrieval.embed_texts(["a", "bb", "a"], scan_id="retrieval-scan")
+        self.assertEqual(matrix.tolist(), [[1.0, 0.0], [2.0, 0.0], [1.0, 0.0]])
+        self.assertEqual(sorted(self.embed.call_args.args[0]), ["a", "bb"])
+
+        retrieval.embed_texts(["bb", "ccc"], scan_id="retrieval-scan")
+        self.assertEqual(self.embed.call_args.args[0], ["ccc"])
+        stats = retrieval.pop_retrieval_stats("retrieval-scan")
+        self.assertEqual((stats["embedded"], stats["embedding_cache_hits"]), (3, 1))
+
+    def test_batched_search_returns_each_query_its_nearest_documents(self):
+        kb = FakeKnowledgeBase(np.array([[1.0, 0.0], [2.0, 0.0], [9.0, 0.0]], dtype="float32"), ["one", "two", "nine"])
+        with mock.patch.object(retrieval, "get_knowledge_base", return_value=kb):
+            results = retrieval.retrieve_documents(["a", "xxxxxxxx"], k=2)
+        self.assertEqual([[document.page_content for document, _ in documents] for documents in results],
+                         [["one", "two"], ["nine", "two"]])
+
+    def test_queries_are_resolved_in_one_batch(self):
+        batcher = retrieval.RetrievalBatcher("s1", batch_size=3, max_wait=10)
+        search = mock.Mock(side_effect=lambda texts, k, scan_id: [[text.upper()] for text in texts])
+
+        async def run():
+            return await asyncio.gather(*(batcher.retrieve(text) for text in ("a", "b", "c")))
+
+        with mock.patch.object(retrieval, "retrieve_documents", search):
+            self.assertEqual(asyncio.run(run()), [["A"], ["B"], ["C"]])
+        search.assert_called_once_with(["a", "b", "c"], batcher.k, "s1")
+
+    def test_partial_batch_is_flushed_after_the_wait(self):
+        batcher = retrieval.RetrievalBatcher("s1", batch_size=10, max_wait=0.01)
+        search = mock.Mock(side_effect=lambda texts, k, scan_id: [[text] for text in texts])
+
+        async def run():
+            return await asyncio.gather(batcher.retrieve("a"), batcher.retrieve("b"))
+
+        with mock.patch.object(retrieval, "retrieve_documents", search):
+            self.assertEqual(asyncio.run(run()), [["a"], ["b"]])
+        self.assertEqual(search.call_count, 1)
+
+    def test_search_failure_reaches_every_waiter(self):
+        batcher = retrieval.RetrievalBatcher("s1", batch_size=2, max_wait=10)
+
+        async def run():
+            return await asyncio.gather(batcher.retrieve("a"), batcher.retrieve("b"), return_exceptions=True)
+
+        with mock.patch.object(retrieval, "retrieve_documents", side_effect=RuntimeError("index gone")):
+            results = asyncio.run(run())
+        self.assertEqual([str(result) for result in results], ["index gone", "index gone"])
+
+
+
+class PrecomputedContextTests(SimpleTestCase):
+    def setUp(self):
+        # Every query retrieves one document named after it
+        self.search = mock.Mock(side_effect=lambda texts, k, scan_id: [[(Document(page_content=text), 0.1)] for text in texts])
+        patch = mock.patch.object(retrieval, "retrieve_documents", self.search)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def contents(self, documents):
+        return [document.page_content for document, _ in documents]
+
+    def test_languages_are_retrieved_once_in_one_batch(self):
+        context = retrieval.PrecomputedContext("s1", k=3)
+
+        async def run():
+            await context.precompute(["py", "js", "py"])
+            await context.retrieve("x = 1", "py")
+            await context.retrieve("y = 2", "js")
+
+        asyncio.run(run())
+        self.assertEqual(self.search.call_count, 1)
+        texts = self.search.call_args.args[0]
+        self.assertIn(get_focus_areas("py")[0], texts)
+        self.assertIn(get_focus_areas("js")[0], texts)
+        self.assertIn(retrieval.SINK_CATEGORY_QUERIES["secrets"], texts)
+
+    def test_sink_context_comes_first_and_is_shared_by_signature(self):
+        context = retrieval.PrecomputedContext("s1", k=3)
+
+        async def run():
+            first = await context.retrieve("subprocess.call(cmd)", "py")
+            second = await context.retrieve("subprocess.run(args)", "py")
+            plain = await context.retrieve("x = 1", "py")
+            return first, second, plain
+
+        first, second, plain = asyncio.run(run())
+        self.assertIs(first, second)
+        self.assertEqual(self.contents(first), [retrieval.SINK_CATEGORY_QUERIES["command"]] + get_focus_areas("py")[:2])
+        self.assertEqual(self.contents(plain), get_focus_areas("py")[:3])
+
+    def test_without_refinement_every_chunk_gets_the_focus_context(self):
+        context = retrieval.PrecomputedContext("s1", k=3, refine=False)
+
+        async def run():
+            return await context.retrieve("subprocess.call(cmd)", "py"), await context.retrieve("x = 1", "py")
+
+        with_sink, plain = asyncio.run(run())
+        self.assertIs(with_sink, plain)
+        self.assertEqual(self.contents(plain), get_focus_areas("py")[:3])
+
+    def test_unknown_language_is_retrieved_on_first_use(self):
+        context = retrieval.PrecomputedContext("s1", k=2)
+        documents = asyncio.run(context.retrieve("x", "zig"))
+        self.assertEqual(self.contents(documents), get_focus_areas("zig")[:2])
+        self.assertEqual(self.search.call_count, 1)
+
+
+
+class AssembleContextTests(SimpleTestCase):
+    def setUp(self):
+        context.pop_token_stats("context-scan")
+
+    def scored(self, *pairs):
+        return [(Document(page_content=text), distance) for text, distance in pairs]
+
+    def assemble(self, scored, overhead_tokens=0, **kwargs):
+        kwargs.setdefault("relative_distance", None)
+        kwargs.setdefault("max_distance", None)
+        documents = context.assemble_context(scored, "prompt", overhead_tokens, scan_id="context-scan", **kwargs)
+        return [document.page_content for document in documents]
+
+    def test_documents_are_ranked_by_distance(self):
+        self.assertEqual(self.assemble(self.scored(("far", 3.0), ("near", 1.0), ("mid", 2.0))), ["near", "mid", "far"])
+
+    def test_documents_far_from_the_best_match_are_dropped(self):
+        scored = self.scored(("best", 1.0), ("close", 1.4), ("far", 2.0))
+        self.assertEqual(self.assemble(scored, relative_distance=1.5), ["best", "close"])
+        self.assertEqual(self.assemble(scored, max_distance=1.2), ["best"])
+        self.assertEqual(self.assemble(scored, relative_distance=1.5, max_distance=1.2), ["best"])
+
+    def test_best_match_is_kept_beyond_the_max_distance(self):
+        self.assertEqual(self.assemble(self.scored(("best", 5.0), ("next", 6.0)), max_distance=1.0), ["best"])
+
+    def test_documents_over_the_token_budget_are_skipped(self):
+        first, big, second, third = "alpha " * 10, "word " * 200, "beta " * 10, "gamma " * 10
+        # Leave room for the prompt plus exactly the first and second documents
+        overhead = context.context_budget(count_tokens("prompt")) - sum(
+            count_tokens(text) + context.DOCUMENT_SEPARATOR_TOKENS for text in (first, second))
+        scored = self.scored((first, 1.0), (big, 1.1), (second, 1.2), (third, 1.3))
+        self.assertEqual(self.assemble(scored, overhead), [first, second])
+
+        stats = context.pop_token_stats("context-scan")
+        self.assertEqual((stats["docs_used"], stats["docs_dropped_budget"], stats["overflows"]), (2, 2, 0))
+        self.assertEqual(stats["prompt_tokens"], count_tokens("prompt") + overhead)
+
+    def test_prompt_that_fills_the_window_is_an_overflow(self):
+        overhead = context.context_budget(count_tokens("prompt")) + 1
+        self.assertEqual(self.assemble(self.scored(("doc", 1.0)), overhead), [])
+        stats = context.pop_token_stats("context-scan")
+        self.assertEqual((stats["overflows"], stats["docs_dropped_budget"]), (1, 1))
+
+
+class LoadIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.kb_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.kb_dir, ignore_errors=True)
+        self.vectors = np.random.RandomState(0).rand(500, 16).astype("float32")
+        self.path = os.path.join(self.kb_dir, kb_store.INDEX_FILE)
+
+    def write(self, index):
+        index.add(self.vectors)
+        faiss.write_index(index, self.path)
+
+    @unittest.skipUnless(os.path.exists("/proc/self/maps"), "needs /proc to see mappings")
+    def test_flat_and_hnsw_indexes_are_mmap_backed(self):
+        for index_type, index in (("flat", faiss.IndexFlatL2(16)), ("hnsw", faiss.IndexHNSWFlat(16, 8))):
+            with self.subTest(index_type=index_type):
+                self.write(index)
+                loaded = kb_store.load_index(self.kb_dir, index_type)
+                with open("/proc/self/maps") as f:
+                    self.assertIn(os.path.realpath(self.path), f.read())
+                self.assertEqual(loaded.search(self.vectors[:1], 1)[1][0][0], 0)
+                del loaded
+
+    def test_unsupported_flags_fall_back(self):
+        self.write(faiss.IndexFlatL2(16))
+        read_index = faiss.read_index
+        attempts = []
+
+        def reject_mmap(path, flags=0):
+            attempts.append(flags)
+            if flags:
+                raise RuntimeError("not supported for this index type")
+            return read_index(path)
+
+        with mock.patch("scanner.rag.kb_store.faiss.read_index", side_effect=reject_mmap):
+            loaded = kb_store.load_index(self.kb_dir, "flat")
+        self.assertEqual(attempts, kb_store._MMAP_FLAGS + [0])
+        self.assertEqual(loaded.ntotal, 500)
+
+
+class ContentDedupeTests(SimpleTestCase):
+    def setUp(self):
+        self.scan_id, self.user_id = str(ObjectId()), str(ObjectId())
+        self.stored = {}
+        self.store_calls = []
+        self.analysed = []
+        self.owner_error = None
+        patches = [
+            mock.patch("scanner.rag.dedupe.get_analysis_version", lambda: "v1"),
+            mock.patch.object(scan_pipeline, "scan_file", self.fake_scan_file),
+            mock.patch.object(scan_pipeline, "FindingWriter", lambda: mock.Mock(flush=mock.AsyncMock())),
+            mock.patch.object(scan_pipeline, "update_progress"),
+            mock.patch.object(scan_pipeline, "display_progress"),
+            mock.patch.object(scan_pipeline, "get_retriever", lambda scan_id: object()),
+            mock.patch.object(scan_pipeline, "get_content_analysis", lambda key, scan_id=None: self.stored.get(key)),
+            mock.patch.object(scan_pipeline, "store_content_analysis",
+                              lambda key, findings: self.store_calls.append((key, list(findings)))),
+            # Every file goes through scan_file rather than a packed prompt
+            mock.patch.object(scan_pipeline.PromptPacker, "accepts", lambda packer, content: None),
+            mock.patch.object(scan_pipeline, "SCAN_FILE_CONCURRENCY", 3),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def fake_scan_file(self, file_path, *args, file_content=None, **kwargs):
+        self.analysed.append(file_path)
+        if self.owner_error:
+            raise AnalysisError(self.owner_error, [])
+        return [{"title": "Code injection", "lines": [2, 3], "code_snip": "eval(data)", "scan_id": ObjectId(self.scan_id),
+                 "code": "F-1", "file_path": f"{os.path.basename(file_path)} [2,3]"}]
+
+    def scan(self, files):
+        discovery = mock.Mock(read_bytes=lambda path: files[path])
+        findings = []
+
+        failed = asyncio.run(scan_pipeline._scan_files("/src", discovery, list(files), self.scan_id, self.user_id, findings,
+                                                       PRIORITY_BULK, "off", {"enabled": False}, {}))
+        return failed, findings
+
+    def test_normalize_content_ignores_line_endings_trailing_space_and_bom(self):
+        self.assertEqual(normalize_content("\ufeffimport os  \r\nprint(1)\t\r\n\r\n"), "import os\nprint(1)")
+        self.assertEqual(normalize_content("a\n\nb"), "a\n\nb")
+
+    def test_copy_finding_belongs_to_the_new_file_and_scan(self):
+        original = {"_id": ObjectId(), "title": "Code injection", "lines": [4, 6], "code": "F-1", "scan_id": ObjectId(),
+                    "file_path": "a.py [4,6]", "source_path": "pkg/a.py", "status": "closed", "approved": True}
+        copy = copy_finding(original, "b.py", self.scan_id, self.user_id)
+        self.assertEqual(copy["file_path"], "b.py [4,6]")
+        self.assertEqual(copy["lines"], [4, 6])
+        self.assertEqual((copy["status"], copy["approved"]), ("open", False))
+        self.assertEqual(copy["scan_id"], ObjectId(self.scan_id))
+        self.assertNotIn("_id", copy)
+        self.assertNotIn("source_path", copy)
+        self.assertNotEqual(copy["code"], "F-1")
+
+    def test_duplicates_in_a_scan_are_analysed_once(self):
+        content = b"import os\nprint(eval(input()))\n"
+        failed, findings = self.scan({"/src/a/x.py": content, "/src/b/y.py": content.replace(b"\n", b"\r\n"),
+                                      "/src/c/z.py": b"other = 1\n"})
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(self.analysed), ["/src/a/x.py", "/src/c/z.py"])
+        by_path = {finding["source_path"]: finding for finding in findings if finding["title"] == "Code injection"}
+        self.assertEqual(by_path["b/y.py"]["file_path"], "y.py [2,3]")
+        self.assertEqual(by_path["b/y.py"]["lines"], [2, 3])
+        self.assertNotEqual(by_path["b/y.py"]["code"], by_path["a/x.py"]["code"])
+        self.assertEqual(len(self.store_calls), 2)
+
+    def test_owner_failure_fails_waiting_duplicates_and_is_not_stored(self):
+        self.owner_error = "LLM call failed: connection refused"
+        content = b"import os\nprint(eval(input()))\n"
+
+        async def held_scan_file(*args, **kwargs):
+            # Hold the owner back so that its duplicates queue up behind it
+            await asyncio.sleep(0.01)
+            return await self.fake_scan_file(*args, **kwargs)
+
+        with mock.patch.object(scan_pipeline, "scan_file", held_scan_file):
+            failed, findings = self.scan({"/src/a/x.py": content, "/src/b/y.py": content, "/src/c/y.py": content})
+        self.assertEqual(self.analysed, ["/src/a/x.py"])
+        self.assertEqual(sorted(failed), ["/src/a/x.py", "/src/b/y.py", "/src/c/y.py"])
+        self.assertEqual(findings, [])
+        self.assertEqual(self.store_calls, [])
+
+    def test_analysis_stored_by_an_earlier_scan_is_reused(self):
+        content = b"import os\nprint(eval(input()))\n"
+        self.scan({"/src/a/x.py": content})
+        key, stored = self.store_calls[0]
+        self.stored[key] = stored
+        self.analysed.clear()
+
+        failed, findings = self.scan({"/src/moved/w.py": content.replace(b"\n", b"  \n")})
+        self.assertEqual((failed, self.analysed), ([], []))
+        self.assertEqual(findings[0]["file_path"], "w.py [2,3]")
+        self.assertEqual(findings[0]["source_path"], "moved/w.py")
+        # A reused analysis is not written back
+        self.assertEqual(len(self.store_calls), 1)
@@ -1,8 +1,9 @@
 from django.urls import path
-from scanner.views import ScanCreateView, ScanProgressView, TestScanView
+from scanner.views import ScanCreateView, ScanProgressView, ScannerStatusView, TestScanView
 
 urlpatterns = [
     path("test/", TestScanView.as_view(), name="test-scan"),
+    path("status/", ScannerStatusView.as_view(), name="scanner-status"),
     path("create/", ScanCreateView.as_view(), name="create-scan"),
     path("<str:scan_id>/", ScanProgressView.as_view(), name="scan-detail"),
     
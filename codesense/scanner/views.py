@@ -1,4 +1,4 @@
-import os, zipfile, uuid
+import os, uuid
 import tempfile
 from django.http import JsonResponse
 from django.conf import settings
@@ -9,6 +9,8 @@ from django.utils.decorators import method_decorator
 from rest_framework.views import APIView
 from rest_framework import status
 from .rag.scanner import scan_folder
+from .rag.archive import open_source_archive, ArchiveError
+from .rag.warmup import ensure_ready, get_warmup_status
 import logging
 import shutil
 import threading
@@ -33,6 +35,15 @@ class ScanCreateView(APIView):
             project_id = serializer.validated_data['project_id']
             triggered_by = serializer.validated_data.get('triggered_by', '')
             zip_file = serializer.validated_data['zip_file']
+            scan_mode = serializer.validated_data['scan_mode']
+            priority = serializer.validated_data['priority']
+            triage_level = serializer.validated_data.get('triage_level')
+            cascade = serializer.validated_data.get('cascade')
+
+            if not ensure_ready(str(settings.SCANNER_KB_PATH)):
+                response = JsonResponse({"detail": "Scanner is warming up. Please try again shortly."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                response["Retry-After"] = "10"
+                return response
  
             # Check concurrent scan limit
             with scan_lock:
@@ -47,39 +58,31 @@ class ScanCreateView(APIView):
                 "scan_name": scan_name,
                 "project_id": project_id,
                 "status": "queued",
+                "scan_mode": scan_mode,
+                "priority": priority,
                 "triggered_by": triggered_by if triggered_by else None
             }
             scan = ScanModel.create(scan_data)
             scan_id = scan["id"]
  
-            # Create temporary directory for both ZIP file and extraction
+            # The upload is scanned in place: source files are read straight from the archive
             temp_dir = tempfile.mkdtemp()
-            temp_zip_path = os.path.join(temp_dir, zip_file.name)
-            extracted_folder_path = os.path.join(temp_dir, 'extracted')
-   
+            temp_zip_path = os.path.join(temp_dir, os.path.basename(zip_file.name))
+
             try:
-                # Save uploaded ZIP file
+                # Save uploaded archive
                 with open(temp_zip_path, 'wb+') as f:
                     for chunk in zip_file.chunks():
                         f.write(chunk)
-                logging.info(f"Uploaded zipped folder saved to {temp_zip_path}")
- 
-                os.makedirs(extracted_folder_path, exist_ok=True)
-                with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(extracted_folder_path)
-                logging.info(f"ZIP file extracted to {extracted_folder_path}")
-               
-                # List contents for debugging
-                extracted_contents = []
-                for root, dirs, files in os.walk(extracted_folder_path):
-                    for file in files:
-                        extracted_contents.append(os.path.join(root, file))
-                logging.info(f"Extracted {len(extracted_contents)} files: {extracted_contents[:10]}...")  # Show first 10 files
- 
-            except zipfile.BadZipFile:
-                logging.error("Uploaded file is not a valid ZIP file")
+                logging.info(f"Uploaded archive saved to {temp_zip_path}")
+
+                source = open_source_archive(temp_zip_path)
+                logging.info(f"Archive has {source.members} members, {source.files} source files to scan")
+
+            except ArchiveError as e:
+                logging.error(f"Rejected uploaded archive: {e}")
                 shutil.rmtree(temp_dir)
-                return JsonResponse({"error": "Invalid zip file"}, status=status.HTTP_400_BAD_REQUEST)
+                return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
  
             except Exception as e:
                 logging.error(f"Failed to process uploaded file: {e}")
@@ -89,12 +92,10 @@ class ScanCreateView(APIView):
             # Start scan in background thread
             def run_scan():
                 try:
-                    # Get kb_path - assuming it's in the scanner directory
-                    kb_path = os.path.join(os.getcwd(), 'scanner')
+                    kb_path = str(settings.SCANNER_KB_PATH)
                     logging.info(f"Starting concurrent scan with scan_name={scan_name}, kb_path={kb_path}")
                    
-                    # Call scan_folder with extracted folder path
-                    findings = scan_folder(folder_path=extracted_folder_path, scan_id=scan_id, triggered_by=triggered_by, kb_path=kb_path, scan_name=scan_name)
+                    findings = scan_folder(folder_path=temp_zip_path, source=source, scan_id=scan_id, triggered_by=triggered_by, kb_path=kb_path, scan_name=scan_name, project_id=project_id, scan_mode=scan_mode, priority=priority, triage_level=triage_level, cascade=cascade)
                     logging.info(f"Concurrent scan completed successfully. Found {len(findings) if findings else 0} vulnerabilities.")
                    
                 except Exception as e:
@@ -104,6 +105,7 @@ class ScanCreateView(APIView):
                 finally:
                     # Cleanup temp files and directory
                     try:
+                        source.close()
                         shutil.rmtree(temp_dir)
                         logging.info(f"Cleaned up temporary directory: {temp_dir}")
                     except Exception as e:
@@ -132,6 +134,12 @@ class ScanProgressView(APIView):
         return JsonResponse({"result": scan })
  
        
+class ScannerStatusView(APIView):
+    def get(self, request):
+        warmup = get_warmup_status()
+        return JsonResponse(warmup, status=status.HTTP_200_OK if warmup["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
 class TestScanView(APIView):
     def get(self, request):
         return JsonResponse({"detail": "Hello"})